@@ -17,8 +17,11 @@ import re   # for regular expressions
 from config import FLAGS
 import config as conf
 import models as mod
+import model_runtime as rt
 import metrics as met
 import utils as utl
+import training as trn
+import monitoring as mon
 import math
 
 # Get logger that has already been created in config.py
@@ -147,7 +150,8 @@ def main(args):
                 scope,
                 num_classes,
                 reuse_variables=reuse_variables,
-                is_train=True)
+                is_train=True,
+                augment=False)
           
           # Don't reuse variable for first GPU, but do reuse for others
           reuse_variables = True
@@ -171,18 +175,17 @@ def main(args):
     # We must calculate the mean of each gradient. Note that this is the
     # synchronization point across all towers.
     grads = average_gradients(tower_grads)
-    
-    # See: https://stackoverflow.com/questions/40701712/how-to-check-nan-in-
-    # gradients-in-tensorflow-when-updating
-    grad_check = ([tf.check_numerics(g, message='Gradient NaN Found!') 
-                      for g, _ in grads if g is not None]
-                  + [tf.check_numerics(loss, message='Loss NaN Found')])
-    
-    # Apply the gradients to adjust the shared variables
-    with tf.control_dependencies(grad_check):
-      update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
-      with tf.control_dependencies(update_ops):
-        train_op = opt.apply_gradients(grads, global_step=global_step)
+
+    # Accumulate gradients over FLAGS.accumulate_steps micro-batches, so that
+    # each update (and each increment of global_step) sees an effective batch
+    # of FLAGS.batch_size * FLAGS.accumulate_steps, and apply them unless
+    # they are not finite
+    train_ops = trn.build_train_op(
+        opt, grads, tf.add_n(tower_losses), global_step,
+        update_ops=tf.get_collection(tf.GraphKeys.UPDATE_OPS),
+        accumulate_steps=FLAGS.accumulate_steps)
+    train_op, accum_op = train_ops.train_op, train_ops.accum_op
+    skipped_steps = train_ops.skipped_steps
     
     # Calculate mean loss     
     loss = tf.reduce_mean(tower_losses)
@@ -204,6 +207,7 @@ def main(args):
              'logits' : logits,
              'probs' : probs,
              'acc' : acc,
+             'skipped_steps' : skipped_steps,
              }
     
     # Reset and read operations for streaming metrics go here
@@ -227,6 +231,10 @@ def main(args):
         
     # Set summary op
     trn_summary = tf.summary.merge_all()
+    # The gradient norm is only written on steps that apply an update, as on
+    # the other steps it would be that of a partial sum
+    grad_summary = tf.summary.merge(
+        tf.get_collection(trn.GRADIENT_SUMMARIES))
 
   #----------------------------------------------------------------------------
   # GRAPH - TRAINING SET ACCURACY
@@ -449,6 +457,17 @@ def main(args):
     else:
       prev_step = 0
 
+    # Micro-batches since the start of training, counted from the restored
+    # updates rather than from the step of the checkpoint, so that a resumed
+    # run starts at the beginning of an accumulation cycle
+    if FLAGS.accumulate_steps > 1:
+      sess_train.run(train_ops.reset_accum)
+    micro_step = (int(sess_train.run(train_ops.num_updates))
+                  * FLAGS.accumulate_steps)
+    # Set when summaries are due, cleared once the gradient norm is written on
+    # the next step that applies an update
+    grad_summary_due = False
+
   # Create summary writer, and write the train graph
   summary_writer = tf.summary.FileWriter(train_summary_dir, 
                                          graph=sess_train.graph)
@@ -492,7 +511,12 @@ def main(args):
   SUMMARY_FREQ = 100
   SAVE_MODEL_FREQ = num_batches_per_epoch # 500
   VAL_FREQ = num_batches_per_epoch # 500
-  PROFILE_FREQ = 5
+
+  # Trace a bounded window of steps, and then turn profiling off
+  if FLAGS.profile:
+    profiler = mon.TraceWindow(os.path.join(train_dir, 'profile'),
+                               prev_step + FLAGS.profile_start_step,
+                               FLAGS.profile_steps)
   #print("starting main loop") 
   for step in range(prev_step, FLAGS.epoch * num_batches_per_epoch + 1): 
     #print("looping")
@@ -509,10 +533,8 @@ def main(args):
       with g_train.as_default():
     
           # With profiling
-          if (FLAGS.profile is True) and ((step % PROFILE_FREQ) == 0): 
-            logger.info("Train with Profiling")
-            run_options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
-            run_metadata = tf.RunMetadata()
+          if FLAGS.profile and profiler.active(step):
+            run_options, run_metadata = profiler.run_options(step)
           # Without profiling
           else:
             run_options = None
@@ -523,21 +545,38 @@ def main(args):
             logger.info("Reset streaming metrics")
             sess_train.run([trn_reset])
           
+          # Only apply the update on the last of FLAGS.accumulate_steps
+          # micro-batches, otherwise just accumulate the gradients
+          apply_step = (micro_step % FLAGS.accumulate_steps
+                        == FLAGS.accumulate_steps - 1)
+          step_op = train_op if apply_step else accum_op
+          if (step % SUMMARY_FREQ) == 0:
+            grad_summary_due = True
+          fetch_grad_summary = apply_step and grad_summary_due
+
           # MAIN RUN
           tic = time.time()
-          train_op_v, trn_metrics_v, trn_summary_v = sess_train.run(
-              [train_op, trn_metrics, trn_summary], 
-              options=run_options, 
-              run_metadata=run_metadata)
+          fetches = [step_op, trn_metrics, trn_summary]
+          if fetch_grad_summary:
+            fetches.append(grad_summary)
+          fetches_v = sess_train.run(fetches,
+                                     options=run_options,
+                                     run_metadata=run_metadata)
+          train_op_v, trn_metrics_v, trn_summary_v = fetches_v[:3]
           toc = time.time()
+          micro_step += 1
+          if fetch_grad_summary:
+            summary_writer.add_summary(fetches_v[3], step)
+            grad_summary_due = False
           
           # Read streaming metrics
           trn_read_v = sess_train.run(trn_read)
           
-          # Write summary for profiling
+          # Write summary and traces for profiling
           if run_options is not None: 
             summary_writer.add_run_metadata(
-                run_metadata, 'epoch{:f}'.format(epoch_decimal))
+                run_metadata, 'step{:d}'.format(step))
+            profiler.record(step, run_metadata)
           
           # Logging
           #logger.info('TRN'
@@ -554,11 +593,6 @@ def main(args):
       sess_val.close()
       sys.exit()
       
-    except tf.errors.InvalidArgumentError as e:
-      logger.warning('%d iteration contains NaN gradients. Discard.' % step)
-      logger.error(str(e))
-      continue
-      
     else:
       # WRITE SUMMARY
       if (step % SUMMARY_FREQ) == 0:
@@ -566,6 +600,9 @@ def main(args):
         with g_train.as_default():
           # Summaries from graph
           summary_writer.add_summary(trn_summary_v, step)
+        if trn_metrics_v['skipped_steps'] > 0:
+          logger.warning('{} updates skipped due to NaN/Inf gradients so far'
+                         .format(trn_metrics_v['skipped_steps']))
           
       # SAVE MODEL
       if (step % SAVE_MODEL_FREQ) == 0:
@@ -704,55 +741,53 @@ def _pad_and_tile_patch(patch):
   return tf.stack([patch] * FLAGS.batch_size)
 
 
-def _transform_vector(width, x_shift, y_shift, im_scale, rot_in_degrees):
-  """
+def _random_transform_vectors(batch_size, scale_min, scale_max, width):
+  """Random projective transforms of the patch, one for each image.
+
   https://github.com/tensorflow/cleverhans/blob/master/examples/adversarial_patch/AdversarialPatch.ipynb
-   If one row of transforms is [a0, a1, a2, b0, b1, b2, c0, c1],
-   then it maps the output point (x, y) to a transformed input point
+   Each row is [a0, a1, a2, b0, b1, b2, c0, c1], which maps the output point
+   (x, y) to a transformed input point
    (x', y') = ((a0 x + a1 y + a2) / k, (b0 x + b1 y + b2) / k),
    where k = c0 x + c1 y + 1.
    The transforms are inverted compared to the transform mapping input points to output points.
+  The scale, shift and rotation are drawn with TensorFlow ops for the whole
+  batch, rather than with NumPy in a py_func per image, so that the overlay
+  runs on the tower device.
   """
-
-  rot = float(rot_in_degrees) / 90. * (math.pi / 2)
-
-  # Standard rotation matrix
-  # (use negative rot because tf.contrib.image.transform will do the inverse)
-  rot_matrix = np.array(
-    [[math.cos(-rot), -math.sin(-rot)],
-     [math.sin(-rot), math.cos(-rot)]]
-  )
-
-  # Scale it
-  # (use inverse scale because tf.contrib.image.transform will do the inverse)
+  im_scale = tf.random_uniform([batch_size], scale_min, scale_max)
+  padding_after_scaling = (1 - im_scale) * width
+  x_shift = tf.random_uniform([batch_size], -1., 1.) * padding_after_scaling
+  y_shift = tf.random_uniform([batch_size], -1., 1.) * padding_after_scaling
+  rot_in_degrees = tf.random_uniform([batch_size], -FLAGS.max_rotation,
+                                     FLAGS.max_rotation)
+  rot = rot_in_degrees / 90. * (math.pi / 2)
+
+  # Standard rotation matrix, scaled
+  # (use negative rot and inverse scale because tf.contrib.image.transform
+  # will do the inverse)
   epsilon = 1e-8
   inv_scale = 1. / (im_scale + epsilon)
-  xform_matrix = rot_matrix * inv_scale
-  a0, a1 = xform_matrix[0]
-  b0, b1 = xform_matrix[1]
+  a0 = tf.cos(-rot) * inv_scale
+  a1 = -tf.sin(-rot) * inv_scale
+  b0 = tf.sin(-rot) * inv_scale
+  b1 = tf.cos(-rot) * inv_scale
 
   # At this point, the image will have been rotated around the top left corner,
   # rather than around the center of the image.
   #
   # To fix this, we will see where the center of the image got sent by our transform,
   # and then undo that as part of the translation we apply.
-  x_origin = float(width) / 2
-  y_origin = float(width) / 2
-
-  x_origin_shifted, y_origin_shifted = np.matmul(
-    xform_matrix,
-    np.array([x_origin, y_origin]),
-  )
-
-  x_origin_delta = x_origin - x_origin_shifted
-  y_origin_delta = y_origin - y_origin_shifted
+  origin = float(width) / 2
+  x_origin_delta = origin - (a0 * origin + a1 * origin)
+  y_origin_delta = origin - (b0 * origin + b1 * origin)
 
   # Combine our desired shifts with the rotation-induced undesirable shift
   a2 = x_origin_delta - (x_shift / (2 * im_scale + epsilon))
   b2 = y_origin_delta - (y_shift / (2 * im_scale + epsilon))
 
   # Return these values in the order that tf.contrib.image.transform expects
-  return np.array([a0, a1, a2, b0, b1, b2, 0, 0]).astype(np.float32)
+  zeros = tf.zeros([batch_size])
+  return tf.stack([a0, a1, a2, b0, b1, b2, zeros, zeros], axis=1)
 
 
 def _circle_mask(shape, sharpness = 40):
@@ -779,33 +814,14 @@ def _random_overlay(imgs, patch, scale_min, scale_max):
   """
   # Add padding
   batch_size = imgs.get_shape().as_list()[0]
-  max_rotation = FLAGS.max_rotation
   image_shape = imgs.get_shape().as_list()[1:]
 
   image_mask = _circle_mask(image_shape)
   image_mask = tf.stack([image_mask] * batch_size)
   padded_patch = tf.stack([patch] * batch_size)
 
-  def _random_transformation(scale_mi, scale_ma, width):
-    im_scale = np.random.uniform(low=scale_mi, high=scale_ma)
-
-    padding_after_scaling = (1 - im_scale) * width
-    x_delta = np.random.uniform(-padding_after_scaling, padding_after_scaling)
-    y_delta = np.random.uniform(-padding_after_scaling, padding_after_scaling)
-
-    rot = np.random.uniform(-max_rotation, max_rotation)
-
-    return _transform_vector(width,
-                             x_shift=x_delta,
-                             y_shift=y_delta,
-                             im_scale=im_scale,
-                             rot_in_degrees=rot)
-  transform_vecs = []
-  for _ in range(batch_size):
-    random_xform_vector = tf.py_func(_random_transformation, [scale_min, scale_max, image_shape[0]],
-                                     tf.float32)
-    random_xform_vector.set_shape([8])
-    transform_vecs.append(random_xform_vector)
+  transform_vecs = _random_transform_vectors(batch_size, scale_min, scale_max,
+                                             image_shape[0])
 
   image_mask = tf.contrib.image.transform(image_mask, transform_vecs, "BILINEAR")
   padded_patch = tf.contrib.image.transform(padded_patch, transform_vecs, "BILINEAR")
@@ -839,7 +855,8 @@ def tower_fn(build_arch,
              scope,
              num_classes,
              is_train=True,
-             reuse_variables=None):
+             reuse_variables=None,
+             augment=False):
   """Model tower to be run on each GPU.
   
   Args: 
@@ -850,6 +867,8 @@ def tower_fn(build_arch,
     num_classes:
     is_train:
     reuse_variables: False for the first GPU, and True for subsequent GPUs
+    augment: whether uint8 inputs get the training augmentation, see
+      rt.device_preprocess
 
   Returns:
     loss: mean loss across samples for one tower (scalar)
@@ -862,9 +881,11 @@ def tower_fn(build_arch,
       (64/4=16, 5)
   """
   
+  x = rt.device_preprocess(x, augment)
   with tf.variable_scope(tf.get_variable_scope(), reuse=reuse_variables):
     x, patch = patch_inputs(x, is_train=is_train, reuse=reuse_variables)
-    output = build_arch(x, False, num_classes=num_classes)
+  output = rt.build_tower(build_arch, x, num_classes, is_train=False,
+                          reuse_variables=reuse_variables)
   targets = tf.fill(dims=y.get_shape().as_list(), value=FLAGS.target_class, name="adversarial_targets")
   if FLAGS.carliniwagner:
     # carlini wagner adversarial objective
@@ -28,6 +28,7 @@ logger = daiquiri.getLogger(__name__)
 from config import FLAGS
 import config as conf
 import models as mod
+import model_runtime as rt
 import metrics as met
 from PIL import Image
 import matplotlib.pyplot as plt
@@ -98,9 +99,12 @@ def main(args):
     # --------------------------------------------------------------------------
     # Calculate the logits for each model tower
     with tf.device('/gpu:0'):
+      # Preprocess uint8 batches here, so the images logged below are those
+      # seen by the model
+      batch_x = rt.device_preprocess(batch_x, is_train=False)
       with tf.name_scope('tower_0') as scope:
         with slim.arg_scope([slim.variable], device='/cpu:0'):
-          loss, logits, recon, cf_recon = tower_fn(
+          loss, output = rt.tower_fn(
             build_arch,
             batch_x,
             batch_labels,
@@ -108,6 +112,9 @@ def main(args):
             num_classes,
             reuse_variables=tf.AUTO_REUSE,
             is_train=False)
+          logits = output['scores']
+          recon = output['decoder_out']
+          cf_recon = output['zeroed_bg_decoder_out']
 
         # Keep track of losses and logits across for each tower
         recon_images = tf.reshape(recon, batch_x.get_shape())
@@ -181,42 +188,5 @@ def main(args):
         plt.show()
 
 
-def tower_fn(build_arch,
-             x,
-             y,
-             scope,
-             num_classes,
-             is_train=False,
-             reuse_variables=None):
-  """Model tower to be run on each GPU.
-
-  Author:
-    Ashley Gritzman 27/11/2018
-
-  Args:
-    build_arch:
-    x: split of batch_x allocated to particular GPU
-    y: split of batch_y allocated to particular GPU
-    scope:
-    num_classes:
-    is_train:
-    reuse_variables: False for the first GPU, and True for subsequent GPUs
-
-  Returns:
-    loss: mean loss across samples for one tower (scalar)
-    scores:
-      If the architecture is a capsule network, then the scores are the output
-      activations of the class caps.
-      If the architecture is the CNN baseline, then the scores are the logits of
-      the final layer.
-      (samples_per_tower, n_classes)
-      (64/4=16, 5)
-  """
-
-  with tf.variable_scope(tf.get_variable_scope(), reuse=reuse_variables):
-    output = build_arch(x, is_train, num_classes=num_classes)
-  loss = mod.total_loss(output, y)
-  return loss, output['scores'], output['decoder_out'], output['zeroed_bg_decoder_out']
-
 if __name__ == "__main__":
   tf.app.run()
@@ -0,0 +1,86 @@
+"""
+License: Apache 2.0
+
+Step time of the capsule network with and without XLA, for the smallNORB and
+cifar10 input shapes.
+
+Each configuration is built in its own graph and trained on random inputs,
+so the input pipeline is not part of the measurement. The first steps, which
+include the XLA compilation, are not timed. Runs on the CPU unless GPUs are
+visible, e.g.
+
+  CUDA_VISIBLE_DEVICES= python3 benchmark_xla.py --batch_size=16
+"""
+
+import tensorflow as tf
+import tensorflow.contrib.slim as slim
+import numpy as np
+
+import time
+
+from config import FLAGS
+import config as conf
+import models as mod
+
+# Input shape and number of classes of the architectures benchmarked
+BENCHMARKS = {'smallNORB': ([32, 32, 1], 5),
+              'cifar10': ([32, 32, 3], 10)}
+WARMUP_STEPS = 5
+
+
+def step_times(dataset_name, xla):
+  """Time training steps of the architecture of dataset_name.
+
+  Args:
+    dataset_name: key of BENCHMARKS
+    xla: whether to compile the tower with XLA
+  Returns:
+    times: seconds of each timed step
+  """
+  image_shape, num_classes = BENCHMARKS[dataset_name]
+  FLAGS.xla = xla
+  build_arch = conf.get_dataset_architecture(dataset_name)
+
+  g = tf.Graph()
+  with g.as_default():
+    tf.set_random_seed(1234)
+    x = tf.random_uniform([FLAGS.batch_size] + image_shape)
+    y = tf.random_uniform([FLAGS.batch_size], maxval=num_classes,
+                          dtype=tf.int64)
+    with slim.arg_scope([slim.variable], device='/cpu:0'):
+      with conf.tower_jit_scope():
+        output = build_arch(x, True, num_classes=num_classes, y=y)
+        loss = mod.total_loss(output, y)
+    train_op = tf.train.AdamOptimizer(FLAGS.lrn_rate).minimize(loss)
+
+    with tf.Session(config=conf.get_session_config()) as sess:
+      sess.run(tf.global_variables_initializer())
+      for _ in range(WARMUP_STEPS):
+        sess.run(train_op)
+      times = []
+      for _ in range(FLAGS.benchmark_steps):
+        tic = time.time()
+        sess.run(train_op)
+        times.append(time.time() - tic)
+  return np.array(times)
+
+
+def main(args):
+  """Print the median step time with and without XLA for each architecture."""
+  xla = FLAGS.xla
+  rows = []
+  for dataset_name in BENCHMARKS:
+    base = np.median(step_times(dataset_name, xla=False))
+    jit = np.median(step_times(dataset_name, xla=True))
+    rows.append((dataset_name, base, jit))
+  FLAGS.xla = xla
+
+  print('{:<12} {:>12} {:>12} {:>9}'.format(
+      'dataset', 'no xla (s)', 'xla (s)', 'speedup'))
+  for dataset_name, base, jit in rows:
+    print('{:<12} {:>12.4f} {:>12.4f} {:>8.2f}x'.format(
+        dataset_name, base, jit, base / jit))
+
+
+if __name__ == "__main__":
+  tf.app.run()
@@ -0,0 +1,247 @@
+"""
+License: Apache 2.0
+"""
+
+import tensorflow as tf
+
+import os
+import threading
+import time
+
+# Get logger that has already been created in config.py
+import daiquiri
+logger = daiquiri.getLogger(__name__)
+
+
+def retained_checkpoints(checkpoints, metrics, permanent, keep_last,
+                         keep_best):
+  """Checkpoints kept by the retention policy of CheckpointManager.
+
+  Args:
+    checkpoints: checkpoint paths, oldest first
+    metrics: validation accuracy by checkpoint path, for those evaluated
+    permanent: checkpoints kept on the keep_every_n_hours basis
+    keep_last: number of most recent checkpoints kept, 0 keeps all
+    keep_best: number of checkpoints with the best metric kept
+  Returns:
+    keep: set of the checkpoint paths to keep
+  """
+  keep = set(p for p in checkpoints if p in permanent)
+  if keep_last > 0:
+    keep.update(checkpoints[-keep_last:])
+  else:
+    keep.update(checkpoints)
+  if keep_best > 0:
+    scored = [p for p in checkpoints if p in metrics]
+    scored.sort(key=lambda p: metrics[p], reverse=True)
+    keep.update(scored[:keep_best])
+  return keep
+
+
+def permanent_checkpoints(times, keep_every_n_hours, start_time):
+  """Checkpoints kept on the keep_every_n_hours basis.
+
+  A checkpoint is permanent if it was written at least keep_every_n_hours
+  after the previous permanent one, or after start_time for the first.
+
+  Args:
+    times: write time of each checkpoint in seconds, oldest first
+    keep_every_n_hours: interval in hours, 0 to disable
+    start_time: time the interval of the first checkpoint is counted from
+  Returns:
+    permanent: indices of the permanent checkpoints in times
+    last_time: time the interval of the next checkpoint is counted from
+  """
+  permanent = []
+  last_time = start_time
+  if keep_every_n_hours > 0:
+    for i, t in enumerate(times):
+      if t - last_time >= keep_every_n_hours * 3600:
+        permanent.append(i)
+        last_time = t
+  return permanent, last_time
+
+
+class CheckpointManager(object):
+  """Save checkpoints with a retention policy, optionally in the background.
+
+  A checkpoint is kept if it is one of the keep_last most recent, one of the
+  keep_best with the highest validation accuracy (see record_metric), or if
+  at least keep_every_n_hours have passed since the previous checkpoint kept
+  on that basis. All other checkpoints are deleted once a newer one has been
+  written.
+
+  With async_save, save() copies the variables into local snapshot variables,
+  which is a single in-memory assign, and the snapshot is written to disk by a
+  background thread while training continues. Only one write is in flight at
+  a time, so the next save() waits for the previous one. The input iterator
+  state is read by the writer thread rather than snapshotted, so a resumed run
+  may skip the few batches trained while the checkpoint was being written.
+
+  The checkpoints listed in the checkpoint state file of resume_dir, the
+  checkpoint directory of the run being resumed, are adopted in the
+  constructor, so that the policy also applies to them and the state file of
+  checkpoint_dir lists them along with the new ones. Their file times stand
+  in for their write times on the keep_every_n_hours basis; their validation
+  accuracy is not known.
+
+  Only the first checkpoint written has a .meta file, as the graph does not
+  change during training.
+
+  The graph ops are built in the constructor, so it has to be called while
+  the training graph is the default graph, before the graph is finalized.
+
+  Args:
+    checkpoint_dir: directory the checkpoints are written to
+    var_list: variables to save, e.g. tf.global_variables()
+    saveables: other saveable objects, e.g. the input iterator state
+    keep_last: number of most recent checkpoints kept, 0 keeps all
+    keep_best: number of checkpoints with the best metric kept
+    keep_every_n_hours: additionally keep one checkpoint every n hours, 0 to
+      disable
+    async_save: write checkpoints from a background thread
+    resume_dir: checkpoint directory of the run being resumed, or None
+  """
+
+  def __init__(self, checkpoint_dir, var_list, saveables=None, keep_last=5,
+               keep_best=1, keep_every_n_hours=0, async_save=True,
+               resume_dir=None):
+    self.checkpoint_dir = checkpoint_dir
+    self.keep_last = keep_last
+    self.keep_best = keep_best
+    self.keep_every_n_hours = keep_every_n_hours
+    self.async_save = async_save
+    saveables = saveables or []
+
+    if async_save:
+      with tf.name_scope('checkpoint_snapshot'):
+        names_to_saveables = {}
+        snapshot_updates = []
+        for v in var_list:
+          with tf.colocate_with(v):
+            snapshot = tf.Variable(
+                tf.zeros(v.get_shape(), dtype=v.dtype.base_dtype),
+                trainable=False,
+                collections=[tf.GraphKeys.LOCAL_VARIABLES],
+                name=v.op.name.replace('/', '_'))
+            snapshot_updates.append(tf.assign(snapshot, v.read_value()))
+          # Save the snapshot under the name of the original variable, so
+          # that the checkpoint is restored as usual
+          names_to_saveables[v.op.name] = snapshot
+        for s in saveables:
+          names_to_saveables[s.name] = s
+        self._snapshot_op = tf.group(*snapshot_updates, name='snapshot')
+      self._saver = tf.train.Saver(names_to_saveables, max_to_keep=None)
+    else:
+      self._saver = tf.train.Saver(list(var_list) + list(saveables),
+                                   max_to_keep=None)
+
+    self._checkpoints = self._existing_checkpoints(resume_dir)
+    self._metrics = {}
+    times = [os.path.getmtime(p + '.index') for p in self._checkpoints]
+    permanent, self._last_permanent_time = permanent_checkpoints(
+        times, keep_every_n_hours, min(times) if times else time.time())
+    self._permanent = set(self._checkpoints[i] for i in permanent)
+    self._lock = threading.Lock()
+    self._thread = None
+    self._meta_graph_written = False
+    if self._checkpoints:
+      logger.info('Adopted {} existing checkpoints in {}'.format(
+          len(self._checkpoints), resume_dir))
+
+  def _existing_checkpoints(self, resume_dir):
+    """Checkpoints of the state file of resume_dir still on disk."""
+    if not resume_dir:
+      return []
+    state = tf.train.get_checkpoint_state(resume_dir)
+    if state is None:
+      return []
+    return [p for p in state.all_model_checkpoint_paths
+            if tf.gfile.Exists(p + '.index')]
+
+  def save(self, session, save_path, global_step):
+    """Save a checkpoint.
+
+    Args:
+      session: session with the variables to save
+      save_path: prefix of the checkpoint files, the step is appended
+      global_step: step appended to the checkpoint name
+    Returns:
+      ckpt_path: path of the checkpoint
+      blocked: seconds the calling thread was blocked
+    """
+    tic = time.time()
+    self.wait()
+    ckpt_path = '{}-{:d}'.format(save_path, global_step)
+    if self.async_save:
+      session.run(self._snapshot_op)
+      self._thread = threading.Thread(target=self._write,
+                                      args=(session, save_path, global_step),
+                                      name='checkpoint_writer')
+      self._thread.daemon = True
+      self._thread.start()
+    else:
+      self._write(session, save_path, global_step)
+    blocked = time.time() - tic
+    logger.info('Checkpoint {} blocked training for {:.3f}s'
+                .format(os.path.basename(ckpt_path), blocked))
+    return ckpt_path, blocked
+
+  def wait(self):
+    """Block until the checkpoint being written, if any, is on disk."""
+    if self._thread is not None:
+      self._thread.join()
+      self._thread = None
+
+  def latest_checkpoint(self):
+    """Path of the most recent checkpoint written to disk."""
+    self.wait()
+    return self._checkpoints[-1] if self._checkpoints else None
+
+  def record_metric(self, ckpt_path, value):
+    """Record the validation accuracy of a checkpoint, higher is better."""
+    with self._lock:
+      self._metrics[ckpt_path] = value
+      self._apply_retention()
+
+  def _write(self, session, save_path, global_step):
+    tic = time.time()
+    write_meta_graph = not self._meta_graph_written
+    try:
+      ckpt_path = self._saver.save(session, save_path,
+                                   global_step=global_step,
+                                   write_meta_graph=write_meta_graph,
+                                   write_state=False)
+    except Exception as e:
+      logger.error('Failed to write checkpoint: {}'.format(e))
+      return
+    self._meta_graph_written = True
+    with self._lock:
+      self._checkpoints.append(ckpt_path)
+      if (self.keep_every_n_hours > 0 and
+          time.time() - self._last_permanent_time
+          >= self.keep_every_n_hours * 3600):
+        self._permanent.add(ckpt_path)
+        self._last_permanent_time = time.time()
+      self._apply_retention()
+    logger.info('Checkpoint {} written in {:.1f}s'
+                .format(os.path.basename(ckpt_path), time.time() - tic))
+
+  def _apply_retention(self):
+    """Delete checkpoints not covered by the policy, call with the lock."""
+    keep = retained_checkpoints(self._checkpoints, self._metrics,
+                                self._permanent, self.keep_last,
+                                self.keep_best)
+
+    for path in self._checkpoints:
+      if path not in keep:
+        for f in tf.gfile.Glob(path + '.*'):
+          tf.gfile.Remove(f)
+        self._metrics.pop(path, None)
+    self._checkpoints = [p for p in self._checkpoints if p in keep]
+
+    if self._checkpoints:
+      tf.train.update_checkpoint_state(
+          self.checkpoint_dir,
+          self._checkpoints[-1],
+          all_model_checkpoint_paths=self._checkpoints)
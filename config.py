@@ -9,6 +9,7 @@ from datetime import datetime   # date stamp the log directory
 import json  # for saving and loading hyperparameters
 import os, sys, re
 import time
+import contextlib
 
 import daiquiri
 import logging
@@ -27,9 +28,39 @@ flags.DEFINE_string('f', '', 'kernel')
 # set to 64 according to authors (https://openreview.net/forum?id=HJWLfGWRb)
 flags.DEFINE_integer('batch_size', 64, 'batch size in total across all gpus') 
 flags.DEFINE_integer('epoch', 100, 'epoch')
+flags.DEFINE_string('train_budget', '', '''length of the run as a number and
+                    a unit: steps, examples, epochs, min or h, e.g. 2e6examples
+                    or 12h; defaults to the number of epochs in epoch''')
 flags.DEFINE_integer('iter_routing', 2, 'number of iterations')
 flags.DEFINE_float('epsilon', 1e-9, 'epsilon')
-flags.DEFINE_float('lrn_rate', 3e-3, 'learning rate to use in Adam optimiser')
+flags.DEFINE_float('lrn_rate', 3e-3, '''learning rate to use in the optimiser,
+                   tuned for a batch of lr_reference_batch_size''')
+flags.DEFINE_string('optimizer', 'adam', '''adam, lars (momentum SGD) or lamb
+                    (Adam), where lars and lamb scale the update of each
+                    layer by the ratio of its weight norm to its update norm,
+                    for stable training with large batches''')
+flags.DEFINE_float('momentum', 0.9, 'momentum of the lars optimiser')
+flags.DEFINE_float('trust_coefficient', 0.001, '''scale of the layer-wise
+                   trust ratio of the lars optimiser''')
+flags.DEFINE_string('lr_schedule', 'exponential', '''exponential (decay by
+                    0.96 every 20000 updates), cosine (decay to zero over the
+                    whole run), or constant''')
+flags.DEFINE_integer('lr_warmup_steps', 0, '''number of optimiser updates over
+                     which the learning rate is ramped up linearly from zero''')
+flags.DEFINE_string('lr_batch_scaling', 'none', '''none, linear or sqrt: scale
+                    lrn_rate by the ratio, or its square root, of the
+                    effective batch size (batch_size * accumulate_steps) to
+                    lr_reference_batch_size''')
+flags.DEFINE_integer('lr_reference_batch_size', 64, '''batch size lrn_rate
+                     was tuned for''')
+flags.DEFINE_integer('accumulate_steps', 1, '''number of micro-batches of
+                     batch_size over which gradients are accumulated before
+                     each optimiser update; global_step and learning rate
+                     decay count optimiser updates''')
+flags.DEFINE_float('ema_decay', 0.999, '''decay of the exponential moving
+                   average of the trainable weights, which is used for
+                   evaluation and testing instead of the weights; 0 to
+                   disable''')
 flags.DEFINE_boolean('weight_reg', True,
                      'train with regularization of weights')
 flags.DEFINE_float('nn_weight_reg_lambda', 2e-7, '''lagrange multiplier for
@@ -108,8 +139,26 @@ flags.DEFINE_string('patch_path', None, '''filepath of the patch to be loaded'''
 # ENVIRONMENT SETTINGS
 #------------------------------------------------------------------------------
 flags.DEFINE_integer('num_gpus', 1, 'number of GPUs')
-flags.DEFINE_integer('num_threads', 8, 
-                     'number of parallel calls in the input pipeline')
+flags.DEFINE_integer('num_threads', 0,
+                     '''number of parallel calls in the input pipeline, 0 to
+                     let tf.data tune it at run time''')
+flags.DEFINE_integer('input_threadpool_size', 0, '''number of threads of
+                     the private thread pool of each input pipeline, 0 to
+                     share the inter-op thread pool of the session''')
+flags.DEFINE_boolean('input_benchmark', False, '''run the training input
+                     pipeline of train_val.py alone for benchmark_steps
+                     batches and report images/sec, instead of training''')
+flags.DEFINE_boolean('input_warmup', False, '''read a little over one epoch
+                     of each input pipeline of train_val.py, which writes
+                     the files of a directory input_cache, and exit instead
+                     of training; used by sweep.py before starting runs that
+                     share the cache''')
+flags.DEFINE_boolean('xla', False, '''JIT-compile the model towers and
+                     their gradients with XLA, fusing the many small
+                     element-wise ops of EM routing''')
+flags.DEFINE_integer('benchmark_steps', 50, '''number of timed steps per
+                     configuration in benchmark_xla.py, and of timed batches
+                     with input_benchmark''')
 flags.DEFINE_string('mode', 'train', 'train, validate, or test')
 flags.DEFINE_string('name', '', 'name of experiment in log directory')
 flags.DEFINE_boolean('reset', False, 'clear the train or test log directory')
@@ -117,8 +166,105 @@ flags.DEFINE_string('debugger', None,
                     '''set to host of TensorBoard debugger e.g. "dccxc180:8886 
                     or dccxl015:8770"''')
 flags.DEFINE_boolean('profile', False, 
-                     '''get runtime statistics to display inTensorboard e.g. 
-                     compute time''')
+                     '''trace a window of training steps, and write Chrome
+                     traces, per-op and per-layer compute time tables, and
+                     runtime statistics for Tensorboard''')
+flags.DEFINE_integer('profile_start_step', 100, '''number of steps after the
+                     start (or resume) of training at which tracing starts,
+                     leaving time for the input pipeline to warm up''')
+flags.DEFINE_integer('profile_steps', 10, '''number of steps to trace before
+                     profiling turns itself off''')
+flags.DEFINE_string('summary_every', '100steps', '''how often training
+                    summaries are written, in steps, examples, epochs, min or
+                    h, e.g. 100steps, 1e5examples or 5min''')
+flags.DEFINE_string('save_every', '1epochs', '''how often checkpoints are
+                    saved, in the same units as summary_every''')
+flags.DEFINE_string('eval_every', '1epochs', '''how often the training and
+                    validation sets are evaluated, in the same units as
+                    summary_every''')
+flags.DEFINE_string('stop_metric', 'acc', '''acc or loss on the validation
+                    set (or the whole training set if there is none) used for
+                    early stopping and pruning''')
+flags.DEFINE_integer('early_stopping_patience', 0, '''stop after this many
+                     evaluations without improvement of stop_metric, 0 to
+                     disable''')
+flags.DEFINE_float('early_stopping_min_delta', 0, '''smallest change of
+                   stop_metric that counts as an improvement''')
+flags.DEFINE_string('prune_db', '', '''SQLite file shared by the runs of a
+                    sweep, runs whose best stop_metric is worse than the
+                    median of the other runs at the same step are stopped;
+                    empty to disable''')
+flags.DEFINE_string('prune_study', '', '''name of the group of runs compared
+                    by the pruning rule, defaults to logdir''')
+flags.DEFINE_integer('prune_warmup_evaluations', 2, '''number of evaluations
+                     before a run can be pruned''')
+flags.DEFINE_integer('prune_min_runs', 3, '''number of other runs that must
+                     have reached a step before the rule is applied''')
+flags.DEFINE_string('input_backend', 'tfrecord', '''tfrecord to read
+                    smallNORB tfrecords and tfds datasets, or npy to read
+                    smallNORB, mnist, cifar10 and svhn from .npy files
+                    materialised once in npy_dir and memory-mapped, and
+                    imagenet56 from the arrays packed into npy_dir by
+                    data/convert_imagenet.py''')
+flags.DEFINE_string('input_cache', 'memory', '''where the deterministic
+                    preprocessing (decoding, normalisation, resizing) of the
+                    input pipelines is cached after the first epoch: memory,
+                    a directory for file-backed caches, or none; imagenet56
+                    is only cached in a directory''')
+flags.DEFINE_boolean('batch_augment', True, '''apply the random crop,
+                     brightness and contrast of smallNORB and imagenet56
+                     training to whole batches after batching, instead of to
+                     each image, see data_pipelines/augment.py''')
+flags.DEFINE_boolean('device_augment', False, '''deliver raw uint8
+                     batches from the input pipelines, and normalise and
+                     augment them in the model graph on the tower device, to
+                     offload the host CPU; on CPU-only machines the ops run on
+                     the CPU''')
+flags.DEFINE_integer('num_workers', 1, '''number of training processes
+                     sharing the training set, each reading a disjoint shard
+                     of every epoch''')
+flags.DEFINE_integer('worker_index', 0, '''index of this training process,
+                     from 0 to num_workers - 1''')
+flags.DEFINE_integer('input_seed', 1234, '''seed of the shuffle of the
+                     training examples, the same on every worker''')
+flags.DEFINE_integer('first_classes', 0, '''train and evaluate on the
+                     examples of the first K classes only, with a K-class
+                     model; 0 for all classes; requires the npy input
+                     backend''')
+flags.DEFINE_string('classes', '', '''train and evaluate on the examples of
+                    these classes only, a comma-separated list of class ids
+                    and ranges such as 0-99,250, remapped to the labels 0 to
+                    K - 1 of a K-class model in the order listed; empty for
+                    all classes; requires the npy input backend''')
+flags.DEFINE_boolean('balanced_sampling', False, '''draw training examples
+                     by picking a class uniformly, then one of its examples,
+                     so every class is equally frequent in the batches;
+                     requires the npy input backend''')
+flags.DEFINE_string('curriculum_file', '', '''.npy file of one loss per
+                    example of the training split, e.g. of a trained model,
+                    to train the first curriculum_epochs epochs on a growing
+                    share of the examples from the lowest loss; empty to
+                    disable; requires the npy input backend''')
+flags.DEFINE_integer('curriculum_epochs', 5, '''number of epochs over which
+                     the curriculum grows to the whole training split''')
+flags.DEFINE_float('curriculum_start', 0.25, '''share of the training
+                   examples in the first epoch of the curriculum''')
+flags.DEFINE_boolean('save_input_state', True,
+                     '''save the position of the training input pipeline,
+                     including its shuffle buffer, with checkpoints, so that
+                     resumed runs continue mid-epoch; not with the memory
+                     input_cache, whose contents would be saved too, nor
+                     with the npy input backend; these skip the batches of
+                     the steps already trained instead''')
+flags.DEFINE_integer('keep_checkpoints', 5, '''number of most recent
+                     checkpoints to keep, 0 to keep all''')
+flags.DEFINE_integer('keep_best_checkpoints', 1, '''number of checkpoints
+                     with the best validation accuracy to keep''')
+flags.DEFINE_float('keep_checkpoint_every_n_hours', 0, '''additionally keep
+                     one checkpoint every n hours, 0 to disable''')
+flags.DEFINE_boolean('async_checkpoint', True, '''write checkpoints from a
+                     snapshot in a background thread, instead of blocking
+                     training''')
 flags.DEFINE_string('load_dir', None, 
                     '''directory containing train or test checkpoints to 
                     continue from''')
@@ -133,6 +279,13 @@ flags.DEFINE_string('storage', LOCAL_STORAGE,
                     'directory where logs and data are stored')
 flags.DEFINE_string('db_name', 'capsules_ex1', 
                     'Name of the DB for mongo for sacred')
+flags.DEFINE_string('npy_dir', os.path.join(LOCAL_STORAGE, 'data', 'npy'),
+                    '''directory of the .npy files of the npy input backend''')
+flags.DEFINE_string('graph_cache_dir',
+                    os.path.join(LOCAL_STORAGE, 'logs', 'graph_cache'),
+                    '''directory where test.py and inspect_results.py cache
+                    the built model graph as a MetaGraph, keyed by the hash
+                    of the hyperparameters; empty to always build the graph''')
 
 # Parse flags
 FLAGS = flags.FLAGS
@@ -233,6 +386,38 @@ def load_or_save_hyperparams(train_dir=None):
     logger.info("Parameters saved to file: {}".format(params_file_path))
 
 
+#------------------------------------------------------------------------------
+# SESSION AND COMPILATION
+#------------------------------------------------------------------------------
+def get_session_config():
+  """Session config shared by the training, testing and inspection scripts.
+
+  With FLAGS.xla, auto-clustering is turned on as well, so that ops outside
+  the towers (e.g. the gradient averaging) are also compiled on GPUs.
+  """
+  # Perry: added in for RTX 2070 incompatibility workaround
+  config = tf.ConfigProto(allow_soft_placement=True, log_device_placement=False)
+  config.gpu_options.allow_growth = True
+  if FLAGS.xla:
+    config.graph_options.optimizer_options.global_jit_level = (
+        tf.OptimizerOptions.ON_1)
+  return config
+
+
+def tower_jit_scope():
+  """Scope in which the ops of a model tower are built.
+
+  With FLAGS.xla, all ops of the tower, and their gradients, are marked for
+  XLA compilation on any device, including the CPU, where auto-clustering is
+  off by default. The capsule layers have static shapes, so each tower is
+  compiled once. Otherwise, this is an empty scope.
+  """
+  if FLAGS.xla:
+    return tf.contrib.compiler.jit.experimental_jit_scope(
+        compile_ops=True, separate_compiled_gradients=True)
+  return contextlib.ExitStack()
+
+
 #------------------------------------------------------------------------------
 # FACTORIES FOR DATASET
 #------------------------------------------------------------------------------
@@ -249,6 +434,9 @@ def get_dataset_path(dataset_name: str):
 
 
 def get_dataset_size_train(dataset_name: str):
+  if data_npy.class_subset() is not None:
+    return data_npy.num_examples(dataset_name,
+                                 get_dataset_path(dataset_name), "train")
   options = {'mnist': 55000, 
              'smallNORB': 23400 * 2,
              'fashion_mnist': 55000, 
@@ -263,6 +451,9 @@ def get_dataset_size_test(dataset_name: str):
   if dataset_name is 'imagenet56':
     logger.info("%s pipeline is not set up for testing, using validation set for testing instead"%dataset_name)
     return get_dataset_size_validate(dataset_name)
+  if data_npy.class_subset() is not None:
+    return data_npy.num_examples(dataset_name,
+                                 get_dataset_path(dataset_name), "test")
   options = {'mnist': 10000, 
              'smallNORB': 23400 * 2,
              'fashion_mnist': 10000, 
@@ -276,6 +467,9 @@ def get_dataset_size_validate(dataset_name: str):
   if dataset_name == 'smallNORB' or dataset_name == 'mnist' or dataset_name == 'cifar10' or dataset_name == 'svhn':
     logger.info("%s pipeline is not set up for validation, using test set for validation instead"%dataset_name)
     return get_dataset_size_test(dataset_name)
+  if data_npy.class_subset() is not None:
+    return data_npy.num_examples(dataset_name,
+                                 get_dataset_path(dataset_name), "validation")
   options = {'imagenet56': 50000}
   return options[dataset_name]
 
@@ -288,6 +482,9 @@ def get_num_classes(dataset_name: str):
              'cifar100': 100,
              'svhn': 10,
              'imagenet56': 1000}
+  classes = data_npy.class_subset()
+  if classes is not None:
+    return len(classes)
   return options[dataset_name]
 
 
@@ -296,7 +493,11 @@ from data_pipelines import mnist as data_mnist
 from data_pipelines import cifar10 as data_cifar10
 from data_pipelines import svhn as data_svhn
 from data_pipelines import imagenet56 as data_imagenet56
-def get_create_inputs(dataset_name: str, mode="train"):
+from data_pipelines import npy as data_npy
+from data_pipelines import common as data_common
+def get_input_fn(dataset_name: str, mode="train", start_step=0):
+  # start_step: step a resumed training run continues from, for training
+  # pipelines whose position is not saved with the iterator state
   
   force_set = None
   if mode == "train":
@@ -310,20 +511,64 @@ def get_create_inputs(dataset_name: str, mode="train"):
     force_set = "test"
    
   path = get_dataset_path(dataset_name)
+
+  if FLAGS.input_backend != 'npy' and (data_npy.class_subset() is not None
+                                       or FLAGS.balanced_sampling
+                                       or FLAGS.curriculum_file):
+    raise ValueError('first_classes, classes, balanced_sampling and '
+                     'curriculum_file require --input_backend=npy')
+  if FLAGS.input_backend == 'npy':
+    return lambda: data_npy.input_fn(dataset_name, path, is_train, force_set,
+                                     start_step)
   
+  if mode == "train" and not input_state_saveable() and start_step > 0:
+    logger.info('Input pipeline state is not saved with checkpoints, '
+                'skipping the first {} batches of the training pipeline'
+                .format(start_step))
+    input_fn = get_input_fn(dataset_name, mode)
+    return lambda: data_common.fast_forward(input_fn(), start_step)
+
   options = {'smallNORB':
-                 lambda: data_norb.create_inputs_norb(path, is_train, force_set),
+                 lambda: data_norb.input_fn(path, is_train, force_set),
              'mnist':
-                 lambda: data_mnist.create_inputs(is_train, force_set),
+                 lambda: data_mnist.input_fn(is_train, force_set),
              'cifar10':
-                 lambda: data_cifar10.create_inputs(is_train, force_set),
+                 lambda: data_cifar10.input_fn(is_train, force_set),
              'svhn':
-                 lambda: data_svhn.create_inputs(is_train, force_set),
+                 lambda: data_svhn.input_fn(is_train, force_set),
              'imagenet56':
-                 lambda: data_imagenet56.create_inputs(is_train, force_set)}
+                 lambda: data_imagenet56.input_fn(is_train, force_set)}
   return options[dataset_name]
 
 
+def get_device_preprocess(dataset_name: str):
+  # Preprocessing of uint8 batches on the tower device with device_augment
+  options = {'smallNORB': data_norb.device_preprocess,
+             'mnist': data_mnist.device_preprocess,
+             'cifar10': data_cifar10.device_preprocess,
+             'svhn': data_svhn.device_preprocess,
+             'imagenet56': data_imagenet56.device_preprocess}
+  return options[dataset_name]
+
+
+def input_state_saveable():
+  # The npy backend reads batches with tf.py_func, which iterator checkpoints
+  # cannot serialise. The state of an iterator over an in-memory cache
+  # includes the cached dataset, which would be written to every checkpoint.
+  # Resumed runs then skip the batches of the steps already trained instead,
+  # see get_input_fn
+  return (FLAGS.save_input_state and FLAGS.input_backend != 'npy'
+          and FLAGS.input_cache != 'memory')
+
+
+def get_create_inputs(dataset_name: str, mode="train"):
+  # Only the training pipeline is saved with checkpoints, see
+  # data_pipelines/common.py
+  saveable = mode == "train" and input_state_saveable()
+  input_fn = get_input_fn(dataset_name, mode)
+  return lambda: data_common.get_next(input_fn(), saveable)
+
+
 import models as mod
 def get_dataset_architecture(dataset_name: str):
   # options = {'smallNORB': mod.build_arch_smallnorb,
@@ -0,0 +1,142 @@
+import numpy as np
+
+import argparse
+import logging
+import daiquiri
+import multiprocessing
+from time import time
+import os
+
+from PIL import Image
+
+daiquiri.setup(level=logging.DEBUG)
+logger = daiquiri.getLogger(__name__)
+
+IMAGE_EXTENSIONS = ('.jpeg', '.jpg', '.png')
+
+# Split names of the source folders and of the packed arrays, which are those
+# of data_pipelines/imagenet56.py
+SPLITS = {'train': 'train', 'val': 'validation'}
+
+
+def list_images(split_dir, wnids):
+    """Paths and labels of the images of a split, in class order.
+
+    Args:
+        split_dir: folder with one subfolder of images per class
+        wnids: sorted class folder names, the label of a class is its index
+    Returns:
+        paths: list of image paths
+        labels: int64 array of labels
+    """
+    paths, labels = [], []
+    for label, wnid in enumerate(wnids):
+        class_dir = os.path.join(split_dir, wnid)
+        if not os.path.isdir(class_dir):
+            continue
+        names = sorted(f for f in os.listdir(class_dir)
+                       if f.lower().endswith(IMAGE_EXTENSIONS))
+        paths.extend(os.path.join(class_dir, f) for f in names)
+        labels.extend([label] * len(names))
+    return paths, np.array(labels, dtype=np.int64)
+
+
+def _pack_block(args):
+    """Decode, resize and write one block of images into the packed array."""
+    image_path, start, paths, size = args
+    images = np.load(image_path, mmap_mode='r+')
+    for i, path in enumerate(paths):
+        with Image.open(path) as img:
+            # Box resize to a square, ignoring the aspect ratio, as in the
+            # imagenet_resized dataset of tfds
+            img = img.convert('RGB').resize((size, size), Image.BOX)
+            images[start + i] = np.asarray(img, dtype=np.uint8)
+    images.flush()
+    return len(paths)
+
+
+def convert_split(src_split_dir, out_split_dir, wnids, size=64,
+                  num_workers=None, block_size=500):
+    """Pack a split of raw ImageNet images into memory-mapped uint8 arrays.
+
+    The images are decoded and resized once, by a pool of processes that
+    each write their block of images straight into image.npy, so memory use
+    is bounded by num_workers * block_size images. Examples are stored in
+    class order, so the first K classes are a prefix of the arrays; the
+    training sampler shuffles them, see data_pipelines/sampler.py. The label
+    file is written last, and marks the split as complete, see
+    data_pipelines/npy.materialize.
+
+    Args:
+        src_split_dir: folder with one subfolder of images per class
+        out_split_dir: folder of image.npy and label.npy
+        wnids: sorted class folder names
+        size: height and width of the packed images
+        num_workers: number of processes, defaults to the number of CPUs
+        block_size: number of images decoded by a process at a time
+    """
+    start = time()
+    paths, labels = list_images(src_split_dir, wnids)
+    if not paths:
+        raise ValueError('No images in the class folders of ' + src_split_dir)
+    logger.info('{} images of {} classes in {}'.format(
+        len(paths), len(np.unique(labels)), src_split_dir))
+
+    if not os.path.exists(out_split_dir):
+        os.makedirs(out_split_dir)
+    for name in ['label.npy', 'index.npy']:
+        if os.path.exists(os.path.join(out_split_dir, name)):
+            os.remove(os.path.join(out_split_dir, name))
+    image_tmp_path = os.path.join(out_split_dir, 'image.tmp.npy')
+    images = np.lib.format.open_memmap(
+        image_tmp_path, mode='w+', dtype=np.uint8,
+        shape=(len(paths), size, size, 3))
+    del images
+
+    blocks = [(image_tmp_path, i, paths[i:i + block_size], size)
+              for i in range(0, len(paths), block_size)]
+    pool = multiprocessing.Pool(num_workers or multiprocessing.cpu_count())
+    try:
+        done = 0
+        for count in pool.imap_unordered(_pack_block, blocks):
+            done += count
+            if done % (20 * block_size) < count:
+                logger.info('{}/{} images'.format(done, len(paths)))
+    finally:
+        pool.close()
+        pool.join()
+
+    os.rename(image_tmp_path, os.path.join(out_split_dir, 'image.npy'))
+    label_tmp_path = os.path.join(out_split_dir, 'label.tmp.npy')
+    np.save(label_tmp_path, labels)
+    os.rename(label_tmp_path, os.path.join(out_split_dir, 'label.npy'))
+    logger.info('Wrote {} in {:.0f} s, {:.1f} MB'.format(
+        out_split_dir, time() - start,
+        os.path.getsize(os.path.join(out_split_dir, 'image.npy')) / 2.**20))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='''Pack raw ImageNet image folders into the uint8 arrays
+        read by the npy input backend for imagenet56. The source has train
+        and val folders with one subfolder of images per class (wnid).''')
+    parser.add_argument('--src', required=True,
+                        help='folder with train/<wnid>/ and val/<wnid>/')
+    parser.add_argument('--out_dir', default='./data/npy/imagenet56',
+                        help='the imagenet56 folder of npy_dir')
+    parser.add_argument('--size', type=int, default=64)
+    parser.add_argument('--num_workers', type=int, default=None)
+    parser.add_argument('--block_size', type=int, default=500)
+    args = parser.parse_args()
+
+    # The label of a class is the index of its wnid in sorted order, as in
+    # tfds, so the labels match those of the tfds pipeline
+    wnids = sorted(d for d in os.listdir(os.path.join(args.src, 'train'))
+                   if os.path.isdir(os.path.join(args.src, 'train', d)))
+    for src_split, split in SPLITS.items():
+        convert_split(os.path.join(args.src, src_split),
+                      os.path.join(args.out_dir, split),
+                      wnids,
+                      size=args.size,
+                      num_workers=args.num_workers,
+                      block_size=args.block_size)
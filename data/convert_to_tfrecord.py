@@ -1,23 +1,147 @@
 import tensorflow as tf
 import numpy as np
 
+import argparse
+import glob
 import logging
 import daiquiri
+import multiprocessing
 from time import time
 import os
 
 from numpy.random import RandomState
-prng = RandomState(1234567890)
 
 daiquiri.setup(level=logging.DEBUG)
 logger = daiquiri.getLogger(__name__)
 
+# Version 1 records store the 96x96 images as float64 raw bytes. Version 2
+# records store uint8 pixels, by default already downsampled to 48x48, and
+# the format_version, height and width fields, see norb._parser
+FORMAT_VERSION = 2
 
-def convert_to_tfrecord(kind: str, chunkify=False):
+# Seed of the permutation of the examples, unchanged so that the records are
+# in the same order as those of earlier versions of the converter
+SEED = 1234567890
+
+# Element type of the smallNORB .mat files by magic number, see
+# https://cs.nyu.edu/~ylclab/data/norb-v1.0-small/
+MAT_DTYPES = {0x1E3D4C51: np.float32,
+              0x1E3D4C53: np.float64,
+              0x1E3D4C54: np.int32,
+              0x1E3D4C55: np.uint8,
+              0x1E3D4C56: np.int16}
+
+MAT_FILES = {'train': 'smallnorb-5x46789x9x18x6x2x96x96-training-{}.mat',
+             'test': 'smallnorb-5x01235x9x18x6x2x96x96-testing-{}.mat'}
+
+
+def read_mat(path):
+    """Memory-map a smallNORB .mat file.
+
+    The header is the magic number of the element type, the number of
+    dimensions, and the size of each dimension, with at least 3 sizes stored
+    even for 1 or 2 dimensional matrices. All fields are little-endian int32.
+
+    Args:
+        path: .mat file
+    Returns:
+        matrix: read-only np.memmap with the shape given in the header
+    """
+    header = np.fromfile(path, dtype='<i4', count=2)
+    magic, ndim = int(header[0]) & 0xFFFFFFFF, int(header[1])
+    if magic not in MAT_DTYPES:
+        raise ValueError('Unknown magic number {:#x} in {}'.format(magic, path))
+    shape = np.fromfile(path, dtype='<i4', count=2 + max(3, ndim))[2:2 + ndim]
+    offset = 4 * (2 + max(3, ndim))
+    return np.memmap(path, dtype=np.dtype(MAT_DTYPES[magic]).newbyteorder('<'),
+                     mode='r', offset=offset, shape=tuple(int(d) for d in shape))
+
+
+def resize_images(images, size):
+    """Downsample images with the same bilinear resize as the input pipeline.
+
+    Vectorised NumPy version of tf.image.resize_images with the TensorFlow 1
+    defaults (bilinear, align_corners=False, no half-pixel centres), in which
+    output pixel i samples input position i * in_size / size. For 96 to 48
+    every output pixel falls on an input pixel, so the result is exact.
+
+    Args:
+        images: uint8 array (num_images, height, width)
+        size: height and width of the resized images
+    Returns:
+        resized: uint8 array (num_images, size, size)
+    """
+    def _coords(in_size):
+        pos = np.arange(size) * (in_size / float(size))
+        lo = np.floor(pos).astype(np.int64)
+        hi = np.minimum(lo + 1, in_size - 1)
+        return lo, hi, (pos - lo).astype(np.float32)
+
+    y0, y1, wy = _coords(images.shape[1])
+    x0, x1, wx = _coords(images.shape[2])
+    images = images.astype(np.float32)
+    top = images[:, y0][:, :, x0] * (1 - wx) + images[:, y0][:, :, x1] * wx
+    bottom = images[:, y1][:, :, x0] * (1 - wx) + images[:, y1][:, :, x1] * wx
+    resized = top * (1 - wy)[:, None] + bottom * wy[:, None]
+    return np.clip(np.round(resized), 0, 255).astype(np.uint8)
+
+
+def _int64_feature(value):
+    return tf.train.Feature(int64_list=tf.train.Int64List(value=[int(value)]))
+
+
+def _write_shard(args):
+    """Write one shard of records, reading block_size images at a time."""
+    dir_mat, kind, indices, tfrecord_path, image_size, block_size = args
+    images = read_mat(os.path.join(dir_mat, MAT_FILES[kind].format('dat')))
+    labels = read_mat(os.path.join(dir_mat, MAT_FILES[kind].format('cat')))
+    info = read_mat(os.path.join(dir_mat, MAT_FILES[kind].format('info')))
+    # Stereo pairs (num_pairs, 2, 96, 96) as single images (num_pairs * 2,
+    # 96, 96), where image i has the label and info of pair i // 2
+    images = images.reshape((-1,) + images.shape[2:])
+    # Elevation as degrees from the horizontal, azimuth in degrees
+    elevation_degrees = np.array([30, 35, 40, 45, 50, 55, 60, 65, 70])
+
+    with tf.python_io.TFRecordWriter(tfrecord_path) as writer:
+        for start in range(0, len(indices), block_size):
+            idx = indices[start:start + block_size]
+            # Read the block in file order, then restore the shuffled order
+            order = np.argsort(idx)
+            block = np.empty((len(idx),) + images.shape[1:], dtype=np.uint8)
+            block[order] = images[idx[order]]
+            if image_size != block.shape[1]:
+                block = resize_images(block, image_size)
+            block_labels = np.asarray(labels[idx // 2]).reshape(-1)
+            block_info = np.asarray(info[idx // 2]).reshape(len(idx), -1)
+
+            for i in range(len(idx)):
+                example = tf.train.Example(features=tf.train.Features(feature={
+                    'format_version': _int64_feature(FORMAT_VERSION),
+                    'height': _int64_feature(image_size),
+                    'width': _int64_feature(image_size),
+                    'img_raw': tf.train.Feature(bytes_list=tf.train.BytesList(
+                        value=[block[i].tobytes()])),
+                    'label': _int64_feature(block_labels[i]),
+                    'category': _int64_feature(block_info[i, 0]),
+                    'elevation': _int64_feature(
+                        elevation_degrees[block_info[i, 1]]),
+                    'azimuth': _int64_feature(block_info[i, 2] * 10),
+                    'lighting': _int64_feature(block_info[i, 3]),
+                }))
+                writer.write(example.SerializeToString())
+    return tfrecord_path
+
+
+def convert_to_tfrecord(kind: str, num_shards=10, image_size=48,
+                        num_workers=None, block_size=1000):
     """Generate TFRecord for train and test datasets from smallNORB .mat files.
-    
-    Combine the images, labels and additional info from .mat files into TFRecord. The chunk approach 
-    has not been fully tested tested.
+
+    Combine the images, labels and additional info from .mat files into
+    sharded TFRecords. The .mat files are memory-mapped, and each shard is
+    written by its own process, which reads the images in blocks, so memory
+    use is bounded by num_workers * block_size images regardless of the size
+    of the split. The images are stored as uint8, downsampled to image_size
+    (9 KB per 96x96 image, 2.3 KB at 48x48, instead of 73 KB as float64).
     The following .mat files are required (download.sh):
         1. smallnorb-5x46789x9x18x6x2x96x96-training-dat.mat
         2. smallnorb-5x46789x9x18x6x2x96x96-training-cat.mat
@@ -25,148 +149,81 @@ def convert_to_tfrecord(kind: str, chunkify=False):
         4. smallnorb-5x01235x9x18x6x2x96x96-testing-dat.mat
         5. smallnorb-5x01235x9x18x6x2x96x96-testing-cat.mat
         6. smallnorb-5x01235x9x18x6x2x96x96-testing-info.mat
-    
+
     Author:
         Ashley Gritzman 19/10/2018
     Credit:
         Modified from: https://github.com/shashanktyagi/DC-GAN-on-NORB-dataset/blob/master/src/model.py
         Original Author: Shashank Tyagi (GitHub ID: shashanktyagi)
-    Args: 
+    Args:
         kind : 'train' or 'test'
-        chunkify : kernel size
-        s : stride      
-    Returns:
-        A 2D numpy matrix containing mapping between children capsules along the rows, 
-        and parent capsules along the columns.
+        num_shards : number of tfrecord files
+        image_size : height and width of the stored images, 96 to keep the original size
+        num_workers : number of processes writing shards, defaults to the number of CPUs
+        block_size : number of images read and converted at once by each process
     """
-    
-    # Plan A: write dataset into one big tfrecord
-    # Plan B: write dataset into manageable chuncks
-    CHUNK = int(24300 * 2 / 10)  # create 10 chunks
-    TOTAL_NUM_IMAGES = int(24300 * 2)
-
     start = time()
-    
+
     # Set up directories
     data_store = os.path.join('./', 'data')
-    dir_mat = os.path.join(data_store,'smallNORB/mat')
-    dir_tfrecords = os.path.join(data_store,'smallNORB/tfrecord/')
-   
+    dir_mat = os.path.join(data_store, 'smallNORB/mat')
+    dir_tfrecords = os.path.join(data_store, 'smallNORB/tfrecord/')
+
     if not tf.gfile.Exists(dir_tfrecords):
         tf.gfile.MakeDirs(dir_tfrecords)
-    
-    #----- READ -----#
-    
-    if kind == "train":
-        fid_images = open(dir_mat + '/smallnorb-5x46789x9x18x6x2x96x96-training-dat.mat', 'rb')
-        fid_labels = open(dir_mat +'/smallnorb-5x46789x9x18x6x2x96x96-training-cat.mat', 'rb')
-        fid_info = open(dir_mat + '/smallnorb-5x46789x9x18x6x2x96x96-training-info.mat', 'rb')
-    elif kind == "test":
-        fid_images = open(dir_mat + '/smallnorb-5x01235x9x18x6x2x96x96-testing-dat.mat', 'rb')
-        fid_labels = open(dir_mat + '/smallnorb-5x01235x9x18x6x2x96x96-testing-cat.mat', 'rb')
-        fid_info = open(dir_mat + '/smallnorb-5x01235x9x18x6x2x96x96-testing-info.mat', 'rb')
-    else:
-        logger.warning('Please choose either training or testing data to preprocess.')
-
-    logger.info('Reading data finished:' + kind)
-
-    # Preprocessing to remove headers
-    # Images
-    for i in range(6):
-        a = fid_images.read(4)
-    # Labels
-    for i in range(5):
-        a = fid_labels.read(4)
-    # Info
-    for i in range(5):
-        a = fid_info.read(4)
-
-    for j in range(TOTAL_NUM_IMAGES // CHUNK if chunkify else 1):
-        
-        num_images = CHUNK if chunkify else TOTAL_NUM_IMAGES  # 24300 * 2
-        num_labels = int(num_images/2) # the images are in stereo pairs, so two images correspond to one label
-        
-        #----- LOAD -----#
-        
-        # Images
-        images = np.zeros((num_images, 96 * 96))
-        for idx in range(num_images):
-            if idx % 100 == 0:
-                logger.info('Load ' + kind + ' images %d' % ((j + 1) * idx))
-            temp = fid_images.read(96 * 96)
-            images[idx, :] = np.fromstring(temp, 'uint8')
-        
-        #----- PROCESS -----#
-        
-        # Labels
-        labels = np.fromstring(fid_labels.read(num_images * np.dtype('int32').itemsize), 'int32')
-        # The images are in stereo pairs, so two images correspond to one label
-        labels = np.repeat(labels, 2)   
-        
-        # Info
-        # 1. the instance in the category (0 to 9)
-        # 2. the elevation (0 to 8, which mean cameras are 30, 35,40,45,50,55,60,65,70 degrees from the horizontal respectively)
-        # 3. the azimuth (0,2,4,...,34, multiply by 10 to get the azimuth in degrees)
-        # 4. the lighting condition (0 to 5)
-        info = np.fromstring(fid_info.read(4 * num_labels * np.dtype('int32').itemsize), 'int32')
-        info = info.reshape(num_labels, 4)
-        # Elevation
-        elevation = np.array([30,35,40,45,50,55,60,65,70])
-        info[:,1] = elevation[info[:,1]]
-        # Azimuth
-        info[:,2] = info[:,2]*10
-        # The images are in stereo pairs, so two images correspond to one info vector
-        info = np.repeat(info, 2, axis=0) 
-           
-        logger.debug('Load data %d finish. Start filling chunk %d.' % (j, j))
-
-        # make dataset permuatation reproduceable
-        perm = prng.permutation(num_images)
-        images = images[perm]
-        labels = labels[perm]
-        info = info[perm]
-        
-        #----- WRITE -----#
-        
-        tfrecord_path = dir_tfrecords + kind + "%d.tfrecords" % j
-        writer = tf.python_io.TFRecordWriter(tfrecord_path)
-        for i in range(num_images):
-            if i % 100 == 0:
-                logger.info('Write ' + kind + ' images %d' % ((j + 1) * i))
-                
-            img = images[i, :].tobytes()
-            lab = labels[i].astype(np.int32)
-            category = info[i,0].astype(np.int32)
-            elevation = info[i,1].astype(np.int32)
-            azimuth = info[i,2].astype(np.int32)
-            lighting = info[i,3].astype(np.int32)
-            
-            example = tf.train.Example(features=tf.train.Features(feature={
-                'img_raw': tf.train.Feature(bytes_list=tf.train.BytesList(value=[img])),
-                "label": tf.train.Feature(int64_list=tf.train.Int64List(value=[lab])),
-                'category': tf.train.Feature(int64_list=tf.train.Int64List(value=[category])),
-                'elevation': tf.train.Feature(int64_list=tf.train.Int64List(value=[elevation])),
-                'azimuth': tf.train.Feature(int64_list=tf.train.Int64List(value=[azimuth])),
-                'lighting': tf.train.Feature(int64_list=tf.train.Int64List(value=[lighting]))
-            }))
-            writer.write(example.SerializeToString())  # Translate Chinese comment: Serialized as a string
-        writer.close()
-
-    # Should take less than a minute
+
+    if kind not in MAT_FILES:
+        raise ValueError('Please choose either train or test data to preprocess.')
+
+    # The records of earlier conversions would be read along with the new ones
+    for path in glob.glob(os.path.join(dir_tfrecords, kind + '*.tfrecords')):
+        os.remove(path)
+
+    # The images are in stereo pairs, so two images correspond to one label
+    num_images = 2 * read_mat(os.path.join(dir_mat, MAT_FILES[kind].format('dat'))).shape[0]
+    logger.info('{} {} images in {} shards'.format(num_images, kind, num_shards))
+
+    # make dataset permuatation reproduceable
+    perm = RandomState(SEED).permutation(num_images)
+
+    shards = []
+    for j, indices in enumerate(np.array_split(perm, num_shards)):
+        tfrecord_path = os.path.join(
+            dir_tfrecords, '{}-{:05d}-of-{:05d}.tfrecords'.format(kind, j, num_shards))
+        shards.append((dir_mat, kind, indices, tfrecord_path, image_size, block_size))
+
+    pool = multiprocessing.Pool(num_workers or multiprocessing.cpu_count())
+    try:
+        for tfrecord_path in pool.imap_unordered(_write_shard, shards):
+            logger.info('Wrote ' + tfrecord_path)
+    finally:
+        pool.close()
+        pool.join()
+
     logger.info('Done writing ' + kind + '. Total time: %f' % (time() - start))
-    
-    # Count 
-    # If not using sharded approach, then should be 48 600 in both train and test tfrecords
-    logger.info("Counting...")
-    c = 0
-    for record in tf.python_io.tf_record_iterator(tfrecord_path):
-        c += 1
-    logger.info("Number of records in {} tfrecord: {}".format(kind,c))
 
+    # Count
+    # Should be 48 600 in both train and test tfrecords
+    logger.info("Counting...")
+    paths = [shard[3] for shard in shards]
+    c = sum(1 for path in paths for _ in tf.python_io.tf_record_iterator(path))
+    logger.info("Number of records in {} tfrecord: {}".format(kind, c))
+    logger.info("Size of {} tfrecord: {:.1f} MB".format(
+        kind, sum(os.path.getsize(path) for path in paths) / 2.**20))
 
 
 if __name__ == "__main__":
-    convert_to_tfrecord(kind='train', chunkify=False)
-    convert_to_tfrecord(kind='test', chunkify=False)
-    
-    
+    parser = argparse.ArgumentParser(
+        description='Convert the smallNORB .mat files to TFRecords')
+    parser.add_argument('--num_shards', type=int, default=10)
+    parser.add_argument('--image_size', type=int, default=48,
+                        help='96 to keep the original size')
+    parser.add_argument('--num_workers', type=int, default=None)
+    parser.add_argument('--block_size', type=int, default=1000)
+    args = parser.parse_args()
+    for kind in ['train', 'test']:
+        convert_to_tfrecord(kind=kind,
+                            num_shards=args.num_shards,
+                            image_size=args.image_size,
+                            num_workers=args.num_workers,
+                            block_size=args.block_size)
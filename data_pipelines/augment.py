@@ -0,0 +1,98 @@
+"""
+License: Apache 2.0
+
+Augmentation of whole batches. Each function draws its random parameters for
+every image of the batch at once and applies them with a few batched ops, so
+the ops run once per batch rather than once per image, and follows the same
+distribution as its per-image counterpart in tf.image.
+"""
+
+import tensorflow as tf
+
+
+def standardize(images):
+  """Normalise each image of a batch to zero mean and unit variance.
+
+  Same as tf.image.per_image_standardization on each image, including the
+  lower bound on the standard deviation for uniform images.
+  """
+  num_pixels = tf.cast(tf.reduce_prod(tf.shape(images)[1:]), tf.float32)
+  mean = tf.reduce_mean(images, axis=[1, 2, 3], keepdims=True)
+  stddev = tf.sqrt(tf.reduce_mean(tf.square(images - mean), axis=[1, 2, 3],
+                                  keepdims=True))
+  return (images - mean) / tf.maximum(stddev, tf.rsqrt(num_pixels))
+
+
+def random_crop(images, size):
+  """Crop a random size x size patch from each image of a batch.
+
+  Same distribution as tf.random_crop on each image: the offsets are uniform
+  over all positions where the patch fits.
+
+  Args:
+    images: (batch, height, width, channels)
+    size: height and width of the patches
+  Returns:
+    patches: (batch, size, size, channels)
+  """
+  shape = tf.shape(images)
+  n, h, w = shape[0], shape[1], shape[2]
+  offset_y = tf.random_uniform([n], maxval=h - size + 1, dtype=tf.int32)
+  offset_x = tf.random_uniform([n], maxval=w - size + 1, dtype=tf.int32)
+  rows = offset_y[:, None] + tf.range(size)[None, :]
+  cols = offset_x[:, None] + tf.range(size)[None, :]
+  # (batch, size, size, 3) indices of the batch, row and column of each pixel
+  indices = tf.stack(
+      [tf.tile(tf.range(n)[:, None, None], [1, size, size]),
+       tf.tile(rows[:, :, None], [1, 1, size]),
+       tf.tile(cols[:, None, :], [1, size, 1])], axis=-1)
+  patches = tf.gather_nd(images, indices)
+  patches.set_shape([images.shape[0], size, size, images.shape[3]])
+  return patches
+
+
+def random_brightness(images, max_delta):
+  """Add a delta from [-max_delta, max_delta) to each image of a batch.
+
+  Same as tf.image.random_brightness on each image.
+  """
+  delta = tf.random_uniform([tf.shape(images)[0], 1, 1, 1],
+                            -max_delta, max_delta)
+  return images + delta
+
+
+def random_contrast(images, lower, upper):
+  """Scale the contrast of each image of a batch by a factor in [lower, upper).
+
+  Same as tf.image.random_contrast on each image: each channel is scaled
+  about its mean over the image.
+  """
+  factor = tf.random_uniform([tf.shape(images)[0], 1, 1, 1], lower, upper)
+  mean = tf.reduce_mean(images, axis=[1, 2], keepdims=True)
+  return (images - mean) * factor + mean
+
+
+def benchmark_augmentation(num_batches=100):
+  """Compare the per-image and batched augmentation of FLAGS.dataset.
+
+  Times the training input pipeline with each, see common.benchmark. Use an
+  in-memory or file input_cache, so that the deterministic preprocessing
+  does not dominate both. Execute this command in a Jupyter Notebook.
+
+  Args:
+    num_batches: number of batches timed
+  Returns:
+    images_per_sec: dict of images/sec by 'per_image' and 'batched'
+  """
+  from config import FLAGS, get_input_fn
+  from data_pipelines import common
+  batch_augment = FLAGS.batch_augment
+  images_per_sec = {}
+  try:
+    for name, value in [('per_image', False), ('batched', True)]:
+      FLAGS.batch_augment = value
+      images_per_sec[name] = common.benchmark(
+          get_input_fn(FLAGS.dataset, mode="train"), num_batches)
+  finally:
+    FLAGS.batch_augment = batch_augment
+  return images_per_sec
@@ -1,26 +1,40 @@
 import tensorflow as tf
 import tensorflow_datasets as tfds
 from config import FLAGS
+from data_pipelines import common
 
 
 def _floatify_and_normalize(datapoint):
+  if FLAGS.device_augment:
+    # Normalised on the tower device, see device_preprocess
+    return datapoint["image"], datapoint["label"]
   img = tf.cast(datapoint["image"], tf.float32) / 255
   return img, datapoint["label"]
 
 
-def create_inputs(is_train, force_set=None):
+def device_preprocess(images, is_train):
+  return tf.cast(images, tf.float32) / 255
+
+
+def input_fn(is_train, force_set=None):
   # currently does not support actual validation pipeline
   split = "train" if is_train else "test"
   if force_set is not None:
     split = force_set
   data = tfds.load(name="cifar10", split=split)
-  data = data.map(_floatify_and_normalize, num_parallel_calls=FLAGS.num_threads)
+  data = common.shard(data, is_train)
+  # Cache the decoded uint8 images, which take a quarter of the space of
+  # float32 images, and cast them every epoch
+  data = common.cache(data, "cifar10", split, is_train)
+  data = data.map(_floatify_and_normalize, num_parallel_calls=common.parallel_calls())
   if is_train:
-    data = data.shuffle(2000 + 3 * FLAGS.batch_size).batch(FLAGS.batch_size, drop_remainder=True).repeat()
+    data = common.shuffle(data, 2000 + 3 * FLAGS.batch_size).batch(FLAGS.batch_size, drop_remainder=True).repeat()
   else:
     data = data.batch(FLAGS.batch_size, drop_remainder=True).repeat()
-  data = data.prefetch(1)
-  iterator = data.make_one_shot_iterator()
-  img, lab = iterator.get_next()
-  output_dict = {'image': img, 'label': lab}
-  return output_dict
+  data = data.map(common.image_label_dict)
+  data = common.finish(data)
+  return data
+
+
+def create_inputs(is_train, force_set=None, saveable=False):
+  return common.get_next(input_fn(is_train, force_set), saveable)
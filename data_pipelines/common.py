@@ -0,0 +1,236 @@
+"""
+License: Apache 2.0
+"""
+
+import tensorflow as tf
+
+import os
+import time
+
+from config import FLAGS
+
+# Initializers of the iterators created by get_next(saveable=True) and
+# get_next_switchable, these have to be run before the first step and before restoring a checkpoint
+ITERATOR_INITIALIZERS = 'iterator_initializers'
+
+
+def parallel_calls():
+  """Parallelism of the pipeline maps, FLAGS.num_threads or autotuned."""
+  return FLAGS.num_threads or tf.data.experimental.AUTOTUNE
+
+
+def finish(dataset):
+  """Prefetch the batches of a pipeline and set its tf.data options.
+
+  The prefetch depth and the parallelism of the maps with parallel_calls
+  are tuned at run time by the tf.data autotuner. With
+  FLAGS.input_threadpool_size, the pipeline runs on its own thread pool
+  instead of the inter-op pool of the session, so the training, evaluation
+  and model ops do not compete for the same threads. Each op of the pipeline
+  runs on one thread, as the parallelism comes from running elements
+  concurrently.
+
+  Args:
+    dataset: batched tf.data.Dataset
+  Returns:
+    dataset: tf.data.Dataset with prefetch and options
+  """
+  options = tf.data.Options()
+  options.experimental_optimization.autotune = True
+  options.experimental_threading.max_intra_op_parallelism = 1
+  if FLAGS.input_threadpool_size:
+    options.experimental_threading.private_threadpool_size = (
+        FLAGS.input_threadpool_size)
+  dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
+  return dataset.with_options(options)
+
+
+def benchmark(input_fn, num_batches, warmup_batches=5):
+  """Throughput of an input pipeline run on its own, without the model.
+
+  The pipeline is built in a separate graph. The warmup batches fill the
+  prefetch buffers; with an in-memory cache, the timed batches of the first
+  epoch also fill the cache, so time more than an epoch to measure the
+  cached throughput.
+
+  Args:
+    input_fn: function returning a batched tf.data.Dataset
+    num_batches: number of batches timed
+    warmup_batches: number of batches read before timing
+  Returns:
+    images_per_sec: images per second
+  """
+  with tf.Graph().as_default():
+    next_element = input_fn().make_one_shot_iterator().get_next()
+    with tf.Session() as sess:
+      for _ in range(warmup_batches):
+        sess.run(next_element)
+      tic = time.time()
+      for _ in range(num_batches):
+        sess.run(next_element)
+      elapsed = time.time() - tic
+  return num_batches * FLAGS.batch_size / elapsed
+
+
+def fill_cache(input_fn, num_batches):
+  """Read num_batches batches of a pipeline, or all of them if it ends first.
+
+  Reading a little over one epoch writes the files of a directory
+  FLAGS.input_cache, see cache, which tf.data only completes at the end of
+  the first epoch.
+
+  Args:
+    input_fn: function returning a batched tf.data.Dataset
+    num_batches: number of batches read
+  """
+  with tf.Graph().as_default():
+    next_element = input_fn().make_one_shot_iterator().get_next()
+    with tf.Session() as sess:
+      try:
+        for _ in range(num_batches):
+          sess.run(next_element)
+      except tf.errors.OutOfRangeError:
+        pass
+
+
+def image_label_dict(img, lab):
+  """Name the fields of (image, label) dataset elements."""
+  return {'image': img, 'label': lab}
+
+
+def cache(dataset, dataset_name, split, is_train, in_memory=True):
+  """Cache the deterministic prefix of a pipeline at FLAGS.input_cache.
+
+  Everything before the cache runs once, in the first epoch, and later
+  epochs read the cached elements, so only the random augmentation, shuffle
+  and batching that follow are recomputed. With a directory, the elements
+  are written to files named after the dataset, split and pipeline, which
+  later runs read instead of the records. The training and evaluation
+  pipelines of a split get separate files, as tf.data does not allow two
+  iterators to write the same cache, and so do the shards of the training
+  workers, see shard, and the uint8 elements of pipelines that leave
+  preprocessing to the model graph with FLAGS.device_augment.
+
+  Args:
+    dataset: tf.data.Dataset of single examples, before any shuffle
+    dataset_name:
+    split: train, test or validation
+    is_train: whether this is the training pipeline
+    in_memory: False for datasets too large to cache in memory, which are
+      then only cached in a directory
+  Returns:
+    dataset: cached tf.data.Dataset
+  """
+  if FLAGS.input_cache == 'none':
+    return dataset
+  if FLAGS.input_cache == 'memory':
+    return dataset.cache() if in_memory else dataset
+  if not os.path.exists(FLAGS.input_cache):
+    os.makedirs(FLAGS.input_cache)
+  name = '{}_{}_{}'.format(dataset_name, split, 'train' if is_train else 'eval')
+  if is_train and FLAGS.num_workers > 1:
+    name += '_worker{}of{}'.format(FLAGS.worker_index, FLAGS.num_workers)
+  if FLAGS.device_augment:
+    name += '_uint8'
+  return dataset.cache(os.path.join(FLAGS.input_cache, name))
+
+
+def shard(dataset, is_train):
+  """Examples of this worker out of FLAGS.num_workers training processes.
+
+  Worker i reads every num_workers-th example, starting at example i, so
+  the workers together see each example of the split once per epoch.
+  Evaluation pipelines are not sharded, so each worker evaluates the whole
+  set. Pipelines with random access to the examples shard a seeded
+  permutation instead, see data_pipelines/sampler.py.
+  """
+  if not is_train or FLAGS.num_workers == 1:
+    return dataset
+  return dataset.shard(FLAGS.num_workers, FLAGS.worker_index)
+
+
+def fast_forward(dataset, start_step):
+  """Skip the batches of the steps a resumed run has already trained on.
+
+  For training pipelines whose iterator state is not saved with checkpoints,
+  so a resumed run continues at the example start_step * FLAGS.batch_size of
+  the stream, as the sampler of the npy backend does, instead of at the
+  start of the first epoch. The skipped batches are still read and
+  preprocessed.
+  """
+  if start_step <= 0:
+    return dataset
+  return dataset.skip(start_step)
+
+
+def shuffle(dataset, buffer_size):
+  """Shuffle with FLAGS.input_seed, reshuffled every epoch in the same
+  sequence in every run."""
+  return dataset.shuffle(buffer_size, seed=FLAGS.input_seed)
+
+
+def get_next(dataset, saveable=False):
+  """Get the next element of a dataset.
+
+  With saveable, the iterator state (position in the input files, shuffle
+  buffer, prefetched batches) is added to the SAVEABLE_OBJECTS collection, so
+  tf.train.Saver writes it to checkpoints along with the variables, and a
+  resumed run continues mid-epoch with the same shuffle order. Only the
+  training pipeline should be saveable: the state is stored under the name of
+  the iterator op, so an evaluation graph built the same way would otherwise
+  restore the training position.
+
+  Args:
+    dataset: tf.data.Dataset
+    saveable: whether the iterator state is saved with checkpoints
+  Returns:
+    next_element: nested structure of tensors from iterator.get_next()
+  """
+  if saveable:
+    iterator = dataset.make_initializable_iterator()
+    tf.add_to_collection(
+        tf.GraphKeys.SAVEABLE_OBJECTS,
+        tf.data.experimental.make_saveable_from_iterator(iterator))
+    tf.add_to_collection(ITERATOR_INITIALIZERS, iterator.initializer)
+  else:
+    iterator = dataset.make_one_shot_iterator()
+  return iterator.get_next()
+
+
+def get_next_switchable(datasets, default, saveable=False):
+  """Get the next element of one of several datasets, selected at run time.
+
+  Each dataset has its own initializable iterator, and a feedable iterator
+  reads from the one whose string handle is fed to handle, or from the
+  iterator of the default dataset if nothing is fed. Switching keeps the
+  position of every iterator, so evaluating on another dataset does not
+  disturb the training pipeline. The datasets must have the same element
+  structure.
+
+  Args:
+    datasets: dict of tf.data.Dataset by name
+    default: name of the dataset read when no handle is fed
+    saveable: whether the state of the default iterator is saved with
+      checkpoints, see get_next
+  Returns:
+    next_element: nested structure of tensors
+    handle: string handle placeholder, defaults to the default iterator
+    iterators: dict of initializable iterators by name, run their
+      initializer to restart a dataset from the beginning
+  """
+  iterators = {}
+  for name, dataset in datasets.items():
+    iterators[name] = dataset.make_initializable_iterator()
+    tf.add_to_collection(ITERATOR_INITIALIZERS, iterators[name].initializer)
+  if saveable:
+    tf.add_to_collection(
+        tf.GraphKeys.SAVEABLE_OBJECTS,
+        tf.data.experimental.make_saveable_from_iterator(iterators[default]))
+
+  handle = tf.placeholder_with_default(
+      iterators[default].string_handle(), shape=[], name='iterator_handle')
+  iterator = tf.data.Iterator.from_string_handle(
+      handle,
+      datasets[default].output_types,
+      datasets[default].output_shapes)
+  return iterator.get_next(), handle, iterators
@@ -1,9 +1,14 @@
 import tensorflow as tf
 import tensorflow_datasets as tfds
 from config import FLAGS
+from data_pipelines import augment
+from data_pipelines import common
 
 
 def _floatify_and_normalize(datapoint):
+  if FLAGS.device_augment:
+    # Normalised on the tower device, see device_preprocess
+    return datapoint["image"], datapoint["label"]
   img = tf.cast(datapoint["image"], tf.float32) / 255
   return img, datapoint["label"]
 
@@ -15,26 +20,59 @@ def _train_preprocess(img, lab):
   return img, lab
 
 
+def _train_augment_batch(img, lab):
+  return _augment_batch(img), lab
+
+
+def _augment_batch(img):
+  img = augment.random_crop(img, 56)
+  img = augment.random_brightness(img, max_delta=2.0)
+  img = augment.random_contrast(img, lower=0.5, upper=1.5)
+  return img
+
+
 def _val_preprocess(img, lab):
   img = tf.image.central_crop(img, 0.875)
   return img, lab
 
 
-def create_inputs(is_train, force_set=None):
+def device_preprocess(images, is_train):
+  # Same as the host pipeline, on uint8 batches on the tower device, see
+  # norb.device_preprocess
+  img = tf.cast(images, tf.float32) / 255
+  return tf.contrib.framework.smart_cond(
+      is_train,
+      lambda: _augment_batch(img),
+      lambda: img[:, 4:60, 4:60, :])  # central_crop(img, 0.875)
+
+
+def input_fn(is_train, force_set=None):
   # does not have test
   split = "train" if is_train else "validation"
   if force_set is not None:
     split = force_set
   data = tfds.load(name="imagenet_resized", split=split, builder_kwargs={'config':'64x64'})
-  data = data.map(_floatify_and_normalize, num_parallel_calls=FLAGS.num_threads)
+  data = common.shard(data, is_train)
+  # Cache the decoded uint8 images, as float32 images would take four times
+  # the space, and only on disk, as even those do not fit in memory
+  data = common.cache(data, "imagenet56", split, is_train, in_memory=False)
+  data = data.map(_floatify_and_normalize, num_parallel_calls=common.parallel_calls())
+  host_preprocess = not FLAGS.device_augment
   if is_train:
-    data = data.map(_train_preprocess, num_parallel_calls=FLAGS.num_threads)
-    data = data.shuffle(2000 + 3 * FLAGS.batch_size).batch(FLAGS.batch_size, drop_remainder=True).repeat()
+    if host_preprocess and not FLAGS.batch_augment:
+      data = data.map(_train_preprocess, num_parallel_calls=common.parallel_calls())
+    data = common.shuffle(data, 2000 + 3 * FLAGS.batch_size).batch(FLAGS.batch_size, drop_remainder=True)
+    if host_preprocess and FLAGS.batch_augment:
+      data = data.map(_train_augment_batch, num_parallel_calls=common.parallel_calls())
+    data = data.repeat()
   else:
-    data = data.map(_val_preprocess, num_parallel_calls=FLAGS.num_threads)
+    if host_preprocess:
+      data = data.map(_val_preprocess, num_parallel_calls=common.parallel_calls())
     data = data.batch(FLAGS.batch_size, drop_remainder=True).repeat()
-  data = data.prefetch(1)
-  iterator = data.make_one_shot_iterator()
-  img, lab = iterator.get_next()
-  output_dict = {'image': img, 'label': lab}
-  return output_dict
+  data = data.map(common.image_label_dict)
+  data = common.finish(data)
+  return data
+
+
+def create_inputs(is_train, force_set=None, saveable=False):
+  return common.get_next(input_fn(is_train, force_set), saveable)
@@ -7,19 +7,71 @@ E-mail: ashley.gritzman@za.ibm.com
 import tensorflow as tf
 import numpy as np
 
+import functools
 import os
 import re
 
 from config import FLAGS
+from data_pipelines import augment
+from data_pipelines import common
 
 
-def _parser(serialized_example):
+def _record_format(path):
+  """Format version and image size of the records in a tfrecord file.
+
+  Records written before the format_version field was added are version 1,
+  which store 96x96 images as float64. Version 2 records store uint8 pixels,
+  see data/convert_to_tfrecord.py.
+
+  Args:
+    path: tfrecord file
+  Returns:
+    version, height, width
+  """
+  record = next(tf.python_io.tf_record_iterator(path))
+  feature = tf.train.Example.FromString(record).features.feature
+  if 'format_version' not in feature:
+    return 1, 96, 96
+  return (feature['format_version'].int64_list.value[0],
+          feature['height'].int64_list.value[0],
+          feature['width'].int64_list.value[0])
+
+
+def _chunk_files(path, split):
+  """Tfrecord files of a split, e.g. train-00000-of-00010.tfrecords."""
+  chunk_re = re.compile(r"%s.*\.tfrecords" % split)
+  chunk_files = sorted(os.path.join(path, fname) for fname in os.listdir(path)
+                       if chunk_re.match(fname))
+  if not chunk_files:
+    raise ValueError('No smallNORB {} records in {}, convert them with '
+                     'data/convert_to_tfrecord.py'.format(split, path))
+  return chunk_files
+
+
+def _split_format(path, chunk_files):
+  """Record format shared by the files of a split, see _record_format.
+
+  Detecting the format lets old float64 records still be read.
+  """
+  formats = set(_record_format(f) for f in chunk_files)
+  if len(formats) != 1:
+    raise ValueError('smallNORB records in {} have different formats {}, '
+                     'convert them again with data/convert_to_tfrecord.py'
+                     .format(path, sorted(formats)))
+  return formats.pop()
+
+
+def _parser(serialized_example, version=1, height=96, width=96,
+            keep_uint8=False):
   """Parse smallNORB example from tfrecord.
   
   Author:
     Ashley Gritzman 15/11/2018
   Args: 
     serialized_example: serialized example from tfrecord  
+    version: record format version, see _record_format
+    height, width: size of the stored images
+    keep_uint8: return the image as uint8 instead of float32
   Returns:
     img: image
     lab: label
@@ -50,9 +102,15 @@ def _parser(serialized_example):
       'lighting': tf.FixedLenFeature([], tf.int64),
      })
 
-  img = tf.decode_raw(features['img_raw'], tf.float64)
-  img = tf.reshape(img, [96, 96, 1])
-  img = tf.cast(img, tf.float32)  # * (1. / 255) # left unnormalized
+  if version == 1:
+    img = tf.decode_raw(features['img_raw'], tf.float64)
+  else:
+    img = tf.decode_raw(features['img_raw'], tf.uint8)
+  img = tf.reshape(img, [height, width, 1])
+  if keep_uint8:
+    img = tf.cast(img, tf.uint8)
+  else:
+    img = tf.cast(img, tf.float32)  # * (1. / 255) # left unnormalized
 
   lab = tf.cast(features['label'], tf.int32)
   cat = tf.cast(features['category'], tf.int32)
@@ -63,6 +121,27 @@ def _parser(serialized_example):
   return img, lab, cat, elv, azi, lit
 
 
+def _deterministic_preprocess(img, lab, cat, elv, azi, lit):
+  """Preprocessing shared by training and validation.
+
+  Downsample to 48x48 and normalise each image to zero mean and unit
+  variance, see _train_preprocess. The result only depends on the record, so
+  input_fn caches it, and later epochs only run the random augmentation.
+
+  Args:
+    img: image from _parser
+    lab, cat, elv, azi, lit: allow these to pass through
+  Returns:
+    img: standardised 48x48 image
+    lab, cat, elv, azi, lit: allow these to pass through
+  """
+  img = img / 255.
+  # No-op for records already downsampled to 48x48 by the converter
+  img = tf.image.resize_images(img, [48, 48])
+  img = tf.image.per_image_standardization(img)
+  return img, lab, cat, elv, azi, lit
+
+
 def _train_preprocess(img, lab, cat, elv, azi, lit):
   """Preprocessing for training.
   
@@ -76,16 +155,13 @@ def _train_preprocess(img, lab, cat, elv, azi, lit):
   Author:
     Ashley Gritzman 15/11/2018
   Args: 
-    img: this fn only works on the image
+    img: standardised image from _deterministic_preprocess
     lab, cat, elv, azi, lit: allow these to pass through  
   Returns:
     img: image processed
     lab, cat, elv, azi, lit: allow these to pass through   
   """
   
-  img = img / 255.
-  img = tf.image.resize_images(img, [48, 48])
-  img = tf.image.per_image_standardization(img)
   img = tf.random_crop(img, [32, 32, 1])
   img = tf.image.random_brightness(img, max_delta = 2.0)
   #original 0.5, 1.5
@@ -100,6 +176,30 @@ def _train_preprocess(img, lab, cat, elv, azi, lit):
   return img, lab, cat, elv, azi, lit
 
 
+def _train_augment_batch(img, lab, cat, elv, azi, lit):
+  """Batched version of the augmentation of _train_preprocess.
+
+  Applied after batching, with the ops of data_pipelines/augment.py, which
+  draw the random crop offsets, brightness and contrast of every image of
+  the batch at once.
+
+  Args:
+    img: batch of standardised 48x48 images
+    lab, cat, elv, azi, lit: allow these to pass through
+  Returns:
+    img: batch of augmented 32x32 images
+    lab, cat, elv, azi, lit: allow these to pass through
+  """
+  return _augment_batch(img), lab, cat, elv, azi, lit
+
+
+def _augment_batch(img):
+  img = augment.random_crop(img, 32)
+  img = augment.random_brightness(img, max_delta=2.0)
+  img = augment.random_contrast(img, lower=0.5, upper=1.5)
+  return img
+
+
 def _val_preprocess(img, lab, cat, elv, azi, lit):
   """Preprocessing for validation/testing.
   
@@ -113,16 +213,13 @@ def _val_preprocess(img, lab, cat, elv, azi, lit):
   Author:
     Ashley Gritzman 15/11/2018
   Args: 
-    img: this fn only works on the image
+    img: standardised image from _deterministic_preprocess
     lab, cat, elv, azi, lit: allow these to pass through  
   Returns:
     img: image processed
     lab, cat, elv, azi, lit: allow these to pass through   
   """
   
-  img = img / 255.
-  img = tf.image.resize_images(img, [48, 48])
-  img = tf.image.per_image_standardization(img)
   img = tf.slice(img, [8, 8, 0], [32, 32, 1])
   
   # Original
@@ -132,6 +229,32 @@ def _val_preprocess(img, lab, cat, elv, azi, lit):
   return img, lab, cat, elv, azi, lit
   
 
+def device_preprocess(images, is_train):
+  """Preprocessing and augmentation of uint8 batches in the model graph.
+
+  With FLAGS.device_augment, input_fn only parses the records, and each
+  tower calls this on its split of the batch, so that the preprocessing runs
+  on the tower device instead of the host CPU. Same as
+  _deterministic_preprocess followed by _train_augment_batch or
+  _val_preprocess.
+
+  Args:
+    images: uint8 (batch, height, width, 1)
+    is_train: bool, or boolean tensor to switch between training and
+      evaluation at run time
+  Returns:
+    img: float32 (batch, 32, 32, 1)
+  """
+  img = tf.cast(images, tf.float32) / 255.
+  # No-op for records already downsampled to 48x48 by the converter
+  img = tf.image.resize_images(img, [48, 48])
+  img = augment.standardize(img)
+  return tf.contrib.framework.smart_cond(
+      is_train,
+      lambda: _augment_batch(img),
+      lambda: img[:, 8:40, 8:40, :])
+
+
 def input_fn(path, is_train: bool, force_set=None):
   """Input pipeline for smallNORB using tf.data.
   
@@ -143,28 +266,39 @@ def input_fn(path, is_train: bool, force_set=None):
     dataset: image tf.data.Dataset 
   """
 
-  import re
   split = "train" if is_train else "test"
   if force_set is not None:
     split = force_set
-  CHUNK_RE = re.compile(r"%s.*\.tfrecords"%split)
-
-  chunk_files = [os.path.join(path, fname)
-           for fname in os.listdir(path)
-           if CHUNK_RE.match(fname)]
+  chunk_files = _chunk_files(path, split)
+  version, height, width = _split_format(path, chunk_files)
+  parser = functools.partial(_parser, version=version, height=height,
+                             width=width, keep_uint8=FLAGS.device_augment)
+  # With device_augment, the uint8 images are only parsed here, and
+  # preprocessed and augmented on the tower device, see device_preprocess
+  host_preprocess = not FLAGS.device_augment
   
-  # 1. create the dataset
-  dataset = tf.data.TFRecordDataset(chunk_files)
+  # 1. create the dataset, reading all the shards in parallel
+  dataset = tf.data.Dataset.from_tensor_slices(chunk_files)
+  dataset = dataset.interleave(tf.data.TFRecordDataset,
+                               cycle_length=len(chunk_files),
+                               num_parallel_calls=common.parallel_calls())
+  dataset = common.shard(dataset, is_train)
   
   # 2. map with the actual work (preprocessing, augmentation…) using multiple 
   # parallel calls
-  dataset = dataset.map(_parser, num_parallel_calls=FLAGS.num_threads)
-  if is_train:
-    dataset = dataset.map(_train_preprocess, 
-                          num_parallel_calls=FLAGS.num_threads)
-  else:
+  dataset = dataset.map(parser, num_parallel_calls=common.parallel_calls())
+  if host_preprocess:
+    dataset = dataset.map(_deterministic_preprocess,
+                          num_parallel_calls=common.parallel_calls())
+  # Cache the deterministic preprocessing, the random augmentation and the
+  # shuffle order still change every epoch
+  dataset = common.cache(dataset, 'smallNORB', split, is_train)
+  if host_preprocess and is_train and not FLAGS.batch_augment:
+    dataset = dataset.map(_train_preprocess,
+                          num_parallel_calls=common.parallel_calls())
+  elif host_preprocess and not is_train:
     dataset = dataset.map(_val_preprocess, 
-                          num_parallel_calls=FLAGS.num_threads)
+                          num_parallel_calls=common.parallel_calls())
   
   # 3. shuffle (with a big enough buffer size)
   # In response to a question on OpenReview, Hinton et al. wrote the 
@@ -175,49 +309,85 @@ def input_fn(path, is_train: bool, force_set=None):
   # capacity=2000 + 3 * batch_size, ensures a minimum amount of shuffling of 
   # examples. min_after_dequeue=2000."
   capacity = 2000 + 3 * FLAGS.batch_size
-  dataset = dataset.shuffle(buffer_size = capacity)
+  dataset = common.shuffle(dataset, buffer_size=capacity)
     
   # 4. batch
   dataset = dataset.batch(FLAGS.batch_size, drop_remainder=True)
+  if host_preprocess and is_train and FLAGS.batch_augment:
+    dataset = dataset.map(_train_augment_batch,
+                          num_parallel_calls=common.parallel_calls())
 
   # 5. repeat
   dataset = dataset.repeat()
   
-  # 6. prefetch
-  dataset = dataset.prefetch(1)
+  # 6. name the fields
+  dataset = dataset.map(_to_dict)
+
+  # 7. prefetch, with autotuned depth
+  dataset = common.finish(dataset)
   
   return dataset
 
 
-def create_inputs_norb(path, is_train: bool, force_set=None):
+def create_inputs_norb(path, is_train: bool, force_set=None, saveable=False):
   """Get a batch from the input pipeline.
   
   Author:
     Ashley Gritzman 15/11/2018
   Args: 
     is_train:  
+    saveable: save the iterator state with checkpoints, see common.get_next
   Returns:
-    img, lab, cat, elv, azi, lit: 
+    output_dict: image, label, category, elevation, azimuth, lighting
   """
   
   # Create batched dataset
   dataset = input_fn(path, is_train, force_set)
   
-  # Create one-shot iterator
-  iterator = dataset.make_one_shot_iterator()
-  
-  img, lab, cat, elv, azi, lit = iterator.get_next()
-  
-  output_dict = {'image': img,
-           'label': lab,
-           'category': cat,
-           'elevation': elv,
-           'azimuth': azi,
-           'lighting': lit}
+  # Create iterator, one-shot unless it is saved with checkpoints
+  output_dict = common.get_next(dataset, saveable)
   
   return output_dict
 
 
+def _to_dict(img, lab, cat, elv, azi, lit):
+  return {'image': img,
+          'label': lab,
+          'category': cat,
+          'elevation': elv,
+          'azimuth': azi,
+          'lighting': lit}
+
+
+def measure_smallnorb(is_train=True, num_batches=100):
+  """Measure the disk size and throughput of the smallNORB input pipeline.
+
+  Run once with the old records and once with the new ones to compare the
+  formats. Execute this command in a Jupyter Notebook.
+
+  Args:
+    is_train: True for the training dataset, False for the test dataset
+    num_batches: number of batches timed, after a few warmup batches
+  Returns:
+    stats: record format, MB on disk, bytes per record and examples/sec
+  """
+  from config import get_dataset_path
+  path = get_dataset_path("smallNORB")
+  split = "train" if is_train else "test"
+  files = _chunk_files(path, split)
+  num_bytes = sum(os.path.getsize(f) for f in files)
+  num_records = sum(1 for f in files
+                    for _ in tf.python_io.tf_record_iterator(f))
+
+  examples_per_sec = common.benchmark(lambda: input_fn(path, is_train),
+                                      num_batches)
+
+  return {'format': _record_format(files[0]),
+          'mb_on_disk': num_bytes / 2.**20,
+          'bytes_per_record': num_bytes / float(num_records),
+          'examples_per_sec': examples_per_sec}
+
+
 def plot_smallnorb(is_train=True, samples_per_class=5):
   """Plot examples from the smallNORB dataset.
   
@@ -0,0 +1,408 @@
+"""
+License: Apache 2.0
+
+Memory-mapped NumPy backend. Each split is materialised once into one .npy
+file per field, with uint8 images, and later runs memory-map the files, so
+that no epoch parses tfrecord protos or decodes tfds images again. The small
+datasets are materialised from their tfrecords or tfds on first use;
+imagenet56 is packed once from the raw ImageNet image folders by
+data/convert_imagenet.py, which avoids the download and preparation of the
+whole imagenet_resized dataset by tfds.
+"""
+
+import tensorflow as tf
+import numpy as np
+
+import hashlib
+import os
+
+from config import FLAGS
+from data_pipelines import common
+from data_pipelines import imagenet56
+from data_pipelines import norb
+from data_pipelines import sampler
+
+# Get logger that has already been created in config.py
+import daiquiri
+logger = daiquiri.getLogger(__name__)
+
+# Datasets supported by the backend, with their tfds names
+TFDS_NAMES = {'mnist': 'mnist',
+              'cifar10': 'cifar10',
+              'svhn': 'svhn_cropped'}
+DATASETS = ['smallNORB', 'imagenet56'] + sorted(TFDS_NAMES)
+
+# Fields stored for each example besides image and label
+NORB_FIELDS = ['category', 'elevation', 'azimuth', 'lighting']
+
+
+def _fields(dataset_name):
+  if dataset_name == 'smallNORB':
+    return ['image', 'label'] + NORB_FIELDS
+  return ['image', 'label']
+
+
+def _read_norb(path, split):
+  """Read a smallNORB split from its tfrecords into uint8 and int32 arrays.
+
+  Records are parsed with NumPy rather than the TensorFlow parser, in the
+  format detected by norb._record_format. Images of version 1 records are
+  whole numbers stored as float64, and are kept at their stored size, since
+  the pipeline resizes them to 48x48 as before.
+  """
+  chunk_files = norb._chunk_files(path, split)
+  version, height, width = norb._split_format(path, chunk_files)
+  pixel_dtype = np.float64 if version == 1 else np.uint8
+
+  images = []
+  fields = {k: [] for k in ['label'] + NORB_FIELDS}
+  for chunk_file in chunk_files:
+    for record in tf.python_io.tf_record_iterator(chunk_file):
+      feature = tf.train.Example.FromString(record).features.feature
+      img = np.frombuffer(feature['img_raw'].bytes_list.value[0], pixel_dtype)
+      images.append(img.astype(np.uint8).reshape(height, width, 1))
+      for k in fields:
+        fields[k].append(feature[k].int64_list.value[0])
+
+  arrays = {k: np.array(v, dtype=np.int32) for k, v in fields.items()}
+  arrays['image'] = np.stack(images)
+  return arrays
+
+
+def _read_tfds(dataset_name, split):
+  """Read a whole tfds split into uint8 images and int64 labels."""
+  import tensorflow_datasets as tfds
+  with tf.Graph().as_default():
+    data = tfds.as_numpy(tfds.load(name=TFDS_NAMES[dataset_name],
+                                   split=split, batch_size=-1))
+  return {'image': data['image'].astype(np.uint8),
+          'label': data['label'].astype(np.int64)}
+
+
+def materialize(dataset_name, path, split, npy_dir):
+  """Memory-map a split, writing its .npy files the first time.
+
+  The label file is written last, and every file is written under a
+  temporary name and renamed, so an interrupted run never leaves a split
+  that looks complete.
+
+  Args:
+    dataset_name: one of DATASETS
+    path: tfrecord directory of smallNORB, see config.get_dataset_path
+    split: train or test, or train or validation for imagenet56
+    npy_dir: directory of the materialised datasets
+  Returns:
+    arrays: dict of read-only np.memmap by field name, with examples on the
+      first axis
+  """
+  split_dir = os.path.join(npy_dir, dataset_name, split)
+  fields = _fields(dataset_name)
+  if not os.path.exists(os.path.join(split_dir, 'label.npy')):
+    if dataset_name == 'imagenet56':
+      raise ValueError('{} is not packed, run data/convert_imagenet.py '
+                       '--out_dir {}'.format(
+                           split_dir, os.path.join(npy_dir, dataset_name)))
+    logger.info('Materialise {} {} into {}'.format(
+        dataset_name, split, split_dir))
+    if dataset_name == 'smallNORB':
+      arrays = _read_norb(path, split)
+    else:
+      arrays = _read_tfds(dataset_name, split)
+    if not os.path.exists(split_dir):
+      os.makedirs(split_dir)
+    for k in sorted(fields, key=lambda k: k == 'label'):
+      tmp_path = os.path.join(split_dir, k + '.tmp.npy')
+      np.save(tmp_path, arrays[k])
+      os.rename(tmp_path, os.path.join(split_dir, k + '.npy'))
+    logger.info('{} {}: {} examples, {:.1f} MB'.format(
+        dataset_name, split, len(arrays['label']),
+        sum(arrays[k].nbytes for k in fields) / 2.**20))
+
+  arrays = {k: np.load(os.path.join(split_dir, k + '.npy'), mmap_mode='r')
+            for k in fields}
+  # Every example of the split, the population of the training sampler
+  if not os.path.exists(index_path(npy_dir, dataset_name, split)):
+    sampler.write_index_file(index_path(npy_dir, dataset_name, split),
+                             np.arange(len(arrays['label'])))
+  return arrays
+
+
+def index_path(npy_dir, dataset_name, split):
+  """Index file of all the examples of a split, see sampler."""
+  return os.path.join(npy_dir, dataset_name, split, 'index.npy')
+
+
+def parse_class_subset(classes, first_classes=0):
+  """Original labels of the classes a run trains on, or None for all.
+
+  Label i of the run is class i of the list, see _label_map.
+
+  Args:
+    classes: comma-separated list of class ids and ranges such as 0-99,250,
+      empty for all classes
+    first_classes: K for the classes 0-(K-1), 0 for all classes
+  Returns:
+    classes: list of distinct class ids in the order listed, or None
+  """
+  if classes and first_classes:
+    raise ValueError('Set either classes or first_classes, not both')
+  if first_classes < 0:
+    raise ValueError('first_classes must not be negative, not {}'.format(
+        first_classes))
+  if first_classes:
+    return list(range(first_classes))
+  if not classes:
+    return None
+  subset = []
+  for part in classes.split(','):
+    first, _, last = part.strip().partition('-')
+    try:
+      first, last = int(first), int(last or first)
+    except ValueError:
+      raise ValueError('Cannot parse class range: {}'.format(part))
+    if last < first:
+      raise ValueError('Empty class range: {}'.format(part))
+    for c in range(first, last + 1):
+      if c not in subset:
+        subset.append(c)
+  return subset
+
+
+def class_subset():
+  """Classes of FLAGS.classes or FLAGS.first_classes."""
+  return parse_class_subset(FLAGS.classes, FLAGS.first_classes)
+
+
+def _label_map(classes):
+  """Array mapping original labels to the labels of the run."""
+  label_map = np.full(max(classes) + 1, -1, dtype=np.int64)
+  label_map[classes] = np.arange(len(classes))
+  return label_map
+
+
+def _subset_indices(arrays, classes):
+  """Indices of the examples of the classes, in file order."""
+  labels = np.asarray(arrays['label'])
+  if classes is None:
+    return np.arange(len(labels))
+  return np.flatnonzero(np.isin(labels, classes))
+
+
+def _curriculum(is_train, split):
+  # The losses of the curriculum file are those of the training split
+  return is_train and split == "train" and bool(FLAGS.curriculum_file)
+
+
+def _pacing():
+  """Fraction of the easiest examples trained on in each curriculum epoch."""
+  return [FLAGS.curriculum_start +
+          (1 - FLAGS.curriculum_start) * e / FLAGS.curriculum_epochs
+          for e in range(FLAGS.curriculum_epochs)]
+
+
+def split_index(arrays, dataset_name, split, is_train):
+  """Index file of the examples a run reads from a split, in sampler order.
+
+  The examples of class_subset, in file order. For training with
+  FLAGS.balanced_sampling, they are grouped by class for
+  sampler.balanced_index_dataset; with FLAGS.curriculum_file, they are
+  ordered from the lowest to the highest loss for the curriculum of
+  sampler.index_dataset. Index files are written the first time, under a
+  name hashed from what selects and orders their examples.
+
+  Args:
+    arrays: memory maps of the split, see materialize
+    dataset_name: one of DATASETS
+    split: name of the split
+    is_train:
+  Returns:
+    path: .npy index file, see sampler.read_index_file
+    class_counts: number of examples of each class in the label order of
+      the run, with balanced sampling, None otherwise
+  """
+  if FLAGS.balanced_sampling and FLAGS.curriculum_file:
+    raise ValueError('Set either balanced_sampling or curriculum_file, '
+                     'not both')
+  classes = class_subset()
+  balanced = is_train and FLAGS.balanced_sampling
+  curriculum = _curriculum(is_train, split)
+  if classes is None and not balanced and not curriculum:
+    return index_path(FLAGS.npy_dir, dataset_name, split), None
+
+  key = [classes]
+  indices = _subset_indices(arrays, classes)
+  class_counts = None
+  if balanced:
+    labels = np.asarray(arrays['label'])[indices]
+    if classes is not None:
+      labels = _label_map(classes)[labels]
+    indices = indices[np.argsort(labels, kind='stable')]
+    class_counts = np.bincount(
+        labels, minlength=len(classes) if classes else 0).tolist()
+    if min(class_counts) == 0:
+      raise ValueError('Class {} has no examples in {} {}'.format(
+          class_counts.index(0), dataset_name, split))
+    key.append('balanced')
+  if curriculum:
+    losses = np.load(FLAGS.curriculum_file, mmap_mode='r')
+    if losses.shape != arrays['label'].shape:
+      raise ValueError('{} has {} losses, not one for each of the {} '
+                       'examples of {} {}'.format(
+                           FLAGS.curriculum_file, losses.shape[0],
+                           len(arrays['label']), dataset_name, split))
+    indices = indices[np.argsort(losses[indices], kind='stable')]
+    key.append((os.path.abspath(FLAGS.curriculum_file),
+                os.path.getmtime(FLAGS.curriculum_file)))
+
+  digest = hashlib.md5(repr(key).encode()).hexdigest()[:12]
+  path = os.path.join(FLAGS.npy_dir, dataset_name, split,
+                      'index_{}.npy'.format(digest))
+  if not os.path.exists(path):
+    sampler.write_index_file(path, indices)
+  return path, class_counts
+
+
+def _split_name(dataset_name, is_train, force_set=None):
+  if force_set is not None:
+    return force_set
+  if is_train:
+    return "train"
+  # imagenet56 does not have test
+  return "validation" if dataset_name == 'imagenet56' else "test"
+
+
+def num_examples(dataset_name, path, split):
+  """Number of examples of class_subset in a split."""
+  arrays = materialize(dataset_name, path, split, FLAGS.npy_dir)
+  return len(_subset_indices(arrays, class_subset()))
+
+
+def _gather(arrays, fields, label_map=None):
+  """Read the examples at a batch of indices from the memory maps."""
+  def gather(indices):
+    batch = [np.ascontiguousarray(arrays[k][indices]) for k in fields]
+    if label_map is not None:
+      i = fields.index('label')
+      batch[i] = label_map[batch[i]].astype(batch[i].dtype)
+    return tuple(batch)
+  return gather
+
+
+def _cast_image(img, *rest):
+  return (tf.cast(img, tf.float32),) + rest
+
+
+def input_fn(dataset_name, path, is_train, force_set=None, start_step=0):
+  """Input pipeline over a memory-mapped split.
+
+  The dataset holds only example indices, which are batched and resolved by
+  one tf.py_func call per batch that reads the rows straight from the memory
+  maps. The preprocessing is that of the TFRecord and tfds pipelines. For
+  training, the indices come from the sampler, which shuffles the whole
+  split with a seeded permutation every epoch and shards it across
+  FLAGS.num_workers, or draws class-balanced batches, see split_index.
+  Training and evaluation read the examples of class_subset, with labels
+  remapped to 0 to K - 1. tf.py_func cannot be serialised, so the iterator state
+  is not saved with checkpoints, see config.input_state_saveable; instead a
+  resumed run starts the sampler at start_step.
+
+  Args:
+    dataset_name: one of DATASETS
+    path: tfrecord directory of smallNORB, see config.get_dataset_path
+    is_train:
+    force_set: overrides the split chosen by is_train
+    start_step: training step the run resumes from
+  Returns:
+    dataset: tf.data.Dataset of batches, with the same fields as the
+      pipeline of the dataset
+  """
+  if dataset_name not in DATASETS:
+    raise ValueError('The npy input backend supports {}, not {}'.format(
+        ', '.join(DATASETS), dataset_name))
+  split = _split_name(dataset_name, is_train, force_set)
+  arrays = materialize(dataset_name, path, split, FLAGS.npy_dir)
+  fields = _fields(dataset_name)
+  index_file, class_counts = split_index(arrays, dataset_name, split,
+                                         is_train)
+  classes = class_subset()
+  label_map = None if classes is None else _label_map(classes)
+
+  if is_train and FLAGS.balanced_sampling:
+    dataset = sampler.balanced_index_dataset(
+        index_file,
+        class_counts,
+        FLAGS.input_seed,
+        worker_index=FLAGS.worker_index,
+        num_workers=FLAGS.num_workers,
+        start=start_step * FLAGS.batch_size)
+    dataset = dataset.batch(FLAGS.batch_size, drop_remainder=True)
+  elif is_train:
+    dataset = sampler.index_dataset(
+        index_file,
+        FLAGS.input_seed,
+        worker_index=FLAGS.worker_index,
+        num_workers=FLAGS.num_workers,
+        start=start_step * FLAGS.batch_size,
+        pacing=_pacing() if _curriculum(is_train, split) else None)
+    dataset = dataset.batch(FLAGS.batch_size, drop_remainder=True)
+  else:
+    dataset = tf.data.Dataset.from_tensor_slices(
+        sampler.read_index_file(index_file)[0])
+    dataset = dataset.batch(FLAGS.batch_size, drop_remainder=True).repeat()
+
+  def read_batch(indices):
+    batch = tf.py_func(_gather(arrays, fields, label_map), [indices],
+                       [tf.as_dtype(arrays[k].dtype) for k in fields],
+                       stateful=False)
+    for tensor, k in zip(batch, fields):
+      tensor.set_shape([FLAGS.batch_size] + list(arrays[k].shape[1:]))
+    return tuple(batch)
+  dataset = dataset.map(read_batch, num_parallel_calls=common.parallel_calls())
+
+  if FLAGS.device_augment:
+    # The uint8 batches are preprocessed on the tower device, see
+    # norb.device_preprocess
+    to_dict = norb._to_dict if dataset_name == 'smallNORB' else \
+        common.image_label_dict
+    dataset = dataset.map(to_dict)
+  elif dataset_name == 'smallNORB':
+    # The smallNORB preprocessing works on single images
+    dataset = dataset.apply(tf.data.experimental.unbatch())
+    dataset = dataset.map(_cast_image,
+                          num_parallel_calls=common.parallel_calls())
+    dataset = dataset.map(norb._deterministic_preprocess,
+                          num_parallel_calls=common.parallel_calls())
+    if not is_train:
+      dataset = dataset.map(norb._val_preprocess,
+                            num_parallel_calls=common.parallel_calls())
+    elif not FLAGS.batch_augment:
+      dataset = dataset.map(norb._train_preprocess,
+                            num_parallel_calls=common.parallel_calls())
+    dataset = dataset.batch(FLAGS.batch_size, drop_remainder=True)
+    if is_train and FLAGS.batch_augment:
+      dataset = dataset.map(norb._train_augment_batch,
+                            num_parallel_calls=common.parallel_calls())
+    dataset = dataset.map(norb._to_dict)
+  elif dataset_name == 'imagenet56' and is_train and not FLAGS.batch_augment:
+    dataset = dataset.apply(tf.data.experimental.unbatch())
+    dataset = dataset.map(
+        lambda img, lab: imagenet56._train_preprocess(
+            tf.cast(img, tf.float32) / 255, lab),
+        num_parallel_calls=common.parallel_calls())
+    dataset = dataset.batch(FLAGS.batch_size, drop_remainder=True)
+    dataset = dataset.map(common.image_label_dict)
+  elif dataset_name == 'imagenet56':
+    # The uint8 batches get the batched preprocessing of the tower device,
+    # on the host
+    dataset = dataset.map(
+        lambda img, lab: common.image_label_dict(
+            imagenet56.device_preprocess(img, is_train), lab),
+        num_parallel_calls=common.parallel_calls())
+  else:
+    dataset = dataset.map(
+        lambda img, lab: common.image_label_dict(
+            tf.cast(img, tf.float32) / 255, lab),
+        num_parallel_calls=common.parallel_calls())
+
+  dataset = common.finish(dataset)
+  return dataset
@@ -0,0 +1,204 @@
+"""
+License: Apache 2.0
+
+Deterministic, resumable and sharded order of the training examples.
+
+Epoch e visits the examples of an index file in the permutation drawn with
+the stateless seed (seed, e), so every worker computes the same permutation
+without communicating. Worker w of W takes every W-th index of it, starting
+at w, truncated so that every worker gets the same number, so no example is
+seen twice in an epoch and at most W - 1 are left out. The order only depends
+on the seed and the position in the stream, so a resumed run continues with
+the examples it would have seen next by starting the stream at the position
+of its checkpoint.
+
+A curriculum restricts the first epochs to a growing prefix of an index file
+ordered from the easiest to the hardest example, and balanced_index_dataset
+draws every class equally often whatever its frequency.
+"""
+
+import tensorflow as tf
+import numpy as np
+
+import os
+
+
+def write_index_file(path, indices):
+  """Write example indices as a .npy index file, see read_index_file."""
+  tmp_path = path + '.tmp.npy'
+  np.save(tmp_path, np.asarray(indices, dtype='<i8'))
+  os.rename(tmp_path, path)
+
+
+def read_index_file(path):
+  """Read an index file with graph ops.
+
+  The file is read when the iterator is initialised, rather than embedded in
+  the graph as a constant, and the dataset has no py_func, so it can be used
+  with one-shot iterators and serialised with the iterator state.
+
+  Args:
+    path: .npy file of int64 example indices
+  Returns:
+    indices: int64 tensor (num_indices)
+    num_indices: int
+  """
+  header = np.load(path, mmap_mode='r')
+  if header.dtype != np.dtype('<i8') or header.ndim != 1:
+    raise ValueError('Index file {} is not a vector of int64, but {} {}'
+                     .format(path, header.dtype, header.shape))
+  offset, num_indices = header.offset, len(header)
+  del header
+  raw = tf.strings.substr(tf.read_file(path), offset, num_indices * 8)
+  indices = tf.decode_raw(raw, tf.int64, little_endian=True)
+  indices.set_shape([num_indices])
+  return indices, num_indices
+
+
+def _check_workers(worker_index, num_workers):
+  if not 0 <= worker_index < num_workers:
+    raise ValueError('Worker index {} is not in [0, {})'.format(
+        worker_index, num_workers))
+
+
+def _epoch_seed(seed, epoch):
+  return tf.stack([tf.constant(seed, tf.int64), epoch])
+
+
+def _epoch_sizes(num_indices, num_workers, pacing=None):
+  """Size of the pool and of the share of one worker of each epoch.
+
+  The first len(pacing) epochs draw from the first pacing[e] of the indices,
+  and the last entry, for all later epochs, from all of them. Every worker
+  takes the same number of indices, pool_size // num_workers.
+
+  Returns:
+    pool_sizes: list of int
+    per_worker: list of int
+  """
+  pool_sizes = [min(num_indices,
+                    max(num_workers, int(round(f * num_indices))))
+                for f in pacing or []] + [num_indices]
+  return pool_sizes, [n // num_workers for n in pool_sizes]
+
+
+def _shard(order, worker_index, num_workers, per_worker):
+  """The share of one worker of the order of an epoch.
+
+  Works on lists and arrays as well as tensors. The shares of the workers are
+  disjoint, and all have per_worker indices.
+  """
+  return order[worker_index::num_workers][:per_worker]
+
+
+def _locate(start, epoch_sizes):
+  """Epoch and position in it of the start of a stream.
+
+  epoch_sizes holds the number of indices of each epoch of one worker, the
+  last one repeating forever.
+  """
+  for epoch, size in enumerate(epoch_sizes[:-1]):
+    if start < size:
+      return epoch, start
+    start -= size
+  return (len(epoch_sizes) - 1 + start // epoch_sizes[-1],
+          start % epoch_sizes[-1])
+
+
+def index_dataset(index_file, seed, shuffle=True, worker_index=0,
+                  num_workers=1, start=0, pacing=None):
+  """Endless stream of the example indices of one worker.
+
+  With pacing, epoch e < len(pacing) only visits the first pacing[e] of the
+  index file, which is ordered from the easiest example, and later epochs
+  all of it.
+
+  Args:
+    index_file: .npy file of the example indices of the split
+    seed: seed of the permutations, the same on every worker
+    shuffle: False to visit the indices in the order of the file every epoch
+    worker_index: index of this worker, from 0 to num_workers - 1
+    num_workers: number of workers sharing the split
+    start: number of indices of the stream of this worker already consumed,
+      e.g. step * batch_size of the checkpoint a run resumes from
+    pacing: fractions in (0, 1] of the index file visited by the first
+      epochs, None to visit all of it every epoch
+  Returns:
+    dataset: tf.data.Dataset of int64 example indices
+  """
+  _check_workers(worker_index, num_workers)
+  indices, num_indices = read_index_file(index_file)
+  pool_sizes, per_worker = _epoch_sizes(num_indices, num_workers, pacing)
+  if per_worker[-1] == 0:
+    raise ValueError('Index file {} has {} indices, fewer than the {} '
+                     'workers'.format(index_file, num_indices, num_workers))
+
+  def epoch_indices(epoch):
+    e = tf.minimum(epoch, len(pool_sizes) - 1)
+    pool_size = tf.gather(tf.constant(pool_sizes, tf.int64), e)
+    order = indices[:pool_size]
+    if shuffle:
+      keys = tf.contrib.stateless.stateless_random_uniform(
+          tf.reshape(pool_size, [1]), seed=_epoch_seed(seed, epoch))
+      order = tf.gather(order, tf.contrib.framework.argsort(keys))
+    order = _shard(order, worker_index, num_workers,
+                   tf.gather(tf.constant(per_worker, tf.int64), e))
+    return tf.data.Dataset.from_tensor_slices(order)
+
+  first_epoch, skip = _locate(start, per_worker)
+  dataset = tf.data.experimental.Counter(first_epoch)
+  dataset = dataset.flat_map(epoch_indices)
+  return dataset.skip(skip)
+
+
+def balanced_index_dataset(index_file, class_counts, seed, worker_index=0,
+                           num_workers=1, start=0):
+  """Endless class-balanced stream of the example indices of one worker.
+
+  Each index is drawn by picking a class uniformly, then one of its examples
+  uniformly, with replacement, so every class makes up the same share of the
+  batches on average. An epoch is as many draws as the share of the index
+  file of a worker, and the draws of worker w in epoch e use the stateless
+  seed (seed, e * num_workers + w), so the stream is resumable as that of
+  index_dataset.
+
+  Args:
+    index_file: .npy file of the example indices, grouped by class in label
+      order
+    class_counts: number of indices of each class in the index file
+    seed: seed of the draws, the same on every worker
+    worker_index: index of this worker, from 0 to num_workers - 1
+    num_workers: number of workers
+    start: number of indices of the stream of this worker already consumed
+  Returns:
+    dataset: tf.data.Dataset of int64 example indices
+  """
+  _check_workers(worker_index, num_workers)
+  indices, num_indices = read_index_file(index_file)
+  if sum(class_counts) != num_indices or min(class_counts) == 0:
+    raise ValueError('Class counts {} do not partition the {} indices of {}'
+                     .format(class_counts, num_indices, index_file))
+  per_worker = num_indices // num_workers
+  if per_worker == 0:
+    raise ValueError('Index file {} has {} indices, fewer than the {} '
+                     'workers'.format(index_file, num_indices, num_workers))
+  num_classes = len(class_counts)
+  counts = tf.constant(class_counts, tf.int64)
+  offsets = tf.constant(np.cumsum([0] + list(class_counts[:-1])), tf.int64)
+
+  def epoch_indices(epoch):
+    u = tf.contrib.stateless.stateless_random_uniform(
+        [2, per_worker],
+        seed=_epoch_seed(seed, epoch * num_workers + worker_index))
+    classes = tf.minimum(tf.cast(u[0] * num_classes, tf.int64),
+                         num_classes - 1)
+    count = tf.gather(counts, classes)
+    member = tf.minimum(tf.cast(u[1] * tf.cast(count, tf.float32), tf.int64),
+                        count - 1)
+    return tf.data.Dataset.from_tensor_slices(
+        tf.gather(indices, tf.gather(offsets, classes) + member))
+
+  first_epoch, skip = _locate(start, [per_worker])
+  dataset = tf.data.experimental.Counter(first_epoch)
+  dataset = dataset.flat_map(epoch_indices)
+  return dataset.skip(skip)
@@ -0,0 +1,116 @@
+"""
+License: Apache 2.0
+"""
+
+import os
+import sqlite3
+import time
+
+import numpy as np
+
+# Get logger that has already been created in config.py
+import daiquiri
+logger = daiquiri.getLogger(__name__)
+
+
+class EarlyStopping(object):
+  """Stop when a validation metric has not improved for a number of
+  evaluations.
+
+  Args:
+    patience: number of evaluations without improvement before stopping
+    higher_is_better: True for accuracy, False for loss
+    min_delta: smallest change that counts as an improvement
+  """
+
+  def __init__(self, patience, higher_is_better=True, min_delta=0.):
+    self.patience = patience
+    self.sign = 1. if higher_is_better else -1.
+    self.min_delta = min_delta
+    self.best = None
+    self.evaluations_since_best = 0
+
+  def update(self, value):
+    """Record an evaluation, and return whether training should stop."""
+    if self.best is None or self.sign * (value - self.best) > self.min_delta:
+      self.best = value
+      self.evaluations_since_best = 0
+    else:
+      self.evaluations_since_best += 1
+    return self.evaluations_since_best >= self.patience
+
+
+class MedianPruner(object):
+  """Median stopping rule across the concurrent runs of a study.
+
+  Every evaluation of every run is recorded in a small SQLite file shared by
+  the runs of a sweep. A run is pruned if its best value so far is worse
+  than the median of the best values of the other runs at the same step,
+  as in the median stopping rule of Golovin et al. "Google Vizier: A Service
+  for Black-Box Optimization". Runs are only compared once they have been
+  evaluated warmup_evaluations times, and once at least min_runs other runs
+  have reached the step.
+
+  Args:
+    db_path: SQLite file, created if it does not exist
+    study: name of the group of runs that are compared with each other
+    run: name of this run, unique within the study
+    higher_is_better: True for accuracy, False for loss
+    warmup_evaluations: number of evaluations before a run can be pruned
+    min_runs: number of other runs needed at a step to compute the median
+  """
+
+  def __init__(self, db_path, study, run, higher_is_better=True,
+               warmup_evaluations=2, min_runs=3):
+    self.study = study
+    self.run = run
+    self.sign = 1. if higher_is_better else -1.
+    self.warmup_evaluations = warmup_evaluations
+    self.min_runs = min_runs
+    self.evaluations = 0
+
+    db_dir = os.path.dirname(db_path)
+    if db_dir and not os.path.exists(db_dir):
+      os.makedirs(db_dir)
+    # Runs write concurrently, so wait for the lock instead of failing, and
+    # use the write-ahead log so readers do not block the writer
+    self._db = sqlite3.connect(db_path, timeout=60)
+    self._db.execute('PRAGMA journal_mode=WAL')
+    with self._db:
+      self._db.execute('''CREATE TABLE IF NOT EXISTS evaluations (
+                          study TEXT, run TEXT, step INTEGER, value REAL,
+                          wall_time REAL,
+                          PRIMARY KEY (study, run, step))''')
+
+  def report(self, step, value):
+    """Record an evaluation, and return whether the run should be pruned."""
+    with self._db:
+      self._db.execute('INSERT OR REPLACE INTO evaluations VALUES '
+                       '(?, ?, ?, ?, ?)',
+                       (self.study, self.run, step, value, time.time()))
+    self.evaluations += 1
+    if self.evaluations < self.warmup_evaluations:
+      return False
+
+    # Best value of each run up to this step, only for runs that have
+    # reached it
+    rows = self._db.execute(
+        'SELECT run, MAX(? * value) FROM evaluations '
+        'WHERE study = ? AND step <= ? AND run IN '
+        '(SELECT run FROM evaluations WHERE study = ? AND step >= ?) '
+        'GROUP BY run',
+        (self.sign, self.study, step, self.study, step)).fetchall()
+    others = [best for run, best in rows if run != self.run]
+    own = [best for run, best in rows if run == self.run]
+    if len(others) < self.min_runs or not own:
+      return False
+    median = float(np.median(others))
+    if own[0] < median:
+      logger.info('Run {} ({:.4f}) is below the median of {} runs ({:.4f}) '
+                  'at step {}'.format(self.run, self.sign * own[0],
+                                      len(others), self.sign * median, step))
+      return True
+    return False
+
+  def close(self):
+    self._db.close()
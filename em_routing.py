@@ -30,7 +30,7 @@ import daiquiri
 logger = daiquiri.getLogger(__name__)
 
 
-def em_routing(votes_ij, activations_i, batch_size, spatial_routing_matrix, drop_rate=0, dropout=False, dropconnect=False):
+def em_routing(votes_ij, activations_i, batch_size, spatial_routing_matrix, drop_rate=0, dropout=False, dropconnect=False, is_train=True):
   """The EM routing between input capsules (i) and output capsules (j).
   
   See Hinton et al. "Matrix Capsules with EM Routing" for detailed description 
@@ -67,6 +67,9 @@ def em_routing(votes_ij, activations_i, batch_size, spatial_routing_matrix, drop
       (64*6*6, 9*8, 1)
     batch_size: 
     spatial_routing_matrix: 
+    is_train:
+      bool, or boolean tensor that switches dropout and dropconnect off at
+      run time
   Returns:
     poses_j: 
       poses of capsules in layer j (L+1)
@@ -199,6 +202,7 @@ def em_routing(votes_ij, activations_i, batch_size, spatial_routing_matrix, drop
                                  tf.size(rr)),
                                  tf.float32)
       dropconnect_mask = tf.reshape(dropconnect_mask, tf.shape(rr))
+      dropconnect_mask = _train_only(dropconnect_mask, is_train)
       rr = tf.multiply(dropconnect_mask, rr)
  
     for it in range(FLAGS.iter_routing):  
@@ -246,10 +250,21 @@ def em_routing(votes_ij, activations_i, batch_size, spatial_routing_matrix, drop
       dropout_mask = tf.cast(tf.random.categorical(logits,
                              tf.size(activations_j)), tf.float32)
       dropout_mask = tf.reshape(dropout_mask, tf.shape(activations_j))
+      dropout_mask = _train_only(dropout_mask, is_train)
       activations_j = tf.multiply(dropout_mask, activations_j)
   return poses_j, activations_j
 
 
+def _train_only(mask, is_train):
+  """Use mask in training, and a mask of ones in evaluation.
+
+  is_train may be a Python bool or a boolean tensor, e.g. when the same graph
+  is used for training and evaluation.
+  """
+  return tf.contrib.framework.smart_cond(
+      is_train, lambda: mask, lambda: tf.ones_like(mask))
+
+
 def m_step(rr, votes, activations_i, beta_v, beta_a, inverse_temperature):
   """The m-step in EM routing between input capsules (i) and output capsules 
   (j).
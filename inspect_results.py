@@ -26,6 +26,7 @@ logger = daiquiri.getLogger(__name__)
 from config import FLAGS
 import config as conf
 import models as mod
+import model_runtime as rt
 
 
 from adv_patch_train_val import patch_inputs
@@ -89,9 +90,6 @@ def main(args):
   logger.info('BUILD TEST GRAPH')
   g_test = tf.Graph()
   with g_test.as_default():
-    # Get global_step
-    global_step = tf.train.get_or_create_global_step()
-
     num_batches_test = int(dataset_size_test / FLAGS.batch_size)
 
     # Get data
@@ -99,71 +97,94 @@ def main(args):
     batch_x = input_dict['image']
     batch_labels = input_dict['label']
     
-    # AG 10/12/2018: Split batch for multi gpu implementation
-    # Each split is of size FLAGS.batch_size / FLAGS.num_gpus
-    # See: https://github.com/naturomics/CapsNet-
-    # Tensorflow/blob/master/dist_version/distributed_train.py
-    splits_x = tf.split(
-        axis=0, 
-        num_or_size_splits=FLAGS.num_gpus, 
-        value=batch_x)
-    splits_labels = tf.split(
-        axis=0, 
-        num_or_size_splits=FLAGS.num_gpus, 
-        value=batch_labels)
-    
     # Build architecture
     build_arch = conf.get_dataset_architecture(FLAGS.dataset)
     # for baseline
     #build_arch = conf.get_dataset_architecture('baseline')
-    
+
     #--------------------------------------------------------------------------
     # MULTI GPU - TEST
     #--------------------------------------------------------------------------
-    # Calculate the logits for each model tower
-    tower_logits = []
-    tower_recon_losses = []
-    reuse_variables = None
-    with tf.device("/cpu:0"):
-      scale_min_feed = tf.placeholder(tf.float32, shape=[], name="scale_min_feed")
-      scale_max_feed = tf.placeholder(tf.float32, shape=[], name="scale_max_feed")
-    patch_feed = None
-    if FLAGS.patch_path:
-      patch_feed = tf.placeholder(tf.float32,
-                                  shape=batch_x.get_shape().as_list()[-3:],
-                                  name="patch_feed")
-    for i in range(FLAGS.num_gpus):
-      with tf.device('/gpu:%d' % i):
-        with tf.name_scope('tower_%d' % i) as scope:
-          with slim.arg_scope([slim.variable], device='/cpu:0'):
-            logits, recon_losses, patch_node = tower_fn(
-                build_arch,
-                splits_x[i],
-                scale_min_feed,
-                scale_max_feed,
-                patch_feed,
-                scope,
-                num_classes,
-                reuse_variables=reuse_variables, 
-                is_train=False)
+    def build_model(inputs):
+      # Preprocess uint8 batches before the patch, whose shape is that of the
+      # preprocessed images
+      with tf.device('/gpu:0'):
+        x = rt.device_preprocess(inputs['x'], is_train=False)
+      # AG 10/12/2018: Split batch for multi gpu implementation
+      # Each split is of size FLAGS.batch_size / FLAGS.num_gpus
+      # See: https://github.com/naturomics/CapsNet-
+      # Tensorflow/blob/master/dist_version/distributed_train.py
+      splits_x = tf.split(
+          axis=0,
+          num_or_size_splits=FLAGS.num_gpus,
+          value=x)
+
+      # Calculate the logits for each model tower
+      tower_logits = []
+      tower_recon_losses = []
+      reuse_variables = None
+      with tf.device("/cpu:0"):
+        scale_min_feed = tf.placeholder(tf.float32, shape=[], name="scale_min_feed")
+        scale_max_feed = tf.placeholder(tf.float32, shape=[], name="scale_max_feed")
+      outputs = {'scale_min_feed': scale_min_feed,
+                 'scale_max_feed': scale_max_feed}
+      patch_feed = None
+      if FLAGS.patch_path:
+        patch_feed = tf.placeholder(tf.float32,
+                                    shape=x.get_shape().as_list()[-3:],
+                                    name="patch_feed")
+        outputs['patch_feed'] = patch_feed
+      for i in range(FLAGS.num_gpus):
+        with tf.device('/gpu:%d' % i):
+          with tf.name_scope('tower_%d' % i) as scope:
+            with slim.arg_scope([slim.variable], device='/cpu:0'):
+              with conf.tower_jit_scope():
+                logits, recon_losses, patch_node = tower_fn(
+                    build_arch,
+                    splits_x[i],
+                    scale_min_feed,
+                    scale_max_feed,
+                    patch_feed,
+                    scope,
+                    num_classes,
+                    reuse_variables=reuse_variables,
+                    is_train=False)
+
+            # Don't reuse variable for first GPU, but do reuse for others
+            reuse_variables = True
+            # Keep track of losses and logits across for each tower
+            tower_logits.append(logits)
+            tower_recon_losses.append(recon_losses)
+      if not FLAGS.save_patch:
+        outputs['logits'] = tf.concat(tower_logits, axis=0)
+        outputs['recon_losses'] = tf.concat(tower_recon_losses, axis=0)
+      if FLAGS.adv_patch:
+        outputs['patch'] = patch_node
+      return outputs
+
+    # The towers are imported from the graph cache if a model with the same
+    # hyperparameters has been built before
+    outputs = rt.build_or_import('inspect', build_model, {'x': batch_x},
+                                 FLAGS.graph_cache_dir)
+    scale_min_feed = outputs['scale_min_feed']
+    scale_max_feed = outputs['scale_max_feed']
+    patch_feed = outputs.get('patch_feed')
+
+    # Get global_step, which is created with the model
+    global_step = tf.train.get_or_create_global_step()
 
-          # Don't reuse variable for first GPU, but do reuse for others
-          reuse_variables = True
-          # Keep track of losses and logits across for each tower
-          tower_logits.append(logits)
-          tower_recon_losses.append(recon_losses)
     # Combine logits from all towers
     test_metrics = {}
     if not FLAGS.save_patch:
-      test_logits = tf.concat(tower_logits, axis=0)
+      test_logits = outputs['logits']
       test_preds = tf.argmax(test_logits, axis=-1)
-      test_recon_losses = tf.concat(tower_recon_losses, axis=0)
+      test_recon_losses = outputs['recon_losses']
       test_metrics = {'preds': test_preds,
                      'labels': batch_labels,
                      'recon_losses': test_recon_losses
                      }
     if FLAGS.adv_patch:
-      test_metrics['patch'] = patch_node
+      test_metrics['patch'] = outputs['patch']
     
     # Reset and read operations for streaming metrics go here
     test_reset = {}
@@ -182,9 +203,7 @@ def main(args):
     #    config=tf.ConfigProto(allow_soft_placement=True, 
     #                          log_device_placement=False), 
     #    graph=g_test)
-    # Perry: added in for RTX 2070 incompatibility workaround
-    config = tf.ConfigProto(allow_soft_placement=True, log_device_placement=False)
-    config.gpu_options.allow_growth = True
+    config = conf.get_session_config()
     sess_test = tf.Session(config=config, graph=g_test)
 
    
@@ -311,7 +330,8 @@ def tower_fn(build_arch,
       x, patch = patch_inputs(x, is_train=is_train, reuse=reuse_variables, 
                               scale_min=scale_min_feed, scale_max=scale_max_feed,
                               patch_feed=patch_feed)
-    output = build_arch(x, is_train, num_classes=num_classes)
+  output = rt.build_tower(build_arch, x, num_classes, is_train=is_train,
+                          reuse_variables=reuse_variables)
   if FLAGS.save_patch:
     return None, None, patch
   recon_loss = mod.reconstruction_loss(output["input"], output["decoder_out"], batch_reduce=False)
@@ -26,7 +26,8 @@ def conv_caps(activation_in,
               dropout=False,
               dropconnect=False,
               affine_voting=True,
-              share_class_kernel=False):
+              share_class_kernel=False,
+              is_train=True):
   """Convolutional capsule layer.
   
   "The routing procedure is used between each adjacent pair of capsule layers. 
@@ -53,6 +54,7 @@ def conv_caps(activation_in,
     kernel: 
     stride: 
     ncaps_out: depth dimension of parent capsules
+    is_train: bool, or boolean tensor that switches dropout off at run time
     
   Returns:
     activation_out: 
@@ -122,7 +124,8 @@ def conv_caps(activation_in,
                            spatial_routing_matrix,
                            drop_rate,
                            dropout,
-                           dropconnect)
+                           dropconnect,
+                           is_train=is_train)
   
     logger.info(name + ' pose_out shape: {}'.format(pose_out.get_shape()))
     logger.info(name + ' activation_out shape: {}'
@@ -141,7 +144,8 @@ def fc_caps(activation_in,
             drop_rate=0,
             dropout=False,
             dropconnect=False,
-            affine_voting=True):
+            affine_voting=True,
+            is_train=True):
   """Fully connected capsule layer.
   
   "The last layer of convolutional capsules is connected to the final capsule 
@@ -164,6 +168,7 @@ def fc_caps(activation_in,
     ncaps_out: number of class capsules
     name: 
     weights_regularizer:
+    is_train: bool, or boolean tensor that switches dropout off at run time
     
   Returns:
     activation_out: 
@@ -238,7 +243,8 @@ def fc_caps(activation_in,
                            spatial_routing_matrix,
                            drop_rate,
                            dropout,
-                           dropconnect)
+                           dropconnect,
+                           is_train=is_train)
 
     activation_out = tf.squeeze(activation_out, name="activation_out")
     pose_out = tf.squeeze(pose_out, name="pose_out")
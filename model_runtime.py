@@ -0,0 +1,213 @@
+"""
+License: Apache 2.0
+
+Model towers shared by the training, testing and inspection scripts, and a
+cache of built model graphs.
+"""
+
+import tensorflow as tf
+
+import hashlib
+import json
+import os
+
+from config import FLAGS
+import config as conf
+import models as mod
+
+# Get logger that has already been created in config.py
+import daiquiri
+logger = daiquiri.getLogger(__name__)
+
+# Flags that name files, directories or runs, and do not change the graph
+GRAPH_INDEPENDENT_FLAGS = ['f', 'name', 'logdir', 'storage', 'load_dir',
+                           'ckpt_name', 'params_path', 'db_name', 'reset',
+                           'debugger', 'graph_cache_dir', 'npy_dir',
+                           'input_cache']
+
+# Modules the model graph is built from, their source is part of the cache
+# key so that the cache is invalidated when the model code changes, including
+# the pipelines whose device_preprocess is built into the towers
+MODEL_SOURCES = ['config.py', 'models.py', 'layers.py', 'em_routing.py',
+                 'utils.py', 'model_runtime.py', 'adv_patch_train_val.py',
+                 'data_pipelines/augment.py', 'data_pipelines/norb.py',
+                 'data_pipelines/mnist.py', 'data_pipelines/cifar10.py',
+                 'data_pipelines/svhn.py', 'data_pipelines/imagenet56.py']
+
+
+def build_tower(build_arch, x, num_classes, is_train=True, y=None,
+                reuse_variables=None):
+  """Build the model for one tower.
+
+  Args:
+    build_arch: architecture, see config.get_dataset_architecture
+    x: split of batch_x allocated to particular GPU
+    num_classes:
+    is_train: bool, or boolean tensor to switch between training and
+      evaluation at run time
+    y: split of batch_y allocated to particular GPU, only used for the
+      reconstruction mask in training
+    reuse_variables: False for the first GPU, and True for subsequent GPUs
+  Returns:
+    output: dict of output tensors of build_arch
+  """
+  with tf.variable_scope(tf.get_variable_scope(), reuse=reuse_variables):
+    return build_arch(x, is_train, num_classes=num_classes, y=y)
+
+
+def device_preprocess(x, is_train):
+  """Preprocess raw uint8 input batches on the device of the tower.
+
+  With FLAGS.device_augment, the input pipelines deliver uint8 batches, and
+  the normalisation and augmentation of the dataset, see
+  config.get_device_preprocess, run here, on the device of the enclosing
+  tf.device scope. Inputs that are already float, because the pipeline or
+  the caller preprocessed them, are returned unchanged.
+
+  Args:
+    x: batch, or split of a batch, of images
+    is_train: bool, or boolean tensor to switch between training
+      augmentation and evaluation cropping at run time
+  Returns:
+    x: float32 batch of preprocessed images
+  """
+  if not FLAGS.device_augment or x.dtype != tf.uint8:
+    return x
+  with tf.name_scope('device_preprocess'):
+    return conf.get_device_preprocess(FLAGS.dataset)(x, is_train)
+
+
+def tower_fn(build_arch,
+             x,
+             y,
+             scope,
+             num_classes,
+             is_train=True,
+             reuse_variables=None):
+  """Model tower to be run on each GPU.
+
+  Author:
+    Ashley Gritzman 27/11/2018
+
+  Args:
+    build_arch:
+    x: split of batch_x allocated to particular GPU
+    y: split of batch_y allocated to particular GPU
+    scope:
+    num_classes:
+    is_train: bool, or boolean tensor to switch between training and
+      evaluation at run time
+    reuse_variables: False for the first GPU, and True for subsequent GPUs
+
+  Returns:
+    loss: mean loss across samples for one tower (scalar)
+    output:
+      dict of output tensors of build_arch, where scores are the output
+      activations of the class caps if the architecture is a capsule network,
+      or the logits of the final layer if it is the CNN baseline
+      (samples_per_tower, n_classes)
+      (64/4=16, 5)
+  """
+  x = device_preprocess(x, is_train)
+  output = build_tower(build_arch, x, num_classes, is_train=is_train, y=y,
+                       reuse_variables=reuse_variables)
+  loss = mod.total_loss(output, y)
+  return loss, output
+
+
+def graph_key(tag, inputs):
+  """Hash of everything a model graph depends on.
+
+  The hyperparameters are those of params.json, as loaded into FLAGS by
+  config.load_or_save_hyperparams, together with any flags overridden on the
+  command line.
+
+  Args:
+    tag: name of the graph, e.g. the script building it
+    inputs: dict of input tensors
+  Returns:
+    key: hex digest
+  """
+  params = {k: v for k, v in FLAGS.flag_values_dict().items()
+            if k not in GRAPH_INDEPENDENT_FLAGS}
+  sha = hashlib.sha1()
+  sha.update(json.dumps(
+      {'tag': tag,
+       'params': params,
+       'inputs': {k: [v.dtype.name, v.get_shape().as_list()]
+                  for k, v in inputs.items()},
+       'tensorflow': tf.__version__},
+      sort_keys=True, default=str).encode())
+  src_dir = os.path.dirname(os.path.abspath(__file__))
+  for name in MODEL_SOURCES:
+    with open(os.path.join(src_dir, name), 'rb') as f:
+      sha.update(f.read())
+  return sha.hexdigest()
+
+
+def build_or_import(tag, build_fn, inputs, cache_dir=None):
+  """Build a model graph, or import it from the cache of built graphs.
+
+  Building the capsule stack takes much longer than importing it, so the
+  graph built by build_fn is exported as a MetaGraph keyed by graph_key, and
+  later runs with the same hyperparameters import it into the default graph,
+  with its inputs connected to inputs. Variables and collections (trainable
+  variables, summaries, the global step) are imported with the graph, so
+  savers built afterwards restore checkpoints as usual.
+
+  build_fn must only build the model, not the input pipeline, and its output
+  tensors must not depend on any tensor of the default graph other than the
+  inputs. The global step is created before build_fn is called, as the
+  spread loss reads it, so callers should get it with
+  tf.train.get_or_create_global_step() afterwards.
+
+  Args:
+    tag: name of the graph, e.g. the script building it
+    build_fn: called with a dict of tensors like inputs, returns a dict of
+      output tensors
+    inputs: dict of input tensors, with static shapes
+    cache_dir: directory of the cached graphs, None or empty to always build
+  Returns:
+    outputs: dict of output tensors
+  """
+  if not cache_dir:
+    tf.train.get_or_create_global_step()
+    return build_fn(inputs)
+
+  key = graph_key(tag, inputs)
+  meta_path = os.path.join(cache_dir, '{}_{}.meta'.format(tag, key))
+  names_path = os.path.join(cache_dir, '{}_{}.json'.format(tag, key))
+
+  if not (os.path.exists(meta_path) and os.path.exists(names_path)):
+    logger.info('Build {} graph for the cache'.format(tag))
+    g = tf.Graph()
+    with g.as_default():
+      tf.train.get_or_create_global_step()
+      placeholders = {
+          k: tf.placeholder(v.dtype, v.get_shape(), name='model_input_' + k)
+          for k, v in inputs.items()}
+      outputs = build_fn(placeholders)
+      names = {'inputs': {k: v.name for k, v in placeholders.items()},
+               'outputs': {k: v.name for k, v in outputs.items()}}
+    if not os.path.exists(cache_dir):
+      os.makedirs(cache_dir)
+    # Write to temporary files and rename, so that concurrent runs never
+    # import a partially written graph
+    tf.train.export_meta_graph(filename=meta_path + '.tmp', graph=g,
+                               clear_devices=False)
+    with open(names_path + '.tmp', 'w') as f:
+      json.dump(names, f)
+    os.rename(meta_path + '.tmp', meta_path)
+    os.rename(names_path + '.tmp', names_path)
+  else:
+    with open(names_path) as f:
+      names = json.load(f)
+
+  logger.info('Import {} graph from {}'.format(tag, meta_path))
+  tf.train.import_meta_graph(
+      meta_path,
+      clear_devices=False,
+      input_map={names['inputs'][k]: v for k, v in inputs.items()})
+  graph = tf.get_default_graph()
+  return {k: graph.get_tensor_by_name(name)
+          for k, name in names['outputs'].items()}
@@ -20,6 +20,32 @@ import daiquiri
 logger = daiquiri.getLogger(__name__)
 
 
+#------------------------------------------------------------------------------
+# TRAIN/EVAL SWITCH
+#------------------------------------------------------------------------------
+# is_train is either a Python bool, or a boolean tensor that switches a single
+# graph between training and evaluation at run time
+def _if_train(value, is_train):
+  """value, unless is_train is False.
+
+  With an is_train tensor the layer is built with value, and the layer itself
+  switches it off at run time.
+  """
+  if isinstance(is_train, bool):
+    return value if is_train else False
+  return value
+
+
+def _reconstruction_classes(scores, y, is_train):
+  """Classes whose pose is reconstructed: labels in training, otherwise
+  predictions."""
+  predictions = lambda: tf.argmax(scores, axis=-1, name="class_predictions")
+  if y is None:
+    return predictions()
+  return tf.contrib.framework.smart_cond(
+      is_train, lambda: tf.cast(y, tf.int64), predictions)
+
+
 #------------------------------------------------------------------------------
 # CAPSNET FOR SMALLNORB
 #------------------------------------------------------------------------------
@@ -49,11 +75,11 @@ def build_arch_smallnorb(inp, is_train: bool, num_classes: int, y=None):
   capsule_weights_regularizer = tf.contrib.layers.l2_regularizer(FLAGS.capsule_weight_reg_lambda)
 
   # for drop connect during em routing
-  drop_rate = FLAGS.drop_rate if is_train else 0
+  drop_rate = FLAGS.drop_rate if _if_train(True, is_train) else 0
 
   # weights_initializer=initializer,
   with slim.arg_scope([slim.conv2d, slim.fully_connected], 
-    trainable = is_train, 
+    trainable = _if_train(True, is_train),
     biases_initializer = bias_initializer,
     weights_regularizer = nn_weights_regularizer):
     
@@ -62,7 +88,7 @@ def build_arch_smallnorb(inp, is_train: bool, num_classes: int, y=None):
         inp,
         center=False, 
         is_training=is_train, 
-        trainable=is_train)
+        trainable=_if_train(True, is_train))
     
     #----- Convolutional Layer 1 -----#
     with tf.variable_scope('relu_conv1') as scope:
@@ -125,8 +151,9 @@ def build_arch_smallnorb(inp, is_train: bool, num_classes: int, y=None):
         name = 'lyr.conv_caps1',
         weights_regularizer = capsule_weights_regularizer,
         drop_rate = FLAGS.drop_rate,
-        dropout = FLAGS.dropout_extra if is_train else False,
-        affine_voting = FLAGS.affine_voting)
+        dropout = _if_train(FLAGS.dropout_extra, is_train),
+        affine_voting = FLAGS.affine_voting,
+        is_train = is_train)
     
     #----- Conv Caps 2 -----#
     activation, pose = lyr.conv_caps(
@@ -138,9 +165,10 @@ def build_arch_smallnorb(inp, is_train: bool, num_classes: int, y=None):
         name = 'lyr.conv_caps2',
         weights_regularizer = capsule_weights_regularizer,
         drop_rate = FLAGS.drop_rate,
-        dropout = FLAGS.dropout if is_train else False,
-        dropconnect = FLAGS.dropconnect if is_train else False,
-        affine_voting = FLAGS.affine_voting)
+        dropout = _if_train(FLAGS.dropout, is_train),
+        dropconnect = _if_train(FLAGS.dropconnect, is_train),
+        affine_voting = FLAGS.affine_voting,
+        is_train = is_train)
 
     #----- Conv Caps 3 -----#
     # not part of Hintin's architecture
@@ -152,9 +180,10 @@ def build_arch_smallnorb(inp, is_train: bool, num_classes: int, y=None):
           stride = 1,
           ncaps_out = FLAGS.E,
           name = 'lyr.conv_caps3',
-          dropout = FLAGS.dropout_extra if is_train else False,
+          dropout = _if_train(FLAGS.dropout_extra, is_train),
           weights_regularizer = capsule_weights_regularizer,
-          affine_voting = FLAGS.affine_voting)
+          affine_voting = FLAGS.affine_voting,
+          is_train = is_train)
     
     #----- Conv Caps 4 -----#
     if FLAGS.F > 0:
@@ -166,9 +195,10 @@ def build_arch_smallnorb(inp, is_train: bool, num_classes: int, y=None):
           ncaps_out = FLAGS.F, 
           name = 'lyr.conv_caps4',
           weights_regularizer = capsule_weights_regularizer,
-          dropout = FLAGS.dropout if is_train else False,
+          dropout = _if_train(FLAGS.dropout, is_train),
           share_class_kernel=False,
-          affine_voting = FLAGS.affine_voting)
+          affine_voting = FLAGS.affine_voting,
+          is_train = is_train)
     
     #----- Class Caps -----#
     class_activation_out, class_pose_out = lyr.fc_caps(
@@ -179,8 +209,9 @@ def build_arch_smallnorb(inp, is_train: bool, num_classes: int, y=None):
         weights_regularizer = capsule_weights_regularizer,
         drop_rate = FLAGS.drop_rate,
         dropout = False,
-        dropconnect = FLAGS.dropconnect if is_train else False,
-        affine_voting = FLAGS.affine_voting)
+        dropconnect = _if_train(FLAGS.dropconnect, is_train),
+        affine_voting = FLAGS.affine_voting,
+        is_train = is_train)
     act_shape = class_activation_out.get_shape() 
     offset = 1
     if len(act_shape.as_list()) == 1:
@@ -199,11 +230,8 @@ def build_arch_smallnorb(inp, is_train: bool, num_classes: int, y=None):
           dim = int(np.prod(class_input.get_shape()[1:]))
           class_input = tf.reshape(class_input, [batch_size, dim])
         else:
-          if y is None:
-            selected_classes = tf.argmax(class_activation_out, axis=-1,
-                                         name="class_predictions")
-          else:
-            selected_classes = y
+          selected_classes = _reconstruction_classes(class_activation_out, y,
+                                                     is_train)
           recon_mask = tf.one_hot(selected_classes, depth=num_classes,
                                   on_value=True, off_value=False, dtype=tf.bool,
                                   name="reconstruction_mask")
@@ -218,8 +246,9 @@ def build_arch_smallnorb(inp, is_train: bool, num_classes: int, y=None):
             weights_regularizer=capsule_weights_regularizer,
             drop_rate=FLAGS.drop_rate,
             dropout=False,
-            dropconnect=FLAGS.dropconnect if is_train else False,
-            affine_voting=FLAGS.affine_voting)
+            dropconnect=_if_train(FLAGS.dropconnect, is_train),
+            affine_voting=FLAGS.affine_voting,
+            is_train=is_train)
           act_shape = bg_activation.get_shape()
           bg_activation = tf.reshape(bg_activation, [batch_size] + act_shape[offset:].as_list())
           bg_pose = tf.reshape(bg_pose, [batch_size] + act_shape[offset:].as_list() + [16])
@@ -265,11 +294,8 @@ def build_arch_smallnorb(inp, is_train: bool, num_classes: int, y=None):
           class_pose_flattened = tf.reshape(class_pose_out, [batch_size] + np.prod(act_shape[offset:].as_list()) * 16)
           class_input = tf.concat(class_activation_flattened, class_pose_flattened)
         else:
-          if y is None:
-            selected_classes = tf.argmax(class_activation_out, axis=-1,
-                                         name="class_predictions")
-          else:
-            selected_classes = y
+          selected_classes = _reconstruction_classes(class_activation_out, y,
+                                                     is_train)
           recon_mask = tf.one_hot(selected_classes, depth=num_classes,
                                   on_value=True, off_value=False, dtype=tf.bool,
                                   name="reconstruction_mask")
@@ -298,8 +324,9 @@ def build_arch_smallnorb(inp, is_train: bool, num_classes: int, y=None):
             weights_regularizer=capsule_weights_regularizer,
             drop_rate=FLAGS.drop_rate,
             dropout=False,
-            dropconnect=FLAGS.dropconnect if is_train else False,
-            affine_voting=FLAGS.affine_voting)
+            dropconnect=_if_train(FLAGS.dropconnect, is_train),
+            affine_voting=FLAGS.affine_voting,
+            is_train=is_train)
           act_shape = bg_activation.get_shape()
           bg_activation_flattened = tf.reshape(bg_activation, [batch_size] + act_shape[offset:].as_list())
           bg_pose_flattened = tf.reshape(bg_pose, [batch_size] + np.prod(act_shape[offset:].as_list()) * 16)
@@ -361,11 +388,7 @@ def  build_arch_alexnet_modified(inp, is_train: bool, num_classes: int, y=None):
       recon_fn = tf.nn.relu
     else:
       recon_fn = tf.nn.tanh
-    if y is None:
-      selected_classes = tf.argmax(class_logits, axis=-1,
-                                   name="class_predictions")
-    else:
-      selected_classes = y
+    selected_classes = _reconstruction_classes(class_logits, y, is_train)
     recon_mask = tf.one_hot(selected_classes, depth=num_classes,
                             on_value=True, off_value=False, dtype=tf.bool,
                             name="reconstruction_mask")
@@ -0,0 +1,362 @@
+"""
+License: Apache 2.0
+"""
+
+import tensorflow as tf
+from tensorflow.python.client import timeline
+import numpy as np
+
+import collections
+import csv
+import json
+import os
+import queue
+import threading
+import time
+
+# Get logger that has already been created in config.py
+import daiquiri
+logger = daiquiri.getLogger(__name__)
+
+
+class AsyncSummaryWriter(object):
+  """Summary writer that hands summaries to a background thread.
+
+  Wraps tf.summary.FileWriter, so that parsing summaries, building events and
+  queueing them for the event file all happen off the training loop. Calls
+  return as soon as the summary is queued, unless the queue is full.
+
+  Args:
+    logdir: directory where the event file is written
+    graph: graph written to the event file
+    max_queue: number of summaries queued before add_summary blocks
+  """
+
+  def __init__(self, logdir, graph=None, max_queue=100):
+    self._writer = tf.summary.FileWriter(logdir, graph=graph)
+    self._queue = queue.Queue(max_queue)
+    self._thread = threading.Thread(target=self._run,
+                                    name='async_summary_writer')
+    self._thread.daemon = True
+    self._thread.start()
+
+  def add_summary(self, summary, global_step=None):
+    """Queue a Summary protocol buffer or serialized summary string."""
+    self._queue.put((self._writer.add_summary, (summary, global_step)))
+
+  def add_run_metadata(self, run_metadata, tag, global_step=None):
+    """Queue run metadata from a traced session run."""
+    self._queue.put((self._writer.add_run_metadata,
+                     (run_metadata, tag, global_step)))
+
+  def flush(self):
+    """Block until all queued summaries are written to disk."""
+    self._queue.join()
+    self._writer.flush()
+
+  def close(self):
+    """Write all queued summaries and stop the background thread."""
+    self._queue.put(None)
+    self._thread.join()
+    self._writer.close()
+
+  def _run(self):
+    while True:
+      item = self._queue.get()
+      try:
+        if item is None:
+          return
+        fn, args = item
+        fn(*args)
+      except Exception as e:
+        logger.error('Failed to write summary: {}'.format(e))
+      finally:
+        self._queue.task_done()
+
+
+def input_wait_time(tensors):
+  """Time spent waiting for the input pipeline in one session run.
+
+  The first timestamp has no inputs, so it runs as soon as the step starts,
+  and the second runs once the batch has been produced by the iterator. The
+  difference is the time the step stalled on input, which is close to zero
+  when the prefetch buffer keeps up with the model.
+
+  Args:
+    tensors: list of tensors from iterator.get_next()
+  Returns:
+    input_wait: seconds between the start of the step and the batch being
+      ready (scalar)
+  """
+  with tf.name_scope('telemetry'):
+    step_start = tf.timestamp()
+    with tf.control_dependencies(tensors):
+      input_ready = tf.timestamp()
+    input_wait = input_ready - step_start
+  return input_wait
+
+
+def max_bytes_in_use(num_gpus):
+  """High-water mark of allocated memory on each GPU.
+
+  With allow_soft_placement, the ops fall back to the CPU allocator on
+  machines without GPUs.
+
+  Args:
+    num_gpus: number of towers
+  Returns:
+    max_bytes: list of scalar tensors, one per GPU
+  """
+  from tensorflow.contrib.memory_stats import MaxBytesInUse
+  max_bytes = []
+  for i in range(num_gpus):
+    with tf.device('/gpu:%d' % i):
+      max_bytes.append(MaxBytesInUse())
+  return max_bytes
+
+
+class StepTelemetry(object):
+  """Per-step throughput and input-stall telemetry for the training loop.
+
+  Every step is appended to a CSV file, and summary() aggregates the steps
+  since the previous call into TensorBoard scalars: examples/sec, step time
+  percentiles, and the fraction of step time spent waiting for input. A high
+  input fraction means the run is input-bound (e.g. tfds decoding), a low one
+  that it is compute-bound (e.g. routing).
+
+  Args:
+    csv_path: file the per-step rows are appended to
+    batch_size: number of examples consumed by each step
+  """
+
+  CSV_FIELDS = ['step', 'wall_time', 'step_time', 'input_wait',
+                'max_gpu_bytes']
+
+  def __init__(self, csv_path, batch_size):
+    self._batch_size = batch_size
+    new_file = not os.path.exists(csv_path)
+    self._csv_file = open(csv_path, 'a', newline='')
+    self._csv_writer = csv.writer(self._csv_file)
+    if new_file:
+      self._csv_writer.writerow(self.CSV_FIELDS)
+    self._reset()
+
+  def _reset(self):
+    self._step_times = []
+    self._input_waits = []
+    self._interval_tic = time.time()
+
+  def record(self, step, step_time, input_wait, max_gpu_bytes=None):
+    """Record one step.
+
+    Args:
+      step: training step
+      step_time: seconds spent in the session run
+      input_wait: seconds of the step spent waiting for the input pipeline
+      max_gpu_bytes: list of memory high-water marks, one per GPU, or None
+        on steps where it is not fetched
+    """
+    self._step_times.append(step_time)
+    self._input_waits.append(input_wait)
+    max_gpu_bytes = '' if max_gpu_bytes is None else int(max(max_gpu_bytes))
+    self._csv_writer.writerow(['{:d}'.format(step),
+                               '{:.3f}'.format(time.time()),
+                               '{:.6f}'.format(step_time),
+                               '{:.6f}'.format(input_wait),
+                               max_gpu_bytes])
+
+  def summary(self, step, max_gpu_bytes=None):
+    """Aggregate the steps recorded since the last call.
+
+    Args:
+      step: training step, used for logging
+      max_gpu_bytes: list of memory high-water marks, one per GPU
+    Returns:
+      summary: tf.Summary with the aggregated telemetry, or None if no steps
+        have been recorded
+    """
+    if not self._step_times:
+      return None
+
+    elapsed = time.time() - self._interval_tic
+    step_times = np.array(self._step_times)
+    input_waits = np.array(self._input_waits)
+    steps_per_sec = len(step_times) / elapsed
+    examples_per_sec = steps_per_sec * self._batch_size
+    p50, p90, p99 = np.percentile(step_times, [50, 90, 99])
+    input_fraction = float(np.sum(input_waits) / np.sum(step_times))
+
+    summary = tf.Summary()
+    summary.value.add(tag='steps_per_sec', simple_value=steps_per_sec)
+    summary.value.add(tag='telemetry/examples_per_sec',
+                      simple_value=examples_per_sec)
+    summary.value.add(tag='telemetry/step_time_p50', simple_value=p50)
+    summary.value.add(tag='telemetry/step_time_p90', simple_value=p90)
+    summary.value.add(tag='telemetry/step_time_p99', simple_value=p99)
+    summary.value.add(tag='telemetry/input_wait_mean',
+                      simple_value=float(np.mean(input_waits)))
+    summary.value.add(tag='telemetry/input_wait_fraction',
+                      simple_value=input_fraction)
+    if max_gpu_bytes is not None:
+      for i, b in enumerate(max_gpu_bytes):
+        summary.value.add(tag='telemetry/max_gpu_mem_mb/gpu_%d' % i,
+                          simple_value=b / 2.**20)
+
+    logger.info('TRN stp-{:d}'.format(step)
+                + ' {:.1f} img/s'.format(examples_per_sec)
+                + ' step p50/p90/p99: {:.3f}/{:.3f}/{:.3f}s'.format(
+                    p50, p90, p99)
+                + ' input wait: {:.1f}%'.format(input_fraction*100))
+
+    self._csv_file.flush()
+    self._reset()
+    return summary
+
+  def close(self):
+    self._csv_file.close()
+
+
+class TraceWindow(object):
+  """Trace a bounded window of training steps.
+
+  Tracing with FULL_TRACE slows the traced step down severalfold, so only
+  num_steps consecutive steps are traced, after which the profiler turns
+  itself off. For every traced step a Chrome trace is written (open in
+  chrome://tracing), and at the end of the window the compute time is
+  aggregated by op type and by layer scope, e.g. all ops under
+  tower_*/lyr.conv_caps1/routing are grouped as lyr.conv_caps1/routing, with
+  the time of the forward and of the backward pass of each layer apart.
+
+  Args:
+    out_dir: directory for the traces and tables
+    start_step: first step to trace
+    num_steps: number of steps to trace
+  """
+
+  def __init__(self, out_dir, start_step, num_steps):
+    self.out_dir = out_dir
+    self.start_step = start_step
+    self.end_step = start_step + num_steps
+    self._op_type_micros = collections.Counter()
+    self._op_type_count = collections.Counter()
+    self._forward_micros = collections.Counter()
+    self._backward_micros = collections.Counter()
+    self._traced_steps = 0
+    if not os.path.exists(out_dir):
+      os.makedirs(out_dir)
+
+  def active(self, step):
+    """Whether step falls in the tracing window."""
+    return self.start_step <= step < self.end_step
+
+  def run_options(self, step):
+    """RunOptions and RunMetadata for step, or (None, None) outside window."""
+    if not self.active(step):
+      return None, None
+    if step == self.start_step:
+      logger.info('Start tracing steps {} to {}'
+                  .format(self.start_step, self.end_step - 1))
+    run_options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+    run_metadata = tf.RunMetadata()
+    return run_options, run_metadata
+
+  def record(self, step, run_metadata):
+    """Write the trace of step, and the tables at the end of the window."""
+    trace = timeline.Timeline(run_metadata.step_stats)
+    trace_path = os.path.join(self.out_dir, 'timeline_step_%d.json' % step)
+    with open(trace_path, 'w') as f:
+      f.write(trace.generate_chrome_trace_format())
+
+    for dev_stats in run_metadata.step_stats.dev_stats:
+      # GPU stream devices repeat the kernels already counted on the compute
+      # device, so skip them to avoid double counting
+      if '/stream:' in dev_stats.device or '/memcpy' in dev_stats.device:
+        continue
+      for node_stats in dev_stats.node_stats:
+        micros = node_stats.all_end_rel_micros
+        op_type = _op_type(node_stats)
+        self._op_type_micros[op_type] += micros
+        self._op_type_count[op_type] += 1
+        scope, backward = _layer_scope(node_stats.node_name)
+        if backward:
+          self._backward_micros[scope] += micros
+        else:
+          self._forward_micros[scope] += micros
+    self._traced_steps += 1
+
+    if step == self.end_step - 1:
+      self._write_tables()
+      logger.info('Finished tracing, profiling turned off. Traces and '
+                  'tables written to {}'.format(self.out_dir))
+
+  def _write_tables(self):
+    n = max(self._traced_steps, 1)
+    total = max(sum(self._op_type_micros.values()), 1)
+    scope_micros = self._forward_micros + self._backward_micros
+    tables = {
+        'op_type': [
+            {'op_type': k,
+             'ms_per_step': v / 1000. / n,
+             'calls_per_step': self._op_type_count[k] / float(n),
+             'percent': 100. * v / total}
+            for k, v in self._op_type_micros.most_common()],
+        'layer_scope': [
+            {'scope': k,
+             'ms_per_step': v / 1000. / n,
+             'forward_ms_per_step': self._forward_micros[k] / 1000. / n,
+             'backward_ms_per_step': self._backward_micros[k] / 1000. / n,
+             'percent': 100. * v / total}
+            for k, v in scope_micros.most_common()]}
+
+    with open(os.path.join(self.out_dir, 'op_stats.json'), 'w') as f:
+      json.dump(tables, f, indent=2)
+
+    lines = ['{:<48} {:>12} {:>12} {:>12} {:>8}'.format(
+        'layer scope', 'ms/step', 'fwd ms', 'bwd ms', '%')]
+    for row in tables['layer_scope']:
+      lines.append('{:<48} {:>12.3f} {:>12.3f} {:>12.3f} {:>8.2f}'.format(
+          row['scope'], row['ms_per_step'], row['forward_ms_per_step'],
+          row['backward_ms_per_step'], row['percent']))
+    lines.append('')
+    lines.append('{:<48} {:>12} {:>8} {:>8}'.format(
+        'op type', 'ms/step', 'calls', '%'))
+    for row in tables['op_type']:
+      lines.append('{:<48} {:>12.3f} {:>8.1f} {:>8.2f}'.format(
+          row['op_type'], row['ms_per_step'], row['calls_per_step'],
+          row['percent']))
+    with open(os.path.join(self.out_dir, 'op_stats.txt'), 'w') as f:
+      f.write('\n'.join(lines) + '\n')
+
+    for line in lines[:11]:
+      logger.info(line)
+
+
+def _op_type(node_stats):
+  """Op type from the timeline label, e.g. 'name = MatMul(a, b)'."""
+  label = node_stats.timeline_label
+  if ' = ' in label:
+    return label.split(' = ', 1)[1].split('(', 1)[0]
+  return node_stats.node_name.split(':')[0].split('/')[-1]
+
+
+def _layer_scope(node_name):
+  """Layer scope of an op, and whether it belongs to the backward pass.
+
+  The tower prefix and the op name are dropped, and gradient ops are grouped
+  under the layer they differentiate, e.g.
+    tower_0/lyr.conv_caps1/routing/m_step/sub
+      -> ('lyr.conv_caps1/routing', False)
+    tower_0/gradients/tower_0/lyr.conv_caps1/routing/m_step/sub_grad/Mul
+      -> ('lyr.conv_caps1/routing', True)
+  """
+  parts = node_name.split(':')[0].split('/')
+  if parts and parts[0].startswith('tower_'):
+    parts = parts[1:]
+  backward = bool(parts) and (parts[0] == 'gradients'
+                              or parts[0].startswith('gradients_'))
+  if backward:
+    parts = parts[1:]
+    if parts and parts[0].startswith('tower_'):
+      parts = parts[1:]
+  scope = parts[:-1][:2]
+  return ('/'.join(scope) if scope else '(top level)'), backward
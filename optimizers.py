@@ -0,0 +1,209 @@
+"""
+License: Apache 2.0
+"""
+
+import tensorflow as tf
+
+# Get logger that has already been created in config.py
+import daiquiri
+logger = daiquiri.getLogger(__name__)
+
+# Variables whose update is not scaled by the layer-wise trust ratio of LARS
+# and LAMB: batch norm, biases, and the per-capsule-type EM routing costs,
+# which are scalars and have no meaningful layer norm
+LAYER_ADAPTATION_EXCLUDE = ['BatchNorm', 'biases', 'beta_a', 'beta_v']
+
+
+def learning_rate_schedule(global_step,
+                           base_lr,
+                           schedule='exponential',
+                           warmup_steps=0,
+                           total_steps=None,
+                           batch_size=None,
+                           reference_batch_size=None,
+                           batch_scaling='none'):
+  """Learning rate with optional batch-size scaling and linear warmup.
+
+  With more towers the effective batch grows, and the base learning rate is
+  scaled by batch_size / reference_batch_size (linear, the usual rule for
+  SGD and LARS) or its square root (sqrt, for Adam and LAMB). Large scaled
+  rates diverge in the first updates, so the rate is ramped up linearly from
+  zero over warmup_steps, after which the schedule starts.
+
+  Args:
+    global_step: number of optimiser updates
+    base_lr: learning rate tuned for reference_batch_size
+    schedule:
+      exponential: decay by 0.96 every 20000 updates
+      cosine: decay to zero over total_steps
+      constant
+    warmup_steps: number of updates of linear warmup
+    total_steps: number of updates in the run, for the cosine schedule
+    batch_size: effective batch size of one update
+    reference_batch_size: batch size base_lr was tuned for
+    batch_scaling: none, linear or sqrt
+  Returns:
+    lrn_rate: learning rate (scalar)
+  """
+
+  if batch_scaling == 'linear':
+    base_lr *= batch_size / float(reference_batch_size)
+  elif batch_scaling == 'sqrt':
+    base_lr *= (batch_size / float(reference_batch_size)) ** 0.5
+  elif batch_scaling != 'none':
+    raise ValueError('Unknown batch scaling: {}'.format(batch_scaling))
+
+  with tf.name_scope('learning_rate'):
+    decay_step = tf.maximum(global_step - warmup_steps, 0)
+    if schedule == 'exponential':
+      # In response to a question on OpenReview, Hinton et al. wrote the
+      # following:
+      # "We use an exponential decay with learning rate: 3e-3, decay_steps:
+      # 20000, decay rate: 0.96."
+      # https://openreview.net/forum?id=HJWLfGWRb&noteId=ryxTPFDe2X
+      lrn_rate = tf.train.exponential_decay(learning_rate=base_lr,
+                                            global_step=decay_step,
+                                            decay_steps=20000,
+                                            decay_rate=0.96)
+    elif schedule == 'cosine':
+      # Otherwise the decay would divide by zero or a negative number of
+      # steps, e.g. on a short train_budget with a long warmup
+      if total_steps <= warmup_steps:
+        raise ValueError('The cosine schedule needs more total steps ({}) '
+                         'than warmup steps ({})'.format(total_steps,
+                                                         warmup_steps))
+      lrn_rate = tf.train.cosine_decay(learning_rate=base_lr,
+                                       global_step=decay_step,
+                                       decay_steps=total_steps - warmup_steps)
+    elif schedule == 'constant':
+      lrn_rate = tf.constant(base_lr)
+    else:
+      raise ValueError('Unknown learning rate schedule: {}'.format(schedule))
+
+    if warmup_steps > 0:
+      step = tf.cast(global_step, tf.float32)
+      warmup_lr = base_lr * (step + 1) / warmup_steps
+      lrn_rate = tf.where(step < warmup_steps, warmup_lr, lrn_rate)
+
+  logger.info('Learning rate: {} schedule from {:.3g}, {} warmup steps'
+              .format(schedule, base_lr, warmup_steps))
+  return lrn_rate
+
+
+def get_optimizer(name, learning_rate, momentum=0.9, trust_coefficient=0.001):
+  """Optimiser by name.
+
+  Args:
+    name: adam, lars or lamb
+    learning_rate: learning rate (scalar)
+    momentum: momentum of LARS
+    trust_coefficient: scale of the LARS trust ratio
+  Returns:
+    opt: tf.train.Optimizer
+  """
+  if name == 'adam':
+    return tf.train.AdamOptimizer(learning_rate=learning_rate)
+  if name == 'lars':
+    # Weight decay is already part of the loss, see models.total_loss
+    return tf.contrib.opt.LARSOptimizer(learning_rate,
+                                        momentum=momentum,
+                                        weight_decay=0.0,
+                                        eeta=trust_coefficient,
+                                        skip_list=LAYER_ADAPTATION_EXCLUDE)
+  if name == 'lamb':
+    return LAMBOptimizer(learning_rate,
+                         exclude_from_layer_adaptation=LAYER_ADAPTATION_EXCLUDE)
+  raise ValueError('Unknown optimizer: {}'.format(name))
+
+
+class LAMBOptimizer(tf.train.Optimizer):
+  """Layer-wise adaptive moments optimiser (LAMB).
+
+  Adam, where the update of each variable is rescaled by the trust ratio
+  ||w|| / ||update||, so that every layer moves by a similar fraction of its
+  weights regardless of the scale of its gradients. This keeps large-batch
+  training stable at learning rates where Adam diverges.
+
+  See You et al. "Large Batch Optimization for Deep Learning: Training BERT
+  in 76 minutes".
+
+  Args:
+    learning_rate: learning rate (scalar)
+    beta1: decay of the first moment estimates
+    beta2: decay of the second moment estimates
+    epsilon: added to the denominator for numerical stability
+    exclude_from_layer_adaptation:
+      substrings of the names of variables that are updated as in Adam
+  """
+
+  def __init__(self, learning_rate, beta1=0.9, beta2=0.999, epsilon=1e-6,
+               exclude_from_layer_adaptation=None, use_locking=False,
+               name='LAMB'):
+    super(LAMBOptimizer, self).__init__(use_locking, name)
+    self._lr = learning_rate
+    self._beta1 = beta1
+    self._beta2 = beta2
+    self._epsilon = epsilon
+    self._exclude = exclude_from_layer_adaptation or []
+
+  def _get_beta_accumulators(self):
+    graph = tf.get_default_graph()
+    return (self._get_non_slot_variable('beta1_power', graph=graph),
+            self._get_non_slot_variable('beta2_power', graph=graph))
+
+  def _create_slots(self, var_list):
+    first_var = min(var_list, key=lambda x: x.name)
+    self._create_non_slot_variable(initial_value=self._beta1,
+                                   name='beta1_power',
+                                   colocate_with=first_var)
+    self._create_non_slot_variable(initial_value=self._beta2,
+                                   name='beta2_power',
+                                   colocate_with=first_var)
+    for v in var_list:
+      self._zeros_slot(v, 'm', self._name)
+      self._zeros_slot(v, 'v', self._name)
+
+  def _apply_dense(self, grad, var):
+    beta1_power, beta2_power = self._get_beta_accumulators()
+    dtype = var.dtype.base_dtype
+    lr = tf.cast(self._lr, dtype)
+    beta1 = tf.cast(self._beta1, dtype)
+    beta2 = tf.cast(self._beta2, dtype)
+    beta1_power = tf.cast(beta1_power, dtype)
+    beta2_power = tf.cast(beta2_power, dtype)
+
+    m = self.get_slot(var, 'm')
+    v = self.get_slot(var, 'v')
+    m_t = tf.assign(m, beta1 * m + (1. - beta1) * grad,
+                    use_locking=self._use_locking)
+    v_t = tf.assign(v, beta2 * v + (1. - beta2) * tf.square(grad),
+                    use_locking=self._use_locking)
+    m_hat = m_t / (1. - beta1_power)
+    v_hat = v_t / (1. - beta2_power)
+    update = m_hat / (tf.sqrt(v_hat) + self._epsilon)
+
+    if not any(s in var.op.name for s in self._exclude):
+      w_norm = tf.norm(var)
+      u_norm = tf.norm(update)
+      trust_ratio = tf.where(
+          tf.logical_and(w_norm > 0, u_norm > 0), w_norm / u_norm,
+          tf.ones_like(w_norm))
+      update = trust_ratio * update
+
+    var_update = tf.assign_sub(var, lr * update,
+                               use_locking=self._use_locking)
+    return tf.group(var_update, m_t, v_t)
+
+  def _apply_sparse(self, grad, var):
+    return self._apply_dense(tf.convert_to_tensor(grad), var)
+
+  def _finish(self, update_ops, name_scope):
+    with tf.control_dependencies(update_ops):
+      beta1_power, beta2_power = self._get_beta_accumulators()
+      with tf.colocate_with(beta1_power):
+        update_beta1 = beta1_power.assign(beta1_power * self._beta1,
+                                          use_locking=self._use_locking)
+        update_beta2 = beta2_power.assign(beta2_power * self._beta2,
+                                          use_locking=self._use_locking)
+    return tf.group(*update_ops + [update_beta1, update_beta2],
+                    name=name_scope)
@@ -0,0 +1,390 @@
+"""
+License: Apache 2.0
+
+Run a grid of train_val.py configurations as subprocesses, packing as many
+runs onto each GPU (or the CPU) as fit in its memory, and write a table of
+the final and best accuracy and the throughput of every run.
+
+The grid is a JSON file with the flags shared by all runs, and a list of
+values for each flag that is swept, e.g.
+
+  {"name": "dropout_vs_nodropout",
+   "base": {"dataset": "smallNORB", "epoch": 5, "batch_size": 32},
+   "grid": {"dropout": [true, false], "lrn_rate": [3e-3, 1e-3]}}
+
+  python3 sweep.py --grid=dropout.json --gpus=0,1 --run_memory_mb=4000
+
+Each run gets one GPU, and is started once the memory reserved by the runs
+already on that GPU leaves run_memory_mb free. The reservation of a run is
+replaced by 1.2 times its measured peak (from the max_gpu_bytes column of its
+telemetry.csv) once it has written its first summary, so small configurations
+are packed tightly. All runs read the same dataset files and the same
+input_cache directory, so before the runs are started, one warm-up pass of
+train_val.py --input_warmup per dataset prepares the data and writes the
+cache files, which the runs then only read. With --prune,
+runs that fall below the median of the other runs are stopped early, which
+frees their GPU for the next configuration.
+"""
+
+import argparse
+import csv
+import itertools
+import json
+import glob
+import os
+import re
+import subprocess
+import sys
+import time
+
+
+#------------------------------------------------------------------------------
+# GRID
+#------------------------------------------------------------------------------
+def expand_grid(base, grid):
+  """Cartesian product of the swept flags, on top of the base flags.
+
+  Returns:
+    runs: list of (name, flags) with a name made of the swept values
+  """
+  names = sorted(grid)
+  runs = []
+  for values in itertools.product(*[grid[n] for n in names]):
+    flags = dict(base)
+    flags.update(zip(names, values))
+    name = '_'.join('{}={}'.format(n, v) for n, v in zip(names, values))
+    runs.append((re.sub(r'[^A-Za-z0-9_.=-]', '', name) or 'base', flags))
+  return runs
+
+
+def flag_args(flags):
+  """Command line arguments for train_val.py, in the --name=value form
+  expected by config.load_or_save_hyperparams."""
+  return ['--{}={}'.format(k, v) for k, v in sorted(flags.items())]
+
+
+# Flags that select the input_cache files of a run, see
+# data_pipelines/common.py
+CACHE_FLAGS = ['dataset', 'input_backend', 'device_augment', 'num_workers',
+               'worker_index']
+
+
+def cache_warmups(runs_flags):
+  """Flags of the warm-up passes that write the cache files of the runs.
+
+  Returns:
+    warmups: flags of the first run of each distinct combination of the
+      CACHE_FLAGS, among the runs with a cache directory
+  """
+  warmups = {}
+  for flags in runs_flags:
+    if flags.get('input_cache') in ['memory', 'none']:
+      continue
+    key = tuple(str(flags.get(k)) for k in CACHE_FLAGS)
+    warmups.setdefault(key, flags)
+  return list(warmups.values())
+
+
+#------------------------------------------------------------------------------
+# DEVICES
+#------------------------------------------------------------------------------
+def gpu_free_memory(gpus):
+  """Free memory of each GPU in MB, queried from nvidia-smi."""
+  try:
+    out = subprocess.check_output(
+        ['nvidia-smi', '--query-gpu=index,memory.free',
+         '--format=csv,noheader,nounits']).decode()
+  except (OSError, subprocess.CalledProcessError):
+    return {}
+  free = {}
+  for line in out.strip().splitlines():
+    index, mb = [s.strip() for s in line.split(',')]
+    if index in gpus:
+      free[index] = float(mb)
+  return free
+
+
+class Run(object):
+  """A train_val.py subprocess and its results."""
+
+  def __init__(self, name, flags, sweep_name, out_dir, prune=False):
+    self.name = name
+    self.flags = dict(flags)
+    self.flags['logdir'] = os.path.join(sweep_name, name)
+    self.flags['name'] = name
+    self.flags.setdefault('num_gpus', 1)
+    # A cache directory shared by all runs of the sweep, filled by the
+    # warm-up passes, see warm_up_caches
+    self.flags.setdefault('input_cache', os.path.join(out_dir, 'input_cache'))
+    if prune:
+      # All runs of the sweep are compared by the median stopping rule, see
+      # early_stopping.MedianPruner
+      self.flags.setdefault('prune_db',
+                            os.path.join(out_dir, 'pruning.sqlite'))
+      self.flags.setdefault('prune_study', sweep_name)
+    self.storage = self.flags.get('storage', './')
+    self.out_path = os.path.join(out_dir, name + '.out')
+    self.process = None
+    self.device = None
+    self.reserved_mb = 0.
+    self.measured = False
+    self.returncode = None
+
+  def start(self, device, reserved_mb):
+    env = dict(os.environ)
+    env['CUDA_VISIBLE_DEVICES'] = '' if device == 'cpu' else device
+    self.device = device
+    self.reserved_mb = reserved_mb
+    self._out = open(self.out_path, 'w')
+    self.process = subprocess.Popen(
+        [sys.executable, 'train_val.py'] + flag_args(self.flags),
+        env=env, stdout=self._out, stderr=subprocess.STDOUT)
+    print('Started {} on {}'.format(self.name, device))
+
+  def poll(self):
+    """Whether the run is still going."""
+    if self.process is None or self.returncode is not None:
+      return False
+    self.returncode = self.process.poll()
+    if self.returncode is None:
+      return True
+    self._out.close()
+    print('Finished {} with exit code {}'.format(self.name, self.returncode))
+    return False
+
+  def terminate(self):
+    if self.poll():
+      self.process.terminate()
+
+  def train_dir(self):
+    """Train directory, see config.setup_train_directories."""
+    dirs = sorted(glob.glob(os.path.join(
+        self.storage, 'logs', '*', self.flags['logdir'], '*', 'train')))
+    return dirs[-1] if dirs else None
+
+  def telemetry(self):
+    """Rows of telemetry.csv written so far, see monitoring.StepTelemetry."""
+    train_dir = self.train_dir()
+    if train_dir is None:
+      return []
+    path = os.path.join(train_dir, 'telemetry.csv')
+    if not os.path.exists(path):
+      return []
+    with open(path, newline='') as f:
+      return list(csv.DictReader(f))
+
+  def peak_memory_mb(self):
+    """Measured GPU memory high-water mark, or None before the first
+    summary."""
+    peaks = [float(r['max_gpu_bytes']) for r in self.telemetry()
+             if r['max_gpu_bytes']]
+    return max(peaks) / 2.**20 if peaks else None
+
+  def results(self):
+    """Final and best accuracy, and steps per second."""
+    accs = []
+    stopped = None
+    train_dir = self.train_dir()
+    log_path = (os.path.join(train_dir, 'logger_train.txt')
+                if train_dir is not None else '')
+    if os.path.exists(log_path):
+      with open(log_path) as f:
+        log = f.read()
+      # Validation accuracy, or accuracy on the whole training set for
+      # datasets without a validation set
+      for split in ['VAL', 'TRN']:
+        accs = [float(a) for a in re.findall(
+            split + r' stp-\d+ avg_acc: ([0-9.]+)%', log)]
+        if accs:
+          break
+      match = re.search(r'Stop training at stp-(\d+): (.*)', log)
+      if match is not None:
+        stopped = '{} at step {}'.format(match.group(2), match.group(1))
+    rows = self.telemetry()
+    steps_per_sec = None
+    if len(rows) > 1:
+      elapsed = float(rows[-1]['wall_time']) - float(rows[0]['wall_time'])
+      if elapsed > 0:
+        steps_per_sec = (len(rows) - 1) / elapsed
+    return {'run': self.name,
+            'exit_code': self.returncode,
+            'final_acc': accs[-1] if accs else None,
+            'best_acc': max(accs) if accs else None,
+            'evaluations': len(accs),
+            'stopped': stopped,
+            'steps_per_sec': steps_per_sec,
+            'peak_gpu_mb': self.peak_memory_mb(),
+            'train_dir': train_dir}
+
+
+#------------------------------------------------------------------------------
+# SCHEDULER
+#------------------------------------------------------------------------------
+def warm_up_caches(runs, sweep_name, out_dir):
+  """Write the input caches of the runs before any of them is started.
+
+  Concurrent runs that found the cache files missing would all build them at
+  once, and tf.data does not allow two writers of the same cache. Instead,
+  one train_val.py --input_warmup pass per combination of the CACHE_FLAGS
+  writes them, on the CPU, and the runs only read them.
+
+  Returns:
+    ok: whether all warm-up passes succeeded
+  """
+  for i, flags in enumerate(cache_warmups([r.flags for r in runs])):
+    flags = dict(flags, input_warmup=True)
+    flags.pop('prune_db', None)
+    flags.pop('prune_study', None)
+    warmup = Run('input_warmup{}'.format(i), flags, sweep_name, out_dir)
+    warmup.start('cpu', 0.)
+    warmup.process.wait()
+    warmup.poll()
+    if warmup.returncode != 0:
+      print('Input cache warm-up failed, see {}'.format(warmup.out_path))
+      return False
+  return True
+
+
+def measure_runs(running):
+  """Replace the reservation of each GPU run by 1.2 times its measured peak,
+  once it has written telemetry."""
+  for r in running:
+    if not r.measured and r.device != 'cpu':
+      peak = r.peak_memory_mb()
+      if peak is not None:
+        r.reserved_mb = 1.2 * peak
+        r.measured = True
+        print('{} uses {:.0f}MB on GPU {}'.format(r.name, peak, r.device))
+
+
+def place_runs(pending, running, devices, capacity_mb, run_memory_mb,
+               max_runs_per_device):
+  """Start pending runs, in order, on the device with the most free memory,
+  while any device has run_memory_mb free. A device without runs takes one
+  regardless of its free memory."""
+  while pending:
+    loads = {d: [r for r in running if r.device == d] for d in devices}
+    free = {d: capacity_mb[d] - sum(r.reserved_mb for r in loads[d])
+            for d in devices}
+    candidates = [d for d in devices
+                  if len(loads[d]) < max_runs_per_device
+                  and (free[d] >= run_memory_mb or not loads[d])]
+    if not candidates:
+      return
+    device = max(candidates, key=lambda d: free[d])
+    run = pending.pop(0)
+    run.start(device, run_memory_mb)
+    running.append(run)
+
+
+def run_sweep(runs, devices, capacity_mb, run_memory_mb, max_runs_per_device,
+              poll_secs=10):
+  """Start the runs in order, packing them onto the devices.
+
+  Args:
+    runs: list of Run
+    devices: GPU indices as strings, or ['cpu']
+    capacity_mb: memory of each device available to the sweep
+    run_memory_mb: memory reserved for a run until its peak is measured
+    max_runs_per_device: maximum number of concurrent runs per device
+    poll_secs: seconds between checks of the running processes
+  """
+  pending = list(runs)
+  running = []
+  try:
+    while pending or running:
+      running = [r for r in running if r.poll()]
+      measure_runs(running)
+      place_runs(pending, running, devices, capacity_mb, run_memory_mb,
+                 max_runs_per_device)
+      time.sleep(poll_secs)
+  except KeyboardInterrupt:
+    for r in running:
+      r.terminate()
+    raise
+
+
+def write_summary(runs, out_dir):
+  """Write the results of all runs to summary.csv and print them."""
+  results = [r.results() for r in runs]
+  fields = ['run', 'exit_code', 'final_acc', 'best_acc', 'evaluations',
+            'stopped', 'steps_per_sec', 'peak_gpu_mb', 'train_dir']
+  path = os.path.join(out_dir, 'summary.csv')
+  with open(path, 'w', newline='') as f:
+    writer = csv.DictWriter(f, fieldnames=fields)
+    writer.writeheader()
+    writer.writerows(results)
+
+  def _fmt(v, spec):
+    return spec.format(v) if v is not None else '-'
+
+  print('{:<48} {:>6} {:>9} {:>9} {:>10} {:>9} {:>8}'.format(
+      'run', 'exit', 'final %', 'best %', 'steps/s', 'peak MB', 'stopped'))
+  for r in sorted(results, key=lambda r: -(r['best_acc'] or 0)):
+    print('{:<48} {:>6} {:>9} {:>9} {:>10} {:>9} {:>8}'.format(
+        r['run'][:48], _fmt(r['exit_code'], '{}'),
+        _fmt(r['final_acc'], '{:.2f}'), _fmt(r['best_acc'], '{:.2f}'),
+        _fmt(r['steps_per_sec'], '{:.2f}'), _fmt(r['peak_gpu_mb'], '{:.0f}'),
+        'yes' if r['stopped'] else ''))
+  print('Summary written to {}'.format(path))
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+  parser.add_argument('--grid', required=True,
+                      help='JSON file with name, base flags and grid')
+  parser.add_argument('--gpus', default=None,
+                      help='comma separated GPU indices, defaults to '
+                           'CUDA_VISIBLE_DEVICES, or the CPU if empty')
+  parser.add_argument('--run_memory_mb', type=float, default=4000,
+                      help='GPU memory reserved for a run until its peak '
+                           'has been measured')
+  parser.add_argument('--max_runs_per_device', type=int, default=4,
+                      help='maximum number of concurrent runs per GPU')
+  parser.add_argument('--cpu_runs', type=int,
+                      default=max(1, (os.cpu_count() or 1) // 8),
+                      help='number of concurrent runs without GPUs')
+  parser.add_argument('--no_cache_warmup', action='store_true',
+                      help='start the runs without writing their input '
+                           'cache first, e.g. if it is already complete')
+  parser.add_argument('--prune', action='store_true',
+                      help='stop runs that fall below the median of the '
+                           'other runs, through a shared SQLite file')
+  parser.add_argument('--out_dir', default=None,
+                      help='directory for run outputs and summary.csv, '
+                           'defaults to logs/sweeps/<name>')
+  args = parser.parse_args()
+
+  with open(args.grid) as f:
+    spec = json.load(f)
+  sweep_name = spec.get('name', os.path.splitext(
+      os.path.basename(args.grid))[0])
+  out_dir = args.out_dir or os.path.join('logs', 'sweeps', sweep_name)
+  os.makedirs(out_dir, exist_ok=True)
+  runs = [Run(name, flags, sweep_name, out_dir, prune=args.prune)
+          for name, flags in expand_grid(spec.get('base', {}),
+                                         spec.get('grid', {}))]
+  print('{} runs in sweep {}'.format(len(runs), sweep_name))
+
+  gpus = args.gpus
+  if gpus is None:
+    gpus = os.environ.get('CUDA_VISIBLE_DEVICES', '')
+  gpus = [g.strip() for g in gpus.split(',') if g.strip()]
+  capacity_mb = gpu_free_memory(gpus)
+  if gpus and capacity_mb:
+    devices = [g for g in gpus if g in capacity_mb]
+    max_runs = args.max_runs_per_device
+  else:
+    devices = ['cpu']
+    capacity_mb = {'cpu': float('inf')}
+    max_runs = args.cpu_runs
+
+  if not args.no_cache_warmup and not warm_up_caches(runs, sweep_name,
+                                                      out_dir):
+    sys.exit(1)
+  run_sweep(runs, devices, capacity_mb, args.run_memory_mb, max_runs)
+  write_summary(runs, out_dir)
+
+
+if __name__ == "__main__":
+  main()
@@ -28,6 +28,8 @@ from config import FLAGS
 import config as conf
 import models as mod
 import metrics as met
+import model_runtime as rt
+import training as trn
 
 
 def main(args):
@@ -80,64 +82,72 @@ def main(args):
   logger.info('BUILD TEST GRAPH')
   g_test = tf.Graph()
   with g_test.as_default():
-    # Get global_step
-    global_step = tf.train.get_or_create_global_step()
-
     num_batches_test = int(dataset_size_test / FLAGS.batch_size)
 
     # Get data
     input_dict = create_inputs_test()
     batch_x = input_dict['image']
     batch_labels = input_dict['label']
-    
-    # AG 10/12/2018: Split batch for multi gpu implementation
-    # Each split is of size FLAGS.batch_size / FLAGS.num_gpus
-    # See: https://github.com/naturomics/CapsNet-
-    # Tensorflow/blob/master/dist_version/distributed_train.py
-    splits_x = tf.split(
-        axis=0, 
-        num_or_size_splits=FLAGS.num_gpus, 
-        value=batch_x)
-    splits_labels = tf.split(
-        axis=0, 
-        num_or_size_splits=FLAGS.num_gpus, 
-        value=batch_labels)
-    
+
     # Build architecture
     build_arch = conf.get_dataset_architecture(FLAGS.dataset)
     # for baseline
     #build_arch = conf.get_dataset_architecture('baseline')
-    
+
     #--------------------------------------------------------------------------
     # MULTI GPU - TEST
     #--------------------------------------------------------------------------
-    # Calculate the logits for each model tower
-    tower_logits = []
-    reuse_variables = None
-    for i in range(FLAGS.num_gpus):
-      with tf.device('/gpu:%d' % i):
-        with tf.name_scope('tower_%d' % i) as scope:
-          with slim.arg_scope([slim.variable], device='/cpu:0'):
-            loss, logits = tower_fn(
-                build_arch, 
-                splits_x[i], 
-                splits_labels[i], 
-                scope, 
-                num_classes, 
-                reuse_variables=reuse_variables, 
-                is_train=False)
-
-          # Don't reuse variable for first GPU, but do reuse for others
-          reuse_variables = True
-          
-          # Keep track of losses and logits across for each tower
-          tower_logits.append(logits)
-          
-          # Loss for each tower
-          tf.summary.histogram("test_logits", logits)
-    
-    # Combine logits from all towers
-    logits = tf.concat(tower_logits, axis=0)
+    def build_model(inputs):
+      # AG 10/12/2018: Split batch for multi gpu implementation
+      # Each split is of size FLAGS.batch_size / FLAGS.num_gpus
+      # See: https://github.com/naturomics/CapsNet-
+      # Tensorflow/blob/master/dist_version/distributed_train.py
+      splits_x = tf.split(
+          axis=0,
+          num_or_size_splits=FLAGS.num_gpus,
+          value=inputs['x'])
+      splits_labels = tf.split(
+          axis=0,
+          num_or_size_splits=FLAGS.num_gpus,
+          value=inputs['y'])
+
+      # Calculate the logits for each model tower
+      tower_logits = []
+      reuse_variables = None
+      for i in range(FLAGS.num_gpus):
+        with tf.device('/gpu:%d' % i):
+          with tf.name_scope('tower_%d' % i) as scope:
+            with slim.arg_scope([slim.variable], device='/cpu:0'):
+              with conf.tower_jit_scope():
+                loss, output = rt.tower_fn(
+                    build_arch,
+                    splits_x[i],
+                    splits_labels[i],
+                    scope,
+                    num_classes,
+                    reuse_variables=reuse_variables,
+                    is_train=False)
+
+            # Don't reuse variable for first GPU, but do reuse for others
+            reuse_variables = True
+
+            # Keep track of losses and logits across for each tower
+            tower_logits.append(output['scores'])
+
+            # Loss for each tower
+            tf.summary.histogram("test_logits", output['scores'])
+
+      # Combine logits from all towers
+      return {'logits': tf.concat(tower_logits, axis=0)}
+
+    # The towers are imported from the graph cache if a model with the same
+    # hyperparameters has been built before
+    logits = rt.build_or_import('test', build_model,
+                                {'x': batch_x, 'y': batch_labels},
+                                FLAGS.graph_cache_dir)['logits']
+
+    # Get global_step, which is created with the model
+    global_step = tf.train.get_or_create_global_step()
     
     # Calculate metrics
     test_loss = mod.spread_loss(logits, batch_labels)
@@ -166,6 +176,13 @@ def main(args):
       
     # Saver
     saver = tf.train.Saver(max_to_keep=None)
+
+    # Checkpoints written with moving averages of the weights are restored
+    # with the averages in place of the weights, by a saver built for the
+    # averages each checkpoint has, see trn.moving_average_restore_map
+    if FLAGS.ema_decay > 0:
+      ema = tf.train.ExponentialMovingAverage(FLAGS.ema_decay)
+      savers_ema = {}
     
     # Set summary op
     test_summary = tf.summary.merge_all()
@@ -178,9 +195,7 @@ def main(args):
     #    config=tf.ConfigProto(allow_soft_placement=True, 
     #                          log_device_placement=False), 
     #    graph=g_test)
-    # Perry: added in for RTX 2070 incompatibility workaround
-    config = tf.ConfigProto(allow_soft_placement=True, log_device_placement=False)
-    config.gpu_options.allow_growth = True
+    config = conf.get_session_config()
     sess_test = tf.Session(config=config, graph=g_test)
 
    
@@ -228,7 +243,21 @@ def main(args):
     #--------------------------------------------------------------------------
     # Run testing on checkpoints
     for ckpt in ckpts_to_test:
-      saver.restore(sess_test, ckpt)
+      reader = tf.train.NewCheckpointReader(ckpt)
+      averaged = []
+      if FLAGS.ema_decay > 0:
+        var_map, averaged = trn.moving_average_restore_map(
+            ema, tf.global_variables(), reader)
+        if averaged:
+          key = tuple(sorted(var_map))
+          if key not in savers_ema:
+            savers_ema[key] = tf.train.Saver(var_map, max_to_keep=None)
+      if averaged:
+        logger.info("Restore moving averages of {} variables: {}".format(
+            len(averaged), ', '.join(v.op.name for v in averaged)))
+        savers_ema[key].restore(sess_test, ckpt)
+      else:
+        saver.restore(sess_test, ckpt)
           
       # Reset accumulators
       accuracy_sum = 0
@@ -263,44 +292,7 @@ def main(args):
       summary_test.value.add(tag="test_acc", simple_value=ave_acc)
       summary_test.value.add(tag="test_loss", simple_value=ave_loss)
       summary_writer.add_summary(summary_test, ckpt_num)
-      
-def tower_fn(build_arch, 
-             x, 
-             y, 
-             scope, 
-             num_classes, 
-             is_train=False, 
-             reuse_variables=None):
-  """Model tower to be run on each GPU.
-  
-  Author:
-    Ashley Gritzman 27/11/2018
-    
-  Args: 
-    build_arch:
-    x: split of batch_x allocated to particular GPU
-    y: split of batch_y allocated to particular GPU
-    scope:
-    num_classes:
-    is_train:
-    reuse_variables: False for the first GPU, and True for subsequent GPUs
-
-  Returns:
-    loss: mean loss across samples for one tower (scalar)
-    scores: 
-      If the architecture is a capsule network, then the scores are the output 
-      activations of the class caps.
-      If the architecture is the CNN baseline, then the scores are the logits of 
-      the final layer.
-      (samples_per_tower, n_classes)
-      (64/4=16, 5)
-  """
-  
-  with tf.variable_scope(tf.get_variable_scope(), reuse=reuse_variables):
-    output = build_arch(x, is_train, num_classes=num_classes)
-  loss = mod.total_loss(output, y)
-  return loss, output['scores']
- 
+
 
 if __name__ == "__main__":
   tf.app.run()
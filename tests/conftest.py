@@ -0,0 +1,11 @@
+"""
+License: Apache 2.0
+
+The modules under test are scripts at the root of the repository, rather
+than an installed package, so make them importable from the tests.
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,67 @@
+"""
+License: Apache 2.0
+
+Tests of the retention policy of checkpoints.CheckpointManager.
+"""
+
+from checkpoints import permanent_checkpoints, retained_checkpoints
+
+CKPTS = ['model.ckpt-{}'.format(i) for i in range(10)]
+
+
+def test_keep_last():
+  keep = retained_checkpoints(CKPTS, {}, set(), keep_last=3, keep_best=0)
+  assert keep == set(CKPTS[-3:])
+
+
+def test_keep_last_zero_keeps_all():
+  keep = retained_checkpoints(CKPTS, {}, set(), keep_last=0, keep_best=0)
+  assert keep == set(CKPTS)
+
+
+def test_keep_best_protects_older_checkpoints():
+  metrics = {CKPTS[1]: 0.9, CKPTS[4]: 0.7, CKPTS[8]: 0.8}
+  keep = retained_checkpoints(CKPTS, metrics, set(), keep_last=1,
+                              keep_best=2)
+  assert keep == {CKPTS[1], CKPTS[8], CKPTS[9]}
+
+
+def test_unscored_checkpoints_are_not_best():
+  keep = retained_checkpoints(CKPTS, {}, set(), keep_last=1, keep_best=3)
+  assert keep == {CKPTS[9]}
+
+
+def test_permanent_checkpoints_are_kept():
+  keep = retained_checkpoints(CKPTS, {}, {CKPTS[0], CKPTS[5]}, keep_last=2,
+                              keep_best=0)
+  assert keep == {CKPTS[0], CKPTS[5], CKPTS[8], CKPTS[9]}
+
+
+def test_permanent_ignores_deleted_checkpoints():
+  keep = retained_checkpoints(CKPTS[5:], {}, {CKPTS[0]}, keep_last=1,
+                              keep_best=0)
+  assert keep == {CKPTS[9]}
+
+
+def test_permanent_every_n_hours():
+  hour = 3600.
+  times = [0.5 * hour, 1.0 * hour, 1.5 * hour, 2.5 * hour, 3.0 * hour]
+  permanent, last_time = permanent_checkpoints(times, 1, start_time=0.)
+  assert permanent == [1, 3]
+  assert last_time == 2.5 * hour
+
+
+def test_permanent_disabled():
+  permanent, last_time = permanent_checkpoints([10., 1e6], 0, start_time=0.)
+  assert permanent == []
+  assert last_time == 0.
+
+
+def test_permanent_counts_from_oldest_adopted_checkpoint():
+  # Adopted checkpoints count from the oldest of them, which itself is not
+  # permanent
+  hour = 3600.
+  times = [5 * hour, 5.5 * hour, 6.2 * hour]
+  permanent, last_time = permanent_checkpoints(times, 1, start_time=times[0])
+  assert permanent == [2]
+  assert last_time == 6.2 * hour
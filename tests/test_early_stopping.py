@@ -0,0 +1,99 @@
+"""
+License: Apache 2.0
+
+Tests of early stopping and of the median pruning of sweep runs.
+"""
+
+import pytest
+
+from early_stopping import EarlyStopping, MedianPruner
+
+
+def test_early_stopping_accuracy():
+  stopper = EarlyStopping(patience=2, higher_is_better=True)
+  assert not stopper.update(0.5)
+  assert not stopper.update(0.6)
+  assert not stopper.update(0.55)
+  assert stopper.update(0.6)
+  assert stopper.best == 0.6
+
+
+def test_early_stopping_loss():
+  stopper = EarlyStopping(patience=1, higher_is_better=False)
+  assert not stopper.update(1.0)
+  assert not stopper.update(0.8)
+  assert stopper.update(0.9)
+
+
+def test_early_stopping_improvement_resets_patience():
+  stopper = EarlyStopping(patience=2)
+  for value in [0.1, 0.1, 0.2, 0.2, 0.3]:
+    assert not stopper.update(value)
+  assert stopper.evaluations_since_best == 0
+
+
+def test_early_stopping_min_delta():
+  stopper = EarlyStopping(patience=2, min_delta=0.01)
+  assert not stopper.update(0.5)
+  assert not stopper.update(0.505)
+  assert stopper.update(0.509)
+  assert stopper.best == 0.5
+
+
+@pytest.fixture
+def db_path(tmp_path):
+  return str(tmp_path / 'pruning.sqlite')
+
+
+def _pruner(db_path, run, higher_is_better=True, warmup_evaluations=1,
+            min_runs=2):
+  return MedianPruner(db_path, 'study', run, higher_is_better,
+                      warmup_evaluations, min_runs)
+
+
+def test_median_pruner_prunes_below_median(db_path):
+  others = [_pruner(db_path, 'run{}'.format(i)) for i in range(3)]
+  for pruner, value in zip(others, [0.6, 0.7, 0.8]):
+    assert not pruner.report(100, value)
+  assert _pruner(db_path, 'bad').report(100, 0.5)
+  assert not _pruner(db_path, 'good').report(100, 0.75)
+
+
+def test_median_pruner_compares_best_so_far(db_path):
+  for i, value in enumerate([0.6, 0.7, 0.8]):
+    _pruner(db_path, 'run{}'.format(i)).report(200, value)
+  pruner = _pruner(db_path, 'run')
+  assert not pruner.report(100, 0.9)
+  # Its best value so far, 0.9, is above the median at step 200
+  assert not pruner.report(200, 0.1)
+
+
+def test_median_pruner_lower_is_better(db_path):
+  for i, value in enumerate([1.0, 2.0, 3.0]):
+    _pruner(db_path, 'run{}'.format(i), higher_is_better=False).report(
+        100, value)
+  assert _pruner(db_path, 'bad', higher_is_better=False).report(100, 2.5)
+  assert not _pruner(db_path, 'good', higher_is_better=False).report(100, 1.5)
+
+
+def test_median_pruner_needs_min_runs_at_the_step(db_path):
+  _pruner(db_path, 'run0').report(100, 0.9)
+  # Only one other run, and the other runs have not reached step 200
+  assert not _pruner(db_path, 'run1').report(100, 0.1)
+  _pruner(db_path, 'run2').report(100, 0.9)
+  assert not _pruner(db_path, 'late').report(200, 0.1)
+
+
+def test_median_pruner_warmup(db_path):
+  for i in range(3):
+    _pruner(db_path, 'run{}'.format(i)).report(100, 0.9)
+  pruner = _pruner(db_path, 'run', warmup_evaluations=2)
+  assert not pruner.report(100, 0.1)
+  assert pruner.report(100, 0.1)
+
+
+def test_median_pruner_studies_are_separate(db_path):
+  for i in range(3):
+    MedianPruner(db_path, 'other', 'run{}'.format(i), True, 1, 2).report(
+        100, 0.9)
+  assert not _pruner(db_path, 'run').report(100, 0.1)
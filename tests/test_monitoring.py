@@ -0,0 +1,25 @@
+"""
+License: Apache 2.0
+
+Tests of the grouping of traced ops by layer scope.
+"""
+
+import pytest
+
+from monitoring import _layer_scope
+
+
+@pytest.mark.parametrize('node_name, expected', [
+    ('tower_0/lyr.conv_caps1/routing/m_step/sub',
+     ('lyr.conv_caps1/routing', False)),
+    ('tower_1/lyr.conv_caps1/routing/m_step/sub:0',
+     ('lyr.conv_caps1/routing', False)),
+    ('tower_0/gradients/tower_0/lyr.conv_caps1/routing/m_step/sub_grad/Mul',
+     ('lyr.conv_caps1/routing', True)),
+    ('tower_1/gradients_1/tower_1/lyr.class_caps/votes_grad/MatMul',
+     ('lyr.class_caps/votes_grad', True)),
+    ('gradients/AddN_3', ('(top level)', True)),
+    ('tower_0/total_loss', ('(top level)', False)),
+])
+def test_layer_scope(node_name, expected):
+  assert _layer_scope(node_name) == expected
@@ -0,0 +1,50 @@
+"""
+License: Apache 2.0
+
+Tests of the class subsets of the npy input backend.
+"""
+
+import numpy as np
+import pytest
+
+try:
+  from data_pipelines import npy
+except (ImportError, AttributeError):
+  # config.py defines its flags with the TensorFlow 1.x API
+  pytest.skip('data_pipelines.npy needs the TensorFlow 1.x of '
+              'requirements.txt', allow_module_level=True)
+
+
+def test_all_classes():
+  assert npy.parse_class_subset('', 0) is None
+
+
+def test_first_classes():
+  assert npy.parse_class_subset('', 3) == [0, 1, 2]
+
+
+def test_classes_and_ranges_in_the_order_listed():
+  assert npy.parse_class_subset('7, 2-4,0') == [7, 2, 3, 4, 0]
+
+
+def test_repeated_classes_are_listed_once():
+  assert npy.parse_class_subset('1-3,2,3-5') == [1, 2, 3, 4, 5]
+
+
+@pytest.mark.parametrize('classes, first_classes', [
+    ('1,2', 2), ('a', 0), ('5-3', 0), ('1,,2', 0), ('', -1)])
+def test_invalid_subsets(classes, first_classes):
+  with pytest.raises(ValueError):
+    npy.parse_class_subset(classes, first_classes)
+
+
+def test_label_map_remaps_to_the_order_listed():
+  label_map = npy._label_map([7, 2, 4])
+  assert label_map[[7, 2, 4]].tolist() == [0, 1, 2]
+  assert label_map[[0, 3]].tolist() == [-1, -1]
+
+
+def test_subset_indices():
+  arrays = {'label': np.array([0, 3, 1, 3, 2, 0])}
+  assert npy._subset_indices(arrays, None).tolist() == list(range(6))
+  assert npy._subset_indices(arrays, [3, 0]).tolist() == [0, 1, 3, 5]
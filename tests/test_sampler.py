@@ -0,0 +1,193 @@
+"""
+License: Apache 2.0
+
+Tests of the epoch arithmetic of the training sampler: where a resumed
+stream starts, the pool of each epoch of a curriculum, and the shares of the
+workers, and of the index streams built from an index file.
+"""
+
+import random
+
+import numpy as np
+import pytest
+import tensorflow as tf
+
+from data_pipelines.sampler import (_epoch_sizes, _locate, _shard,
+                                    balanced_index_dataset, index_dataset,
+                                    write_index_file)
+
+# The index streams are built with the TensorFlow 1.x API
+requires_tf1 = pytest.mark.skipif(
+    not hasattr(tf, 'contrib'),
+    reason='the index streams need the TensorFlow 1.x of requirements.txt')
+
+
+def _stream_positions(epoch_sizes, length):
+  """(epoch, position) of each of the first length indices of a stream."""
+  positions = []
+  epoch = 0
+  while len(positions) < length:
+    size = epoch_sizes[min(epoch, len(epoch_sizes) - 1)]
+    positions.extend((epoch, i) for i in range(size))
+    epoch += 1
+  return positions[:length]
+
+
+def test_locate_without_pacing():
+  assert _locate(0, [5]) == (0, 0)
+  assert _locate(4, [5]) == (0, 4)
+  assert _locate(5, [5]) == (1, 0)
+  assert _locate(12, [5]) == (2, 2)
+
+
+def test_locate_with_pacing():
+  sizes = [2, 4, 10]
+  assert _locate(0, sizes) == (0, 0)
+  assert _locate(1, sizes) == (0, 1)
+  # First index of each epoch
+  assert _locate(2, sizes) == (1, 0)
+  assert _locate(6, sizes) == (2, 0)
+  assert _locate(16, sizes) == (3, 0)
+  assert _locate(26, sizes) == (4, 0)
+  # Within the repeating epochs
+  assert _locate(27, sizes) == (4, 1)
+
+
+@pytest.mark.parametrize('epoch_sizes', [[7], [1, 3, 7], [3, 3, 5, 7]])
+def test_locate_matches_the_stream(epoch_sizes):
+  positions = _stream_positions(epoch_sizes, 100)
+  for start, position in enumerate(positions):
+    assert _locate(start, epoch_sizes) == position
+
+
+def test_epoch_sizes_without_pacing():
+  assert _epoch_sizes(103, 4) == ([103], [25])
+
+
+def test_epoch_sizes_with_pacing():
+  pool_sizes, per_worker = _epoch_sizes(1000, 4, [0.25, 0.5, 0.75])
+  assert pool_sizes == [250, 500, 750, 1000]
+  assert per_worker == [62, 125, 187, 250]
+
+
+def test_epoch_sizes_pool_has_one_index_per_worker():
+  pool_sizes, per_worker = _epoch_sizes(100, 8, [0.01])
+  assert pool_sizes[0] == 8 and per_worker[0] == 1
+  # But never more than the indices of the file
+  pool_sizes, per_worker = _epoch_sizes(5, 8, [0.01])
+  assert pool_sizes == [5, 5] and per_worker == [0, 0]
+
+
+@pytest.mark.parametrize('num_indices, num_workers', [
+    (100, 1), (100, 3), (101, 4), (7, 7), (1000, 16)])
+def test_shards_are_disjoint_and_equal(num_indices, num_workers):
+  order = list(range(num_indices))
+  random.Random(num_indices).shuffle(order)
+  _, per_worker = _epoch_sizes(num_indices, num_workers)
+  shards = [_shard(order, w, num_workers, per_worker[-1])
+            for w in range(num_workers)]
+  assert all(len(s) == per_worker[-1] for s in shards)
+  seen = [i for s in shards for i in s]
+  assert len(set(seen)) == len(seen)
+  assert set(seen) <= set(order)
+  # At most num_workers - 1 indices are left out of an epoch
+  assert num_indices - len(seen) < num_workers
+
+
+def test_shards_of_a_curriculum_epoch_stay_in_its_pool():
+  num_indices, num_workers = 1000, 3
+  pool_sizes, per_worker = _epoch_sizes(num_indices, num_workers, [0.2])
+  pool = list(range(pool_sizes[0]))
+  random.Random(0).shuffle(pool)
+  shards = [_shard(pool, w, num_workers, per_worker[0])
+            for w in range(num_workers)]
+  seen = [i for s in shards for i in s]
+  assert len(set(seen)) == len(seen) == num_workers * per_worker[0]
+  assert max(seen) < pool_sizes[0]
+
+
+def test_resumed_workers_continue_their_shards():
+  # A worker resumed at any position continues with the indices it would
+  # have seen next, and never with those of another worker
+  num_indices, num_workers = 50, 4
+  pool_sizes, per_worker = _epoch_sizes(num_indices, num_workers, [0.5])
+  orders = []
+  for epoch in range(4):
+    pool = list(range(pool_sizes[min(epoch, len(pool_sizes) - 1)]))
+    random.Random(epoch).shuffle(pool)
+    orders.append(pool)
+
+  def stream(worker_index, start):
+    epoch, skip = _locate(start, per_worker)
+    out = []
+    while epoch < len(orders):
+      e = min(epoch, len(per_worker) - 1)
+      out.extend(_shard(orders[epoch], worker_index, num_workers,
+                        per_worker[e]))
+      epoch += 1
+    return out[skip:]
+
+  for w in range(num_workers):
+    full = stream(w, 0)
+    for start in range(len(full)):
+      assert stream(w, start) == full[start:]
+  for epoch, order in enumerate(orders):
+    e = min(epoch, len(per_worker) - 1)
+    shards = [set(_shard(order, w, num_workers, per_worker[e]))
+              for w in range(num_workers)]
+    assert sum(len(s) for s in shards) == len(set.union(*shards))
+
+
+@pytest.fixture
+def index_file(tmp_path):
+  # 40 example indices, grouped by class: 10, 20 and 10 examples
+  path = str(tmp_path / 'train.npy')
+  write_index_file(path, np.arange(100, 140))
+  return path
+
+
+def _take(make_dataset, n):
+  """First n indices of the dataset built by make_dataset."""
+  with tf.Graph().as_default():
+    next_index = make_dataset().make_one_shot_iterator().get_next()
+    with tf.Session() as sess:
+      return [int(sess.run(next_index)) for _ in range(n)]
+
+
+@requires_tf1
+@pytest.mark.parametrize('pacing', [None, [0.5]])
+def test_resumed_index_dataset_continues_its_shard(index_file, pacing):
+  num_workers, length = 3, 60
+  firsts = []
+  for w in range(num_workers):
+    full = _take(lambda: index_dataset(
+        index_file, 7, worker_index=w, num_workers=num_workers,
+        pacing=pacing), length)
+    for start in [1, 6, 13, 29]:
+      resumed = _take(lambda: index_dataset(
+          index_file, 7, worker_index=w, num_workers=num_workers,
+          start=start, pacing=pacing), length - start)
+      assert resumed == full[start:]
+    _, per_worker = _epoch_sizes(40, num_workers, pacing)
+    firsts.append(set(full[:per_worker[0]]))
+  # The workers share the first epoch without overlap
+  assert sum(len(f) for f in firsts) == len(set.union(*firsts))
+
+
+@requires_tf1
+def test_resumed_balanced_index_dataset_continues_its_stream(index_file):
+  num_workers, length = 2, 60
+  streams = []
+  for w in range(num_workers):
+    full = _take(lambda: balanced_index_dataset(
+        index_file, [10, 20, 10], 7, worker_index=w,
+        num_workers=num_workers), length)
+    for start in [1, 19, 20, 45]:
+      resumed = _take(lambda: balanced_index_dataset(
+          index_file, [10, 20, 10], 7, worker_index=w,
+          num_workers=num_workers, start=start), length - start)
+      assert resumed == full[start:]
+    assert set(full) <= set(range(100, 140))
+    streams.append(full)
+  # Each worker draws with its own seed
+  assert streams[0] != streams[1]
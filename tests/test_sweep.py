@@ -0,0 +1,131 @@
+"""
+License: Apache 2.0
+
+Tests of the grid expansion, cache warm-up and packing of sweep.py.
+"""
+
+import os
+
+import pytest
+
+from sweep import (Run, cache_warmups, expand_grid, flag_args, measure_runs,
+                   place_runs)
+
+
+def test_expand_grid_cartesian_product():
+  runs = expand_grid({'dataset': 'smallNORB', 'epoch': 5},
+                     {'dropout': [True, False], 'lrn_rate': [3e-3, 1e-3]})
+  assert len(runs) == 4
+  flags = [f for _, f in runs]
+  assert {(f['dropout'], f['lrn_rate']) for f in flags} == {
+      (True, 3e-3), (True, 1e-3), (False, 3e-3), (False, 1e-3)}
+  for f in flags:
+    assert f['dataset'] == 'smallNORB' and f['epoch'] == 5
+
+
+def test_expand_grid_names_are_unique_and_sorted_by_flag():
+  runs = expand_grid({}, {'lrn_rate': [3e-3, 1e-3], 'dropout': [True]})
+  names = [n for n, _ in runs]
+  assert names == ['dropout=True_lrn_rate=0.003',
+                   'dropout=True_lrn_rate=0.001']
+  assert len(set(names)) == len(names)
+
+
+def test_expand_grid_swept_flags_override_base():
+  runs = expand_grid({'batch_size': 32}, {'batch_size': [16, 64]})
+  assert [f['batch_size'] for _, f in runs] == [16, 64]
+
+
+def test_expand_grid_does_not_modify_base():
+  base = {'epoch': 5}
+  expand_grid(base, {'epoch': [1, 2]})
+  assert base == {'epoch': 5}
+
+
+def test_expand_grid_empty_grid_is_one_base_run():
+  assert expand_grid({'epoch': 5}, {}) == [('base', {'epoch': 5})]
+
+
+def test_expand_grid_names_are_safe_directory_names():
+  runs = expand_grid({}, {'dataset': ['a/b c']})
+  assert runs[0][0] == 'dataset=abc'
+
+
+def test_flag_args():
+  assert flag_args({'epoch': 5, 'dropout': False}) == [
+      '--dropout=False', '--epoch=5']
+
+
+def test_cache_warmups_one_per_cache():
+  runs = [{'dataset': 'mnist', 'lrn_rate': 1e-3},
+          {'dataset': 'mnist', 'lrn_rate': 3e-3},
+          {'dataset': 'mnist', 'device_augment': True},
+          {'dataset': 'cifar10'},
+          {'dataset': 'svhn', 'input_cache': 'memory'}]
+  assert cache_warmups(runs) == [runs[0], runs[2], runs[3]]
+
+
+class _Run(Run):
+  """Run that is placed without starting a process."""
+
+  def start(self, device, reserved_mb):
+    self.device = device
+    self.reserved_mb = reserved_mb
+
+
+@pytest.fixture
+def runs(tmp_path):
+  out_dir = str(tmp_path / 'sweep')
+  return [_Run('run{}'.format(i), {'dataset': 'mnist',
+                                   'storage': str(tmp_path)},
+               'sweep', out_dir) for i in range(4)]
+
+
+def _write_telemetry(run, peaks_mb):
+  train_dir = os.path.join(run.storage, 'logs', 'mnist', run.flags['logdir'],
+                           '20200101_00:00:00:000000_' + run.name, 'train')
+  os.makedirs(train_dir)
+  with open(os.path.join(train_dir, 'telemetry.csv'), 'w') as f:
+    f.write('step,wall_time,max_gpu_bytes\n')
+    for step, mb in enumerate(peaks_mb):
+      f.write('{},{},{}\n'.format(step, step, int(mb * 2 ** 20)))
+
+
+def test_runs_share_the_sweep_input_cache(runs, tmp_path):
+  assert {r.flags['input_cache'] for r in runs} == {
+      os.path.join(str(tmp_path / 'sweep'), 'input_cache')}
+
+
+def test_packing_by_measured_memory(runs):
+  pending = list(runs)
+  running = []
+  capacity_mb = {'0': 10000., '1': 5000.}
+  place_runs(pending, running, ['0', '1'], capacity_mb, 4000., 4)
+  # Until their peaks are measured, runs reserve run_memory_mb, which leaves
+  # no room for the last run
+  assert [r.device for r in running] == ['0', '0', '1']
+  assert pending == runs[3:]
+
+  # The measured peak of the first run, 1000MB, frees room for the last run
+  # on its GPU
+  _write_telemetry(runs[0], [800, 1000])
+  _write_telemetry(runs[2], [])
+  measure_runs(running)
+  assert runs[0].measured and runs[0].reserved_mb == pytest.approx(1200.)
+  assert not runs[2].measured and runs[2].reserved_mb == 4000.
+  place_runs(pending, running, ['0', '1'], capacity_mb, 4000., 4)
+  assert not pending and runs[3].device == '0'
+
+
+def test_packing_limits_runs_per_device(runs):
+  pending = list(runs)
+  running = []
+  place_runs(pending, running, ['0'], {'0': 100000.}, 4000., 2)
+  assert len(running) == 2 and len(pending) == 2
+
+
+def test_packing_starts_one_run_on_an_empty_device(runs):
+  pending = list(runs)
+  running = []
+  place_runs(pending, running, ['0'], {'0': 1000.}, 4000., 4)
+  assert len(running) == 1
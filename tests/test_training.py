@@ -0,0 +1,104 @@
+"""
+License: Apache 2.0
+
+Tests of the training periods of training.Period, and of the restore of the
+moving averages of the weights.
+"""
+
+import pytest
+
+from training import Period, _parse_period, moving_average_restore_map
+
+
+@pytest.mark.parametrize('spec, expected', [
+    ('100steps', (100., 'step')),
+    ('1step', (1., 'step')),
+    ('1epochs', (1., 'epoch')),
+    ('100epochs', (100., 'epoch')),
+    ('2.5epochs', (2.5, 'epoch')),
+    ('.5epoch', (0.5, 'epoch')),
+    ('1e6examples', (1e6, 'example')),
+    ('2.5E+3examples', (2500., 'example')),
+    ('1e-1epochs', (0.1, 'epoch')),
+    ('30min', (30., 'min')),
+    ('30mins', (30., 'min')),
+    ('1.5e1min', (15., 'min')),
+    ('12h', (12., 'h')),
+    ('2hours', (2., 'h')),
+    (' 3 steps ', (3., 'step')),
+])
+def test_parse_period(spec, expected):
+  assert _parse_period(spec) == expected
+
+
+@pytest.mark.parametrize('spec', ['steps', '10', '1e6', '1.2.3steps',
+                                  '-5steps', '10fortnights', '1e'])
+def test_parse_period_rejects(spec):
+  with pytest.raises(ValueError):
+    _parse_period(spec)
+
+
+def test_period_steps():
+  period = Period('100steps', batch_size=32, steps_per_epoch=1000)
+  assert period.steps == 100
+  assert period.due(200) and not period.due(150)
+  assert not period.exhausted(100) and period.exhausted(101)
+
+
+def test_period_epochs():
+  assert Period('1epochs', 32, 1000).steps == 1000
+  assert Period('2.5epochs', 32, 1000).steps == 2500
+  assert Period('{}epochs'.format(100), 32, 1000).steps == 100000
+
+
+def test_period_examples():
+  assert Period('1e6examples', 100, 1000).steps == 10000
+  assert Period('3.2e1examples', 32, 1000).steps == 1
+  # At least one step
+  assert Period('1examples', 32, 1000).steps == 1
+
+
+def test_period_time():
+  period = Period('1.5e1min', 32, 1000)
+  assert period.steps is None
+  assert period.seconds == 900
+  assert Period('2h', 32, 1000).seconds == 7200
+  assert not period.exhausted(10 ** 9)
+
+
+class _Variable(object):
+
+  def __init__(self, name):
+    self.op = type('Op', (object,), {'name': name})()
+
+
+class _Ema(object):
+
+  def average_name(self, v):
+    return v.op.name + '/ExponentialMovingAverage'
+
+
+class _Reader(object):
+
+  def __init__(self, names):
+    self.names = set(names)
+
+  def has_tensor(self, name):
+    return name in self.names
+
+
+def test_moving_average_restore_map():
+  # Averages of the conv weights are restored even where the variable is not
+  # trainable, the others from the weights themselves
+  conv = _Variable('conv1/weights')
+  caps = _Variable('class_caps/w')
+  bn_mean = _Variable('conv1/BatchNorm/moving_mean')
+  reader = _Reader(['conv1/weights', 'conv1/weights/ExponentialMovingAverage',
+                    'class_caps/w', 'class_caps/w/ExponentialMovingAverage',
+                    'conv1/BatchNorm/moving_mean'])
+  var_map, averaged = moving_average_restore_map(
+      _Ema(), [conv, caps, bn_mean], reader)
+  assert var_map == {'conv1/weights/ExponentialMovingAverage': conv,
+                     'class_caps/w/ExponentialMovingAverage': caps,
+                     'conv1/BatchNorm/moving_mean': bn_mean}
+  assert averaged == [conv, caps]
@@ -19,8 +19,15 @@ import re   # for regular expressions
 from config import FLAGS
 import config as conf
 import models as mod
+import model_runtime as rt
 import metrics as met
 import utils as utl
+import training as trn
+import monitoring as mon
+import checkpoints as ckp
+import early_stopping as es
+import optimizers as optim
+from data_pipelines import common as data_common
 
 # Get logger that has already been created in config.py
 import daiquiri
@@ -30,12 +37,8 @@ logger = daiquiri.getLogger(__name__)
 def main(args):
   """Run training and validation.
   
-  1. Build graphs
-      1.1 Training graph to run on multiple GPUs
-      1.2 Validation graph to run on multiple GPUs
-  2. Configure sessions
-      2.1 Train
-      2.2 Validate
+  1. Build graph to train and validate on multiple GPUs
+  2. Configure session
   3. Main loop
       3.1 Train
       3.2 Write summary
@@ -64,19 +67,47 @@ def main(args):
   dataset_size_val  = conf.get_dataset_size_validate(FLAGS.dataset)
   build_arch      = conf.get_dataset_architecture(FLAGS.dataset)
   num_classes     = conf.get_num_classes(FLAGS.dataset)
-  create_inputs_train = conf.get_create_inputs(FLAGS.dataset, mode="train")
-  create_inputs_train_wholeset = conf.get_create_inputs(FLAGS.dataset, mode="train_whole")
+  # Pipelines whose position is not saved with checkpoints start where the
+  # run they resume from stopped
+  resume_step = latest_step(FLAGS.load_dir) if FLAGS.load_dir else 0
+  input_fn_train = conf.get_input_fn(FLAGS.dataset, mode="train",
+                                     start_step=resume_step)
+  input_fn_train_wholeset = conf.get_input_fn(FLAGS.dataset, mode="train_whole")
   if dataset_size_val > 0:
-    create_inputs_val   = conf.get_create_inputs(FLAGS.dataset, mode="validate")
+    input_fn_val   = conf.get_input_fn(FLAGS.dataset, mode="validate")
+
+  if FLAGS.input_benchmark:
+    images_per_sec = data_common.benchmark(input_fn_train,
+                                           FLAGS.benchmark_steps)
+    logger.info('Training input pipeline of {}: {:.1f} images/sec'.format(
+        FLAGS.dataset, images_per_sec))
+    return
+
+  if FLAGS.input_warmup:
+    # Fill the input_cache files, so that the runs of a sweep that share them
+    # only read them, see sweep.py
+    warmup = [(input_fn_train, dataset_size_train // FLAGS.num_workers),
+              (input_fn_train_wholeset, dataset_size_train)]
+    if dataset_size_val > 0:
+      warmup.append((input_fn_val, dataset_size_val))
+    for input_fn, num_examples in warmup:
+      data_common.fill_cache(input_fn, num_examples // FLAGS.batch_size + 2)
+    logger.info('Input cache of {} written to {}'.format(
+        FLAGS.dataset, FLAGS.input_cache))
+    return
 
   
  #*****************************************************************************
- # 1. BUILD GRAPHS
+ # 1. BUILD GRAPH
  #*****************************************************************************
 
   #----------------------------------------------------------------------------
-  # GRAPH - TRAIN
+  # GRAPH - TRAIN AND EVALUATE
   #----------------------------------------------------------------------------
+  # A single graph is used for training and for evaluation on the whole
+  # training set and the validation set, so the capsule stack is built once
+  # per tower. The input is switched by feeding the handle of another
+  # iterator, and the model by feeding is_train=False
   logger.info('BUILD TRAIN GRAPH')
   g_train = tf.Graph()
   with g_train.as_default(), tf.device('/cpu:0'):
@@ -84,25 +115,64 @@ def main(args):
     # Get global_step
     global_step = tf.train.get_or_create_global_step()
 
-    # Get batches per epoch
-    num_batches_per_epoch = int(dataset_size_train / FLAGS.batch_size)
-
-    # In response to a question on OpenReview, Hinton et al. wrote the 
-    # following:
-    # "We use an exponential decay with learning rate: 3e-3, decay_steps: 20000,     # decay rate: 0.96."
-    # https://openreview.net/forum?id=HJWLfGWRb&noteId=ryxTPFDe2X
-    lrn_rate = tf.train.exponential_decay(learning_rate = FLAGS.lrn_rate, 
-                        global_step = global_step, 
-                        decay_steps = 20000, 
-                        decay_rate = 0.96)
+    # Get batches per epoch, each worker reads its shard of the training set
+    num_batches_per_epoch = int(
+        dataset_size_train / (FLAGS.batch_size * FLAGS.num_workers))
+    if dataset_size_val > 0:
+      num_batches_val = int(dataset_size_val / FLAGS.batch_size)
+
+    # Length of the run, FLAGS.epoch epochs unless a budget in steps,
+    # examples or wall-clock time is given
+    budget = trn.Period(FLAGS.train_budget or '{}epochs'.format(FLAGS.epoch),
+                        FLAGS.batch_size, num_batches_per_epoch)
+    if budget.steps is not None:
+      total_steps = budget.steps
+    else:
+      # The number of steps in a wall-clock budget is not known in advance,
+      # so the cosine schedule decays over FLAGS.epoch epochs
+      total_steps = FLAGS.epoch * num_batches_per_epoch
+
+    # Learning rate schedule and optimiser, by default the exponential decay
+    # and Adam used by Hinton et al.
+    # The schedule counts optimiser updates, so the run is
+    # num_batches_per_epoch / accumulate_steps updates per epoch, each on an
+    # effective batch of batch_size * accumulate_steps
+    lrn_rate = optim.learning_rate_schedule(
+        global_step,
+        FLAGS.lrn_rate,
+        schedule=FLAGS.lr_schedule,
+        warmup_steps=FLAGS.lr_warmup_steps,
+        total_steps=total_steps // FLAGS.accumulate_steps,
+        batch_size=FLAGS.batch_size * FLAGS.accumulate_steps,
+        reference_batch_size=FLAGS.lr_reference_batch_size,
+        batch_scaling=FLAGS.lr_batch_scaling)
     tf.summary.scalar('learning_rate', lrn_rate)
-    opt = tf.train.AdamOptimizer(learning_rate=lrn_rate)
+    opt = optim.get_optimizer(FLAGS.optimizer, lrn_rate,
+                                momentum=FLAGS.momentum,
+                                trust_coefficient=FLAGS.trust_coefficient)
 
     # Get batch from data queue. Batch size is FLAGS.batch_size, which is then 
     # divided across multiple GPUs
-    input_dict = create_inputs_train()
+    # Training reads from the train iterator by default, evaluation feeds the
+    # handle of the train_whole or validate iterator
+    datasets = {'train': input_fn_train(),
+                'train_whole': input_fn_train_wholeset()}
+    if dataset_size_val > 0:
+      datasets['validate'] = input_fn_val()
+    input_dict, iterator_handle, iterators = data_common.get_next_switchable(
+        datasets, 'train', saveable=conf.input_state_saveable())
+    eval_handles = {name: iterators[name].string_handle()
+                    for name in datasets if name != 'train'}
     batch_x = input_dict['image']
     batch_labels = input_dict['label']
+
+    # Switches batch norm, dropout and the reconstruction mask to evaluation
+    is_train = tf.placeholder_with_default(True, shape=[], name='is_train')
+
+    # Telemetry: time each step waits on the input pipeline, and memory
+    # high-water mark of each GPU
+    input_wait = mon.input_wait_time([batch_x, batch_labels])
+    max_gpu_bytes = mon.max_bytes_in_use(FLAGS.num_gpus)
     
     # AG 03/10/2018: Split batch for multi gpu implementation
     # Each split is of size FLAGS.batch_size / FLAGS.num_gpus
@@ -133,14 +203,16 @@ def main(args):
           #with slim.arg_scope([slim.model_variable, slim.variable],
           # device='/cpu:0'):
           with slim.arg_scope([slim.variable], device='/cpu:0'):
-            loss, logits = tower_fn(
-                build_arch, 
-                splits_x[i], 
-                splits_labels[i], 
-                scope, 
-                num_classes, 
-                reuse_variables=reuse_variables,
-                is_train=True)
+            with conf.tower_jit_scope():
+              loss, output = rt.tower_fn(
+                  build_arch,
+                  splits_x[i],
+                  splits_labels[i],
+                  scope,
+                  num_classes,
+                  reuse_variables=reuse_variables,
+                  is_train=is_train)
+              logits = output['scores']
           
           # Don't reuse variable for first GPU, but do reuse for others
           reuse_variables = True
@@ -161,18 +233,29 @@ def main(args):
     # We must calculate the mean of each gradient. Note that this is the
     # synchronization point across all towers.
     grad = average_gradients(tower_grads)
-    
-    # See: https://stackoverflow.com/questions/40701712/how-to-check-nan-in-
-    # gradients-in-tensorflow-when-updating
-    grad_check = ([tf.check_numerics(g, message='Gradient NaN Found!') 
-                      for g, _ in grad if g is not None] 
-                  + [tf.check_numerics(loss, message='Loss NaN Found')])
-    
-    # Apply the gradients to adjust the shared variables
-    with tf.control_dependencies(grad_check):
-      update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
-      with tf.control_dependencies(update_ops):
-        train_op = opt.apply_gradients(grad, global_step=global_step)
+
+    # Exponential moving average of the weights (including the EM routing
+    # costs beta_a and beta_v), updated after every optimiser update. The
+    # averages are global variables, so they are saved with the checkpoints
+    ema = None
+    if FLAGS.ema_decay > 0:
+      ema = tf.train.ExponentialMovingAverage(FLAGS.ema_decay,
+                                              num_updates=global_step)
+
+    # Accumulate gradients over FLAGS.accumulate_steps micro-batches, so that
+    # each update (and each increment of global_step) sees an effective batch
+    # of FLAGS.batch_size * FLAGS.accumulate_steps, and apply them unless
+    # they are not finite
+    train_ops = trn.build_train_op(
+        opt, grad, tf.add_n(tower_losses), global_step,
+        update_ops=tf.get_collection(tf.GraphKeys.UPDATE_OPS),
+        accumulate_steps=FLAGS.accumulate_steps,
+        ema=ema, ema_var_list=tf.trainable_variables())
+    train_op, accum_op = train_ops.train_op, train_ops.accum_op
+    skipped_steps = train_ops.skipped_steps
+    if FLAGS.ema_decay > 0:
+      use_average, use_weights = trn.moving_average_swap(
+          ema, tf.trainable_variables())
     
     # Calculate mean loss     
     loss = tf.reduce_mean(tower_losses)
@@ -193,7 +276,18 @@ def main(args):
              'logits' : logits,
              'probs' : probs,
              'acc' : acc,
+             'skipped_steps' : skipped_steps,
              }
+
+    # Only the scalar metrics are fetched in the main loop, and only on
+    # summary steps
+    trn_scalars = {k: trn_metrics[k] for k in ['loss', 'acc', 'skipped_steps']}
+
+    # Metrics for evaluation on the whole training set and validation set,
+    # fetched with is_train=False
+    eval_metrics = {'loss' : mod.spread_loss(logits, batch_labels),
+                    'acc' : acc,
+                    }
     
     # Reset and read operations for streaming metrics go here
     trn_reset = {}
@@ -206,8 +300,29 @@ def main(args):
     # Set Saver
     # AG 26/09/2018: Save all variables including Adam so that we can continue 
     # training from where we left off
-    # max_to_keep=None should keep all checkpoints
-    saver = tf.train.Saver(tf.global_variables(), max_to_keep=None)
+    # The state of the input iterator is saved too, so that a resumed run
+    # continues from the same position in the epoch
+    saver_train = tf.train.Saver(
+        tf.global_variables()
+        + tf.get_collection(tf.GraphKeys.SAVEABLE_OBJECTS),
+        max_to_keep=None)
+
+    # Checkpoints are written by a manager that only keeps the last few, the
+    # best on validation, and one every few hours, and writes them from a
+    # snapshot in the background
+    train_checkpoint_dir = train_dir + '/checkpoint'
+    if not os.path.exists(train_checkpoint_dir):
+      os.makedirs(train_checkpoint_dir)
+    ckpt_manager = ckp.CheckpointManager(
+        train_checkpoint_dir,
+        tf.global_variables(),
+        saveables=tf.get_collection(tf.GraphKeys.SAVEABLE_OBJECTS),
+        keep_last=FLAGS.keep_checkpoints,
+        keep_best=FLAGS.keep_best_checkpoints,
+        keep_every_n_hours=FLAGS.keep_checkpoint_every_n_hours,
+        async_save=FLAGS.async_checkpoint,
+        resume_dir=(os.path.join(FLAGS.load_dir, 'train', 'checkpoint')
+                    if FLAGS.load_dir else None))
     
     # Display number of parameters
     train_params = np.sum([np.prod(v.get_shape().as_list())
@@ -216,190 +331,14 @@ def main(args):
         
     # Set summary op
     trn_summary = tf.summary.merge_all()
-
-  #----------------------------------------------------------------------------
-  # GRAPH - TRAINING SET ACCURACY
-  #----------------------------------------------------------------------------
-  logger.info('BUILD TRAINING SET ACCURACY GRAPH')
-  g_trn_acc = tf.Graph()
-  with g_trn_acc.as_default():
-    # Get global_step
-    global_step = tf.train.get_or_create_global_step()
-
-    
-    # Get data
-    input_dict = create_inputs_train_wholeset()
-    batch_x = input_dict['image']
-    batch_labels = input_dict['label']
-    
-    # AG 10/12/2018: Split batch for multi gpu implementation
-    # Each split is of size FLAGS.batch_size / FLAGS.num_gpus
-    # See: https://github.com/naturomics/CapsNet-
-    # Tensorflow/blob/master/dist_version/distributed_train.py
-    splits_x = tf.split(
-        axis=0, 
-        num_or_size_splits=FLAGS.num_gpus, 
-        value=batch_x)
-    splits_labels = tf.split(
-        axis=0, 
-        num_or_size_splits=FLAGS.num_gpus, 
-        value=batch_labels)
-    
-    
-    #--------------------------------------------------------------------------
-    # MULTI GPU - TRAINING SET ACCURACY
-    #--------------------------------------------------------------------------
-    # Calculate the logits for each model tower
-    tower_logits = []
-    reuse_variables = None
-    for i in range(FLAGS.num_gpus):
-      with tf.device('/gpu:%d' % i):
-        with tf.name_scope('tower_%d' % i) as scope:
-          with slim.arg_scope([slim.variable], device='/cpu:0'):
-            loss, logits = tower_fn(
-                build_arch, 
-                splits_x[i], 
-                splits_labels[i], 
-                scope, 
-                num_classes, 
-                reuse_variables=reuse_variables, 
-                is_train=False)
-
-          # Don't reuse variable for first GPU, but do reuse for others
-          reuse_variables = True
-          
-          # Keep track of losses and logits across for each tower
-          tower_logits.append(logits)
-          
-          # Loss for each tower
-          tf.summary.histogram("train_set_logits", logits)
-    
-    # Combine logits from all towers
-    logits = tf.concat(tower_logits, axis=0)
-    
-    # Calculate metrics
-    train_set_loss = mod.spread_loss(logits, batch_labels)
-    train_set_acc = met.accuracy(logits, batch_labels)
-    
-    # Prepare predictions and one-hot labels
-    train_set_probs = tf.nn.softmax(logits=logits)
-    train_set_labels_oh = tf.one_hot(batch_labels, num_classes)
-    
-    # Group metrics together
-    # See: https://cs230-stanford.github.io/tensorflow-model.html
-    train_set_metrics = {'loss' : train_set_loss,
-                   'labels' : batch_labels, 
-                   'labels_oh' : train_set_labels_oh,
-                   'logits' : logits,
-                   'probs' : train_set_probs,
-                   'acc' : train_set_acc,
-                   }
-    
-    # Reset and read operations for streaming metrics go here
-    train_set_reset = {}
-    train_set_read = {}
-    saver = tf.train.Saver(max_to_keep=None)
-    
-    tf.summary.scalar("train_set_loss", train_set_loss)
-    tf.summary.scalar("train_set_acc", train_set_acc)
-    trn_acc_summary = tf.summary.merge_all()
-  
-  if dataset_size_val > 0: 
-    #----------------------------------------------------------------------------
-    # GRAPH - VALIDATION
-    #----------------------------------------------------------------------------
-    logger.info('BUILD VALIDATION GRAPH')
-    g_val = tf.Graph()
-    with g_val.as_default():
-      # Get global_step
-      global_step = tf.train.get_or_create_global_step()
-
-      num_batches_val = int(dataset_size_val / FLAGS.batch_size)
-      
-      # Get data
-      input_dict = create_inputs_val()
-      batch_x = input_dict['image']
-      batch_labels = input_dict['label']
-      
-      # AG 10/12/2018: Split batch for multi gpu implementation
-      # Each split is of size FLAGS.batch_size / FLAGS.num_gpus
-      # See: https://github.com/naturomics/CapsNet-
-      # Tensorflow/blob/master/dist_version/distributed_train.py
-      splits_x = tf.split(
-          axis=0, 
-          num_or_size_splits=FLAGS.num_gpus, 
-          value=batch_x)
-      splits_labels = tf.split(
-          axis=0, 
-          num_or_size_splits=FLAGS.num_gpus, 
-          value=batch_labels)
-      
-      
-      #--------------------------------------------------------------------------
-      # MULTI GPU - VALIDATE
-      #--------------------------------------------------------------------------
-      # Calculate the logits for each model tower
-      tower_logits = []
-      reuse_variables = None
-      for i in range(FLAGS.num_gpus):
-        with tf.device('/gpu:%d' % i):
-          with tf.name_scope('tower_%d' % i) as scope:
-            with slim.arg_scope([slim.variable], device='/cpu:0'):
-              loss, logits = tower_fn(
-                  build_arch, 
-                  splits_x[i], 
-                  splits_labels[i], 
-                  scope, 
-                  num_classes, 
-                  reuse_variables=reuse_variables, 
-                  is_train=False)
-
-            # Don't reuse variable for first GPU, but do reuse for others
-            reuse_variables = True
-            
-            # Keep track of losses and logits across for each tower
-            tower_logits.append(logits)
-            
-            # Loss for each tower
-            tf.summary.histogram("val_logits", logits)
-      
-      # Combine logits from all towers
-      logits = tf.concat(tower_logits, axis=0)
-      
-      # Calculate metrics
-      val_loss = mod.spread_loss(logits, batch_labels)
-      val_acc = met.accuracy(logits, batch_labels)
-      
-      # Prepare predictions and one-hot labels
-      val_probs = tf.nn.softmax(logits=logits)
-      val_labels_oh = tf.one_hot(batch_labels, num_classes)
-      
-      # Group metrics together
-      # See: https://cs230-stanford.github.io/tensorflow-model.html
-      val_metrics = {'loss' : val_loss,
-                     'labels' : batch_labels, 
-                     'labels_oh' : val_labels_oh,
-                     'logits' : logits,
-                     'probs' : val_probs,
-                     'acc' : val_acc,
-                     }
-      
-      # Reset and read operations for streaming metrics go here
-      val_reset = {}
-      val_read = {}
-      
-      tf.summary.scalar("val_loss", val_loss)
-      tf.summary.scalar("val_acc", val_acc)
-        
-      # Saver
-      saver = tf.train.Saver(max_to_keep=None)
-      
-      # Set summary op
-      val_summary = tf.summary.merge_all()
+    # The gradient norm is only written on steps that apply an update, as on
+    # the other steps it would be that of a partial sum
+    grad_summary = tf.summary.merge(
+        tf.get_collection(trn.GRADIENT_SUMMARIES))
        
         
   #****************************************************************************
-  # 2. SESSIONS
+  # 2. SESSION
   #****************************************************************************
           
   #----- SESSION TRAIN -----#
@@ -408,9 +347,7 @@ def main(args):
   #                                              log_device_placement=False),
   #                        graph=g_train)
 
-  # Perry: added in for RTX 2070 incompatibility workaround
-  config = tf.ConfigProto(allow_soft_placement=True, log_device_placement=False)
-  config.gpu_options.allow_growth = True
+  config = conf.get_session_config()
   sess_train = tf.Session(config=config, graph=g_train)
 
   # Debugger
@@ -423,60 +360,86 @@ def main(args):
   with g_train.as_default():
     sess_train.run([tf.global_variables_initializer(),
                     tf.local_variables_initializer()])
+    sess_train.run(tf.get_collection(data_common.ITERATOR_INITIALIZERS))
+    eval_handles = sess_train.run(eval_handles)
     
     # Restore previous checkpoint
     # AG 26/09/2018: where should this go???
     if FLAGS.load_dir is not None:
-      prev_step = load_training(saver, sess_train, FLAGS.load_dir)
+      prev_step = load_training(saver_train, sess_train, FLAGS.load_dir)
     else:
       prev_step = 0
 
-  # Create summary writer, and write the train graph
-  summary_writer = tf.summary.FileWriter(train_summary_dir, 
-                                         graph=sess_train.graph)
-
-
-  #----- SESSION TRAIN SET ACCURACY -----#
-  #sess_val = tf.Session(config=tf.ConfigProto(allow_soft_placement=True,
-  #                                            log_device_placement=False),
-  #                      graph=g_val)
-
-  # Perry: added in for RTX 2070 incompatibility workaround
-  config = tf.ConfigProto(allow_soft_placement=True, log_device_placement=False)
-  config.gpu_options.allow_growth = True
-  sess_train_acc = tf.Session(config=config, graph=g_trn_acc)
-
-  with g_trn_acc.as_default():
-    sess_train_acc.run([tf.local_variables_initializer(), 
-                        tf.global_variables_initializer()])
-
-
-  if dataset_size_val > 0:
-    #----- SESSION VALIDATION -----#
-    #sess_val = tf.Session(config=tf.ConfigProto(allow_soft_placement=True,
-    #                                            log_device_placement=False),
-    #                      graph=g_val)
- 
-    # Perry: added in for RTX 2070 incompatibility workaround
-    config = tf.ConfigProto(allow_soft_placement=True, log_device_placement=False)
-    config.gpu_options.allow_growth = True
-    sess_val = tf.Session(config=config, graph=g_val)
+    # Micro-batches since the start of training, counted from the restored
+    # updates rather than from the step of the checkpoint, so that a resumed
+    # run starts at the beginning of an accumulation cycle
+    if FLAGS.accumulate_steps > 1:
+      sess_train.run(train_ops.reset_accum)
+    micro_step = (int(sess_train.run(train_ops.num_updates))
+                  * FLAGS.accumulate_steps)
 
+  # Create summary writer, and write the train graph
+  # Summaries are written from a background thread to keep the main loop off
+  # the event file
+  summary_writer = mon.AsyncSummaryWriter(train_summary_dir,
+                                          graph=sess_train.graph)
 
-    with g_val.as_default():
-      sess_val.run([tf.local_variables_initializer(), 
-                    tf.global_variables_initializer()])
+  # Per-step telemetry, also written to CSV next to the summaries
+  telemetry = mon.StepTelemetry(
+      os.path.join(train_dir, 'telemetry.csv'), FLAGS.batch_size)
 
 
   #****************************************************************************
   # 3. MAIN LOOP
   #****************************************************************************
-  SUMMARY_FREQ = 100
-  SAVE_MODEL_FREQ = num_batches_per_epoch # 500
-  VAL_FREQ = num_batches_per_epoch # 500
-  PROFILE_FREQ = 5
-  
-  for step in range(prev_step, FLAGS.epoch * num_batches_per_epoch + 1): 
+  # Summaries, checkpoints and evaluation each have their own cadence in
+  # steps, examples, epochs or wall-clock time, so the loop does not depend
+  # on epoch boundaries
+  summary_period = trn.Period(FLAGS.summary_every, FLAGS.batch_size,
+                              num_batches_per_epoch)
+  save_period = trn.Period(FLAGS.save_every, FLAGS.batch_size,
+                           num_batches_per_epoch)
+  eval_period = trn.Period(FLAGS.eval_every, FLAGS.batch_size,
+                           num_batches_per_epoch)
+  budget.restart()
+  logger.info('Train for {}, summaries every {}, checkpoints every {}, '
+              'evaluation every {}'.format(budget.spec, summary_period.spec,
+                                           save_period.spec, eval_period.spec))
+
+  # Trace a bounded window of steps, and then turn profiling off
+  if FLAGS.profile:
+    profiler = mon.TraceWindow(os.path.join(train_dir, 'profile'),
+                               prev_step + FLAGS.profile_start_step,
+                               FLAGS.profile_steps)
+
+  # Stop runs that no longer improve, or that fall behind the other runs of
+  # a sweep
+  higher_is_better = FLAGS.stop_metric == 'acc'
+  early_stopping = None
+  if FLAGS.early_stopping_patience > 0:
+    early_stopping = es.EarlyStopping(FLAGS.early_stopping_patience,
+                                      higher_is_better,
+                                      FLAGS.early_stopping_min_delta)
+  pruner = None
+  if FLAGS.prune_db:
+    pruner = es.MedianPruner(FLAGS.prune_db,
+                             FLAGS.prune_study or FLAGS.logdir,
+                             train_dir,
+                             higher_is_better,
+                             FLAGS.prune_warmup_evaluations,
+                             FLAGS.prune_min_runs)
+  stop_reason = None
+
+  # Most recent checkpoint, its validation accuracy is recorded for retention
+  latest_ckpt = None
+  latest_ckpt_step = None
+
+  # Set when summaries are due, cleared once the gradient norm is written on
+  # the next step that applies an update
+  grad_summary_due = False
+
+  step = prev_step
+  while stop_reason is None and not budget.exhausted(step):
   #for step in range(0,3):
     # AG 23/05/2018: limit number of iterations for testing
     # for step in range(100):
@@ -490,10 +453,8 @@ def main(args):
       with g_train.as_default():
     
           # With profiling
-          if (FLAGS.profile is True) and ((step % PROFILE_FREQ) == 0): 
-            logger.info("Train with Profiling")
-            run_options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
-            run_metadata = tf.RunMetadata()
+          if FLAGS.profile and profiler.active(step):
+            run_options, run_metadata = profiler.run_options(step)
           # Without profiling
           else:
             run_options = None
@@ -504,21 +465,48 @@ def main(args):
             logger.info("Reset streaming metrics")
             sess_train.run([trn_reset])
           
+          # Only apply the update on the last of FLAGS.accumulate_steps
+          # micro-batches, otherwise just accumulate the gradients
+          apply_step = (micro_step % FLAGS.accumulate_steps
+                        == FLAGS.accumulate_steps - 1)
+          step_op = train_op if apply_step else accum_op
+
           # MAIN RUN
+          # Only fetch the train op on most steps, summaries and metrics are
+          # fetched on summary steps only
+          summary_step = summary_period.due(step)
+          fetches = {'step_op': step_op, 'input_wait': input_wait}
+          if summary_step:
+            fetches['metrics'] = trn_scalars
+            fetches['summary'] = trn_summary
+            fetches['max_gpu_bytes'] = max_gpu_bytes
+            grad_summary_due = True
+          if apply_step and grad_summary_due:
+            fetches['grad_summary'] = grad_summary
           tic = time.time()
-          train_op_v, trn_metrics_v, trn_summary_v = sess_train.run(
-              [train_op, trn_metrics, trn_summary], 
-              options=run_options, 
-              run_metadata=run_metadata)
+          fetches_v = sess_train.run(fetches,
+                                     options=run_options,
+                                     run_metadata=run_metadata)
           toc = time.time()
+          micro_step += 1
+          telemetry.record(step, toc - tic, fetches_v['input_wait'],
+                           fetches_v.get('max_gpu_bytes'))
+
+          if summary_step:
+            trn_metrics_v = fetches_v['metrics']
+            trn_summary_v = fetches_v['summary']
+
+            # Read streaming metrics
+            trn_read_v = sess_train.run(trn_read)
+          if 'grad_summary' in fetches_v:
+            summary_writer.add_summary(fetches_v['grad_summary'], step)
+            grad_summary_due = False
           
-          # Read streaming metrics
-          trn_read_v = sess_train.run(trn_read)
-          
-          # Write summary for profiling
+          # Write summary and traces for profiling
           if run_options is not None: 
             summary_writer.add_run_metadata(
-                run_metadata, 'epoch{:f}'.format(epoch_decimal))
+                run_metadata, 'step{:d}'.format(step))
+            profiler.record(step, run_metadata)
           
           # Logging
           #logger.info('TRN'
@@ -530,66 +518,57 @@ def main(args):
           #       )
 
     except KeyboardInterrupt:
+      ckpt_manager.wait()
+      telemetry.close()
+      summary_writer.close()
       sess_train.close()
-      sess_val.close()
       sys.exit()
       
-    except tf.errors.InvalidArgumentError as e:
-      logger.warning('%d iteration contains NaN gradients. Discard.' % step)
-      logger.error(str(e))
-      continue
-      
     else:
       # WRITE SUMMARY
-      if (step % SUMMARY_FREQ) == 0:
+      if summary_step:
         logger.info("Write Train Summary")
         with g_train.as_default():
           # Summaries from graph
           summary_writer.add_summary(trn_summary_v, step)
+
+        logger.info('TRN stp-{:d}'.format(step)
+                    + ' loss: {:.4f}'.format(trn_metrics_v['loss'])
+                    + ' acc: {:.2f}%'.format(trn_metrics_v['acc']*100))
+
+        # Throughput, step time and input stalls since the last summary
+        summary_telemetry = telemetry.summary(
+            step, fetches_v['max_gpu_bytes'])
+        if summary_telemetry is not None:
+          summary_writer.add_summary(summary_telemetry, step)
+        if trn_metrics_v['skipped_steps'] > 0:
+          logger.warning('{} updates skipped due to NaN/Inf gradients so far'
+                         .format(trn_metrics_v['skipped_steps']))
           
       # SAVE MODEL
-      if (step % SAVE_MODEL_FREQ) == 0:
+      if save_period.due(step):
         logger.info("Save Model")
         with g_train.as_default():
-          train_checkpoint_dir = train_dir + '/checkpoint'
-          if not os.path.exists(train_checkpoint_dir):
-            os.makedirs(train_checkpoint_dir)
-
           # Save ckpt from train session
-          ckpt_path = os.path.join(train_checkpoint_dir, 'model.ckpt' + str(epoch))
-          saver.save(sess_train, ckpt_path, global_step=step)
-      if (step % VAL_FREQ) == 0:
-        # calculate metrics every epoch
-        with g_trn_acc.as_default():
+          latest_ckpt = save_checkpoint(
+              ckpt_manager, sess_train, summary_writer,
+              os.path.join(train_checkpoint_dir, 'model.ckpt' + str(epoch)),
+              step)
+          latest_ckpt_step = step
+      if eval_period.due(step):
+        # calculate metrics on the whole train and validation sets
+        with g_train.as_default():
+          # Evaluate the averaged weights, which oscillate much less between
+          # evaluations than the weights themselves
+          if FLAGS.ema_decay > 0:
+            sess_train.run(use_average)
           logger.info("Start Train Set Accuracy")
-          # Restore ckpt to val session
-          latest_ckpt = tf.train.latest_checkpoint(train_checkpoint_dir)
-          saver.restore(sess_train_acc, latest_ckpt)
-          
-          # Reset accumulators
-          accuracy_sum = 0
-          loss_sum = 0
-          sess_train_acc.run(train_set_reset)
-          
-          for i in range(num_batches_per_epoch):
-            train_set_metrics_v, train_set_summary_str_v = sess_train_acc.run(
-                [train_set_metrics, trn_acc_summary])
-            
-            # Update
-            accuracy_sum += train_set_metrics_v['acc']
-            loss_sum += train_set_metrics_v['loss']
-            
-            # Read
-            trn_read_v = sess_train_acc.run(val_read)
-            
-            # Get checkpoint number
-            ckpt_num = re.split('-', latest_ckpt)[-1]
-
-          # Average across batches
-          ave_acc = accuracy_sum / num_batches_per_epoch
-          ave_loss = loss_sum / num_batches_per_epoch
+          ave_acc, ave_loss = evaluate(
+              sess_train, eval_metrics, iterators['train_whole'],
+              {iterator_handle: eval_handles['train_whole'], is_train: False},
+              num_batches_per_epoch)
            
-          logger.info('TRN ckpt-{}'.format(ckpt_num) 
+          logger.info('TRN stp-{}'.format(step)
                       + ' avg_acc: {:.2f}%'.format(ave_acc*100) 
                       + ' avg_loss: {:.4f}'.format(ave_loss)
                      )
@@ -598,49 +577,19 @@ def main(args):
           summary_train = tf.Summary()
           summary_train.value.add(tag="trn_acc", simple_value=ave_acc)
           summary_train.value.add(tag="trn_loss", simple_value=ave_loss)
-          summary_writer.add_summary(summary_train, epoch)
+          summary_writer.add_summary(summary_train, step)
           
 
         if dataset_size_val > 0: 
           #----- Validation -----#
-          with g_val.as_default():
+          with g_train.as_default():
             logger.info("Start Validation")
-            
-            # Restore ckpt to val session
-            latest_ckpt = tf.train.latest_checkpoint(train_checkpoint_dir)
-            saver.restore(sess_val, latest_ckpt)
-            
-            # Reset accumulators
-            accuracy_sum = 0
-            loss_sum = 0
-            sess_val.run(val_reset)
-            
-            for i in range(num_batches_val):
-              val_metrics_v, val_summary_str_v = sess_val.run(
-                  [val_metrics, val_summary])
-               
-              # Update
-              accuracy_sum += val_metrics_v['acc']
-              loss_sum += val_metrics_v['loss']
-              
-              # Read
-              val_read_v = sess_val.run(val_read)
-              
-              # Get checkpoint number
-              ckpt_num = re.split('-', latest_ckpt)[-1]
-
-              # Logging
-              #logger.info('VAL ckpt-{}'.format(ckpt_num) 
-              #            + ' bch-{:d}'.format(i) 
-              #            + ' cum_acc: {:.2f}%'.format(accuracy_sum/(i+1)*100) 
-              #            + ' cum_loss: {:.4f}'.format(loss_sum/(i+1))
-              #           )
-            
-            # Average across batches
-            ave_acc = accuracy_sum / num_batches_val
-            ave_loss = loss_sum / num_batches_val
+            ave_acc, ave_loss = evaluate(
+                sess_train, eval_metrics, iterators['validate'],
+                {iterator_handle: eval_handles['validate'], is_train: False},
+                num_batches_val)
              
-            logger.info('VAL ckpt-{}'.format(ckpt_num) 
+            logger.info('VAL stp-{}'.format(step)
                         + ' avg_acc: {:.2f}%'.format(ave_acc*100) 
                         + ' avg_loss: {:.4f}'.format(ave_loss)
                        )
@@ -649,55 +598,48 @@ def main(args):
             summary_val = tf.Summary()
             summary_val.value.add(tag="val_acc", simple_value=ave_acc)
             summary_val.value.add(tag="val_loss", simple_value=ave_loss)
-            summary_writer.add_summary(summary_val, epoch)
-          
+            summary_writer.add_summary(summary_val, step)
+
+            # Protect the best checkpoints from deletion
+            if latest_ckpt_step == step:
+              ckpt_manager.record_metric(latest_ckpt, ave_acc)
+
+        if FLAGS.ema_decay > 0:
+          with g_train.as_default():
+            sess_train.run(use_weights)
+
+        # The last evaluation is on the validation set if there is one
+        stop_value = ave_acc if FLAGS.stop_metric == 'acc' else ave_loss
+        if early_stopping is not None and early_stopping.update(stop_value):
+          stop_reason = 'no improvement in {} evaluations'.format(
+              FLAGS.early_stopping_patience)
+        if pruner is not None and pruner.report(step, stop_value):
+          stop_reason = 'pruned by the median rule'
+        if stop_reason is not None:
+          logger.info('Stop training at stp-{}: {}'.format(step, stop_reason))
+
+    step += 1
+
+  # A budget in examples or wall-clock time rarely ends on a save step, so
+  # save the final state as well
+  if step > prev_step and latest_ckpt_step != step - 1:
+    logger.info("Save Final Model")
+    epoch = int(np.floor((step - 1) / num_batches_per_epoch))
+    save_checkpoint(
+        ckpt_manager, sess_train, summary_writer,
+        os.path.join(train_checkpoint_dir, 'model.ckpt' + str(epoch)),
+        step - 1)
+
   # Close (main loop)
+  if pruner is not None:
+    pruner.close()
+  ckpt_manager.wait()
+  telemetry.close()
+  summary_writer.close()
   sess_train.close()
-  sess_val.close()
   sys.exit()
 
   
-def tower_fn(build_arch, 
-             x, 
-             y, 
-             scope, 
-             num_classes, 
-             is_train=True, 
-             reuse_variables=None):
-  """Model tower to be run on each GPU.
-  
-  Author:
-    Ashley Gritzman 27/11/2018
-    
-  Args: 
-    build_arch:
-    x: split of batch_x allocated to particular GPU
-    y: split of batch_y allocated to particular GPU
-    scope:
-    num_classes:
-    is_train:
-    reuse_variables: False for the first GPU, and True for subsequent GPUs
-
-  Returns:
-    loss: mean loss across samples for one tower (scalar)
-    scores: 
-      If the architecture is a capsule network, then the scores are the output 
-      activations of the class caps.
-      If the architecture is the CNN baseline, then the scores are the logits of 
-      the final layer.
-      (samples_per_tower, n_classes)
-      (64/4=16, 5)
-  """
-  
-  with tf.variable_scope(tf.get_variable_scope(), reuse=reuse_variables):
-    if is_train:
-      output = build_arch(x, is_train, num_classes=num_classes, y=y)
-    else:
-      output = build_arch(x, is_train, num_classes=num_classes)
-  loss = mod.total_loss(output, y)
-  return loss, output['scores']
-
-
 def average_gradients(tower_grads):
   """Compute average gradients across all towers.
   
@@ -743,6 +685,50 @@ def average_gradients(tower_grads):
   return average_grads
           
 
+def save_checkpoint(ckpt_manager, session, summary_writer, ckpt_path, step):
+  """Save a checkpoint, and write the time training was blocked.
+
+  Args:
+    ckpt_manager: checkpoints.CheckpointManager
+    session: training session
+    summary_writer: writer for the checkpoint_blocked_sec summary
+    ckpt_path: prefix of the checkpoint files
+    step: training step
+  Returns:
+    ckpt_path: path of the checkpoint
+  """
+  ckpt_path, blocked = ckpt_manager.save(session, ckpt_path, step)
+  summary_ckpt = tf.Summary()
+  summary_ckpt.value.add(tag="checkpoint_blocked_sec", simple_value=blocked)
+  summary_writer.add_summary(summary_ckpt, step)
+  return ckpt_path
+
+
+def evaluate(session, metrics, iterator, feed_dict, num_batches):
+  """Average metrics over an evaluation dataset.
+
+  The iterator is restarted first, so every evaluation sees the same batches.
+
+  Args:
+    session: session with the training graph
+    metrics: dict with the 'acc' and 'loss' tensors
+    iterator: initializable iterator of the evaluation dataset
+    feed_dict: feeds the handle of iterator, and is_train=False
+    num_batches: number of batches to average over
+  Returns:
+    ave_acc: mean accuracy over the batches
+    ave_loss: mean loss over the batches
+  """
+  session.run(iterator.initializer)
+  accuracy_sum = 0
+  loss_sum = 0
+  for i in range(num_batches):
+    metrics_v = session.run(metrics, feed_dict=feed_dict)
+    accuracy_sum += metrics_v['acc']
+    loss_sum += metrics_v['loss']
+  return accuracy_sum / num_batches, loss_sum / num_batches
+
+
 def extract_step(path):
   """Returns the step from the file format name of Tensorflow checkpoints.
   
@@ -765,7 +751,11 @@ def load_training(saver, session, load_dir):
   
   If there is no functioning saved model or FLAGS.restart is set, cleans the
   load_dir directory. Otherwise, loads the latest saved checkpoint in load_dir
-  to session.
+  to session. If the saver also restores the state of the input iterator,
+  but the checkpoint was written without it, only the variables are restored
+  and the input pipeline starts from the beginning. Moving averages of the
+  weights missing from the checkpoint start from the restored weights, and
+  other missing variables keep their initial values.
   
   Author:
     Ashley Gritzman 26/09/2018
@@ -785,7 +775,35 @@ def load_training(saver, session, load_dir):
   if tf.gfile.Exists(checkpoint_dir):
     ckpt = tf.train.get_checkpoint_state(checkpoint_dir)
     if ckpt and ckpt.model_checkpoint_path:
+      reader = tf.train.NewCheckpointReader(ckpt.model_checkpoint_path)
+      saveables = tf.get_collection(tf.GraphKeys.SAVEABLE_OBJECTS)
+      found = [v for v in tf.global_variables()
+               if reader.has_tensor(v.op.name)]
+      missing = [v for v in tf.global_variables()
+                 if not reader.has_tensor(v.op.name)]
+      if not all(reader.has_tensor(spec.name)
+                 for s in saveables for spec in s.specs):
+        logger.warning("Checkpoint has no input pipeline state, restoring "
+                       "variables only")
+        saver = tf.train.Saver(found)
+      elif missing:
+        saver = tf.train.Saver(found + saveables)
       saver.restore(session, ckpt.model_checkpoint_path)
+
+      # Restore the weights into the moving averages of checkpoints written
+      # without them
+      ema_suffix = '/ExponentialMovingAverage'
+      averages = {v.op.name[:-len(ema_suffix)]: v for v in missing
+                  if v.op.name.endswith(ema_suffix)
+                  and reader.has_tensor(v.op.name[:-len(ema_suffix)])}
+      if averages:
+        tf.train.Saver(averages).restore(session,
+                                         ckpt.model_checkpoint_path)
+      averaged = set(v.op.name for v in averages.values())
+      for v in missing:
+        if v.op.name not in averaged:
+          logger.warning("Variable {} not in checkpoint, keeping its "
+                         "initial value".format(v.op.name))
       prev_step = extract_step(ckpt.model_checkpoint_path)
       logger.info("Restored checkpoint")
     else:
@@ -797,6 +815,15 @@ def load_training(saver, session, load_dir):
   return prev_step
 
 
+def latest_step(load_dir):
+  """Step of the latest training checkpoint in load_dir, 0 if there is none."""
+  checkpoint_dir = os.path.join(load_dir, "train", "checkpoint")
+  ckpt = tf.train.get_checkpoint_state(checkpoint_dir)
+  if ckpt and ckpt.model_checkpoint_path:
+    return extract_step(ckpt.model_checkpoint_path)
+  return 0
+
+
 def find_checkpoint(load_dir, seen_step):
   """Finds the global step for the latest written checkpoint to the load_dir.
   
@@ -0,0 +1,349 @@
+"""
+License: Apache 2.0
+"""
+
+import tensorflow as tf
+
+import collections
+import re
+import time
+
+# Get logger that has already been created in config.py
+import daiquiri
+logger = daiquiri.getLogger(__name__)
+
+# Collection of the summaries that are only meaningful on steps that apply an
+# update, rather than accumulate a micro-batch, see apply_gradients_if_finite
+GRADIENT_SUMMARIES = 'gradient_summaries'
+
+
+def accumulate_gradients(grads_and_vars, accumulate_steps):
+  """Accumulate gradients over several micro-batches.
+
+  Each run of accum_op adds the current tower-averaged gradients to a set of
+  accumulators. The averaged gradients returned also depend on accum_op, so an
+  update built from them consumes the final micro-batch, and applies the mean
+  over all accumulate_steps micro-batches. The accumulators are local
+  variables, so they are initialised by tf.local_variables_initializer() and
+  are not written to checkpoints.
+
+  Args:
+    grads_and_vars:
+      list of (gradient, variable) tuples, e.g. from average_gradients
+    accumulate_steps: number of micro-batches per optimiser update
+  Returns:
+    accum_op: adds the gradients of the current micro-batch to accumulators
+    average_grads:
+      list of (gradient, variable) tuples where the gradient is the mean of
+      the accumulated gradients, including the current micro-batch
+    accum_vars: list of accumulator variables, see reset_accumulators
+  """
+
+  with tf.variable_scope('gradient_accumulation'):
+    accum_updates = []
+    accum_vars = []
+    average_grads = []
+    for g, v in grads_and_vars:
+      if g is None:
+        continue
+      accum = tf.Variable(
+          tf.zeros(v.get_shape(), dtype=v.dtype.base_dtype),
+          trainable=False,
+          collections=[tf.GraphKeys.LOCAL_VARIABLES],
+          name=v.op.name.replace('/', '_') + '_accum')
+
+      # assign_add returns the accumulator after the update, so the mean
+      # includes the current micro-batch
+      accum_update = tf.assign_add(accum, g)
+      accum_updates.append(accum_update)
+      accum_vars.append(accum)
+      average_grads.append((accum_update / float(accumulate_steps), v))
+
+    accum_op = tf.group(*accum_updates, name='accum_op')
+
+  logger.info('Accumulating gradients over {} micro-batches'
+              .format(accumulate_steps))
+
+  return accum_op, average_grads, accum_vars
+
+
+def reset_accumulators(accum_vars):
+  """Zero the gradient accumulators.
+
+  The assign ops are created here rather than in accumulate_gradients, so that
+  they pick up the control dependencies of the calling context, e.g. to zero
+  the accumulators only after the optimiser update has read them.
+
+  Args:
+    accum_vars: accumulator variables returned by accumulate_gradients
+  Returns:
+    reset_op: op that zeros all accumulators
+  """
+  return tf.group(*[tf.assign(a, tf.zeros_like(a)) for a in accum_vars],
+                  name='reset_accumulators')
+
+
+def apply_gradients_if_finite(opt, grads_and_vars, loss, global_step,
+                              update_ops=None, after_update=None):
+  """Apply gradients only if the loss and gradients are all finite.
+
+  Replaces a tf.check_numerics op per gradient (each of which has to finish
+  before the update can start, and throws an exception that aborts the step)
+  with one fused global-norm reduction. If the norm or the loss is NaN or Inf,
+  the update is skipped in-graph, in the same way as dynamic loss scaling, and
+  a counter of skipped updates is incremented instead. global_step is only
+  incremented by updates that are applied. The global norm of the gradients
+  is summarised in the GRADIENT_SUMMARIES collection, which is not merged by
+  tf.summary.merge_all.
+
+  Args:
+    opt: optimiser used to apply the gradients
+    grads_and_vars: list of (gradient, variable) tuples
+    loss: loss the gradients were computed from (scalar)
+    global_step: incremented when the update is applied
+    update_ops: ops to run before the check, e.g. batch norm updates
+    after_update: function building the ops to run after an applied update,
+      e.g. the update of moving averages, which a skipped update leaves
+      unchanged too
+  Returns:
+    train_op: applies the update, or increments skipped_steps
+    skipped_steps:
+      number of updates skipped because of non-finite values, this is a
+      global variable so it is saved with the checkpoints
+      (scalar)
+  """
+
+  with tf.variable_scope('finite_check'):
+    skipped_steps = tf.get_variable(
+        'skipped_steps',
+        shape=[],
+        dtype=tf.int64,
+        initializer=tf.zeros_initializer(),
+        trainable=False)
+
+    # A single reduction over all gradients: if any element is NaN or Inf,
+    # then so is the global norm
+    grads = [g for g, _ in grads_and_vars if g is not None]
+    with tf.control_dependencies(update_ops):
+      grad_norm = tf.global_norm(grads)
+      is_finite = tf.logical_and(tf.is_finite(grad_norm), tf.is_finite(loss))
+
+  def _apply():
+    apply_op = opt.apply_gradients(grads_and_vars, global_step=global_step)
+    if after_update is not None:
+      with tf.control_dependencies([apply_op]):
+        apply_op = after_update()
+    with tf.control_dependencies([apply_op]):
+      return tf.constant(True)
+
+  def _skip():
+    with tf.control_dependencies([tf.assign_add(skipped_steps, 1)]):
+      return tf.constant(False)
+
+  applied = tf.cond(is_finite, _apply, _skip, name='apply_if_finite')
+  train_op = tf.group(applied, name='train_op')
+
+  tf.summary.scalar('skipped_steps', tf.cast(skipped_steps, tf.float32))
+  tf.summary.scalar('gradient_global_norm', grad_norm,
+                    collections=[GRADIENT_SUMMARIES])
+
+  return train_op, skipped_steps
+
+
+TrainOps = collections.namedtuple(
+    'TrainOps', ['train_op', 'accum_op', 'reset_accum', 'skipped_steps',
+                 'num_updates'])
+
+
+def build_train_op(opt, grads_and_vars, loss, global_step, update_ops=None,
+                   accumulate_steps=1, ema=None, ema_var_list=None):
+  """Ops of a training step, shared by the training scripts.
+
+  Accumulates the gradients over accumulate_steps micro-batches (see
+  accumulate_gradients), applies them unless they are not finite (see
+  apply_gradients_if_finite) and then the moving averages of the weights,
+  and zeros the accumulators. A skipped update leaves the weights, the
+  moving averages and global_step unchanged.
+
+  Args:
+    opt: optimiser used to apply the gradients
+    grads_and_vars: list of (gradient, variable) tuples, averaged over towers
+    loss: loss the gradients were computed from (scalar)
+    global_step: incremented when an update is applied
+    update_ops: ops to run with every micro-batch, e.g. batch norm updates
+    accumulate_steps: number of micro-batches per optimiser update
+    ema: tf.train.ExponentialMovingAverage updated with every update, or None
+    ema_var_list: variables averaged by ema
+  Returns:
+    ops: TrainOps of
+      train_op: applies (or skips) the update of the last micro-batch
+      accum_op: accumulates a micro-batch, the same as train_op without
+        accumulation
+      reset_accum: zeros the accumulators, e.g. after a restore, None
+        without accumulation
+      skipped_steps: number of updates skipped, see apply_gradients_if_finite
+      num_updates: number of updates applied or skipped so far; a resumed
+        run continues the accumulation cycles after them
+  """
+  update_ops = update_ops or []
+  if accumulate_steps > 1:
+    accum_op, grads_and_vars, accum_vars = accumulate_gradients(
+        grads_and_vars, accumulate_steps)
+    accum_op = tf.group(accum_op, *update_ops)
+
+  # The update is skipped in-graph if the loss or gradients contain NaN or
+  # Inf, and counted in skipped_steps
+  after_update = None
+  if ema is not None:
+    after_update = lambda: ema.apply(ema_var_list)
+  train_op, skipped_steps = apply_gradients_if_finite(
+      opt, grads_and_vars, loss, global_step, update_ops=update_ops,
+      after_update=after_update)
+
+  reset_accum = None
+  if accumulate_steps > 1:
+    # Zero the accumulators once they have been applied (or skipped)
+    with tf.control_dependencies([train_op]):
+      train_op = reset_accumulators(accum_vars)
+    # The accumulators are local variables, so they are not restored from
+    # checkpoints, and a resumed run starts a new cycle from zero
+    reset_accum = reset_accumulators(accum_vars)
+  else:
+    accum_op = train_op
+
+  num_updates = global_step + skipped_steps
+  return TrainOps(train_op, accum_op, reset_accum, skipped_steps, num_updates)
+
+
+def moving_average_swap(ema, var_list):
+  """Ops to evaluate with the moving averages in place of the weights.
+
+  use_average copies the weights into local backup variables and assigns the
+  moving averages to the weights, and use_weights copies the backups back.
+  All copies stay on the device of each variable, so the same graph can be
+  evaluated with the averaged weights without a second graph or a round trip
+  through a checkpoint.
+
+  Args:
+    ema: tf.train.ExponentialMovingAverage applied to var_list
+    var_list: variables to swap, e.g. tf.trainable_variables()
+  Returns:
+    use_average: op that swaps the moving averages in
+    use_weights: op that swaps the weights back
+  """
+  backup_updates = []
+  average_updates = []
+  weight_updates = []
+  with tf.name_scope('ema_swap'):
+    for v in var_list:
+      with tf.colocate_with(v):
+        backup = tf.Variable(
+            tf.zeros(v.get_shape(), dtype=v.dtype.base_dtype),
+            trainable=False,
+            collections=[tf.GraphKeys.LOCAL_VARIABLES],
+            name=v.op.name.replace('/', '_'))
+        backup_update = tf.assign(backup, v.read_value())
+        backup_updates.append(backup_update)
+        with tf.control_dependencies([backup_update]):
+          average_updates.append(tf.assign(v, ema.average(v)))
+        weight_updates.append(tf.assign(v, backup))
+    use_average = tf.group(*average_updates, name='use_average')
+    use_weights = tf.group(*weight_updates, name='use_weights')
+  return use_average, use_weights
+
+
+def moving_average_restore_map(ema, var_list, reader):
+  """Restore variables from their moving averages where a checkpoint has them.
+
+  Unlike ema.variables_to_restore, which only maps the trainable variables of
+  the current graph, this maps every variable whose average is in the
+  checkpoint, so a graph built with is_train=False, whose conv weights are
+  not trainable, restores the same averaged weights that training evaluates
+  with moving_average_swap.
+
+  Args:
+    ema: tf.train.ExponentialMovingAverage the checkpoint was written with
+    var_list: variables to restore, e.g. tf.global_variables()
+    reader: tf.train.NewCheckpointReader of the checkpoint
+  Returns:
+    var_map: dict of variable by name in the checkpoint, for tf.train.Saver
+    averaged: variables restored from their moving averages
+  """
+  var_map = {}
+  averaged = []
+  for v in var_list:
+    name = ema.average_name(v)
+    if reader.has_tensor(name):
+      averaged.append(v)
+    else:
+      name = v.op.name
+    var_map[name] = v
+  return var_map, averaged
+
+
+def _parse_period(spec):
+  """Split e.g. '100steps', '2.5epochs', '1e6examples' or '30min'."""
+  # The exponent needs digits, so the e of epochs is not taken for one
+  number = r'[0-9]*\.?[0-9]+(?:[eE][+-]?[0-9]+)?'
+  match = re.match(r'^\s*(' + number + r')\s*([a-zA-Z]+)\s*$', spec)
+  if match is None:
+    raise ValueError('Cannot parse period: {}'.format(spec))
+  value = float(match.group(1))
+  unit = match.group(2).lower()
+  if unit != 'mins' and unit.endswith('s'):
+    unit = unit[:-1]
+  unit = {'min': 'min', 'mins': 'min', 'h': 'h', 'hr': 'h', 'hour': 'h',
+          'step': 'step', 'example': 'example', 'epoch': 'epoch'}.get(unit)
+  if unit is None:
+    raise ValueError('Unknown unit in period: {}'.format(spec))
+  return value, unit
+
+
+class Period(object):
+  """A period of training in steps, examples, epochs or wall-clock time.
+
+  Steps, examples and epochs are all converted to steps, so that these
+  cadences are exact and reproducible, while min and h are measured in
+  wall-clock time from the creation of the object, i.e. from the start (or
+  resume) of training.
+
+  Args:
+    spec: number and unit, e.g. '100steps', '1e6examples', '2epochs',
+      '30min' or '12h'
+    batch_size: examples per step
+    steps_per_epoch: steps per epoch
+  """
+
+  def __init__(self, spec, batch_size, steps_per_epoch):
+    self.spec = spec
+    value, unit = _parse_period(spec)
+    if unit in ('min', 'h'):
+      self.steps = None
+      self.seconds = value * (60 if unit == 'min' else 3600)
+    else:
+      per_step = {'step': 1.,
+                  'example': 1. / batch_size,
+                  'epoch': float(steps_per_epoch)}[unit]
+      self.steps = max(1, int(round(value * per_step)))
+      self.seconds = None
+    self._tic = time.time()
+
+  def restart(self):
+    """Restart the wall-clock time, e.g. once the session is ready."""
+    self._tic = time.time()
+
+  def due(self, step):
+    """Whether the periodic action is due at step, restarts the clock."""
+    if self.steps is not None:
+      return step % self.steps == 0
+    now = time.time()
+    if now - self._tic >= self.seconds:
+      self._tic = now
+      return True
+    return False
+
+  def exhausted(self, step):
+    """Whether a budget of this period has been used up before step."""
+    if self.steps is not None:
+      return step > self.steps
+    return time.time() - self._tic >= self.seconds